@@ -30,8 +30,7 @@ class Asyn2f(object):
         self._client.training_process_info.global_version_used = self._client.global_model_info.version
 
         current_global_model_file_name = self._client.global_model_info.get_file_name()
-        file_exist, current_global_weights = self._client.load_weights_from_file(self._client.local_storage_path.GLOBAL_MODEL_ROOT_FOLDER, 
-                                                                          file_name= current_global_model_file_name)
+        file_exist, current_global_weights = self._client.load_global_weights_from_file(file_name= current_global_model_file_name)
 
         if file_exist:
             # for tensorflow model, there is some conflict in the dimension of 
@@ -103,8 +102,7 @@ class Asyn2f(object):
                         self._client.model.current_weights = self._client.model.get_weights()
                         # load global weights from file
                         current_global_model_file_name = self._client.global_model_info.get_file_name()
-                        file_exist, self._client.model.global_weights = self._client.load_weights_from_file(self._client.local_storage_path.GLOBAL_MODEL_ROOT_FOLDER, 
-                                                                                              current_global_model_file_name)
+                        file_exist, self._client.model.global_weights = self._client.load_global_weights_from_file(file_name= current_global_model_file_name)
                         
                         
                         if file_exist:
@@ -29,8 +29,7 @@ class KaflMStep(object):
         self._client.training_process_info.global_version_used = self._client.global_model_info.version
 
         current_global_model_file_name = self._client.global_model_info.get_file_name()
-        file_exist, current_global_weights = self._client.load_weights_from_file(self._client.local_storage_path.GLOBAL_MODEL_ROOT_FOLDER, 
-                                                                          file_name= current_global_model_file_name)
+        file_exist, current_global_weights = self._client.load_global_weights_from_file(file_name= current_global_model_file_name)
 
         if file_exist:
             # for tensorflow model, there is some conflict in the dimension of 
@@ -96,8 +95,7 @@ class KaflMStep(object):
                 if self._client.state.new_model_flag:
                     
                     current_global_model_file_name = self._client.global_model_info.get_file_name()
-                    file_exist, global_weights = self._client.load_weights_from_file(self._client.local_storage_path.GLOBAL_MODEL_ROOT_FOLDER, 
-                                                                                            current_global_model_file_name)
+                    file_exist, global_weights = self._client.load_global_weights_from_file(file_name= current_global_model_file_name)
                     
                     if file_exist:
                         LOGGER.info("*" * 20)
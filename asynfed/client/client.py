@@ -3,11 +3,11 @@ import json
 import logging
 from threading import Thread, Lock
 import uuid
-from time import sleep
+from time import sleep, time
 
 import re
-import pickle
 from tqdm import tqdm
+import numpy as np
 
 
 from asynfed.common.messages import ExchangeMessage
@@ -22,9 +22,12 @@ import asynfed.common.utils.time_ultils as time_utils
 
 from asynfed.common.messages.server.server_response_to_init import ServerRespondToInit, StorageInfo
 import asynfed.common.messages as message_utils
+from asynfed.common.weights import save_weights, load_weights, load_model, quantize, relative_change, TopKSparsifier, LowRankCompressor, DeltaWeights, subtract_base
+from asynfed.common.weights import delta_file_name, DELTA_FOLDER, resolve_layer_mask, select_layers, merge_layers
+from asynfed.common.storage_connectors import available_codecs, ShardedModelStorage, SHARD_FOLDER
 
 
-from .objects import ModelWrapper, LocalModelUploadInfo, ServerTrainingConfig
+from .objects import ModelWrapper, LocalModelUploadInfo, ServerTrainingConfig, TransferMonitor
 from .config_structure import ClientConfig
 from .components import ClientComponents
 from .algorithms import Asyn2f, KaflMStep, FedAvg
@@ -39,6 +42,9 @@ LOGGER.setLevel(logging.INFO)
 
 lock = Lock()
 
+# strategies whose rounds wait for every chosen client to send its update
+SYNCHRONOUS_STRATEGIES = ("fedavg",)
+
 
 from .objects import GlobalModelInfo
 
@@ -91,10 +97,23 @@ class Client(object):
         self.global_model_info: GlobalModelInfo = None
         self.server_training_config: ServerTrainingConfig = None
         self._remote_upload_folder: str = None
+        # set when the server stores models as layer shards
+        self._sharded_storage: ShardedModelStorage = None
+        # layers exchanged with the server (as given by the server, resolved against the model), None for all of them
+        self._federated_layers: list = None
 
         # dynamic - training process
         # local model update info object
         self._local_model_upload_info: LocalModelUploadInfo = LocalModelUploadInfo()
+        # lossy update encoder (sparse or low rank), keeps the part of the updates that is not sent yet
+        self._update_encoder = self._get_update_encoder()
+        # to detect the local updates that barely changed
+        self._last_uploaded_weights: list = None
+        # global models rebuilt from a diff since the last full download
+        self._consecutive_global_deltas: int = 0
+        self._skipped_updates: int = 0
+        # measured throughput of the cloud storage, to adapt the encoding of the updates
+        self._transfer_monitor: TransferMonitor = TransferMonitor()
 
 
         # fixed property
@@ -120,6 +139,12 @@ class Client(object):
         self._consumer_thread = Thread(target= self._start_consumer, name= "client_consumer_thread")
         self._consumer_thread.daemon = True
 
+        # the server messages that download models or evaluate them are handled here, one at a time and in order,
+        # so that the consumer thread keeps answering pings and receiving the next notifications meanwhile
+        self._message_executor = thread_pool_ref(max_workers= 1, thread_name_prefix= "client_message_handler")
+        # latest global version notified by the server, older notifications still waiting are skipped
+        self._latest_notified_version: int = None
+
         self._clean_storage_thread = Thread(target= self._clean_storage, name= "client_clean_storage_thread")
         self._clean_storage_thread.daemon = True
 
@@ -167,18 +192,26 @@ class Client(object):
 
 
     # consumer queue callback
+    # only decodes the message, handles the cheap ones (ping, stop) and hands the others to the message executor
     def on_message_received(self, ch, method, props, body):
-        msg_received: dict = message_utils.deserialize(body.decode('utf-8'))
+        try:
+            msg_received: dict = message_utils.deserialize(body, props.content_type)
+        except Exception:
+            # e.g. a msgpack message while the package is not installed, the consumer must keep running
+            LOGGER.exception(f"Drop a message that can not be decoded (content type {props.content_type})")
+            return
         message_type: str = msg_received['headers']['message_type']
 
         # these two abstract method
         # handle differently by each algorithm
         if message_type == MessageType.SERVER_INIT_RESPONSE and not self.state.is_connected and self.config.client_id == msg_received['headers']['client_id']:
-            self._handle_server_init_response(msg_received)
+            self._submit_message_handler(self._handle_server_init_response, msg_received)
 
 
-        elif message_type == MessageType.SERVER_NOTIFY_MESSAGE and self.state.is_connected:
-            self._handle_server_notify_message(msg_received)
+        elif message_type == MessageType.SERVER_NOTIFY_MESSAGE:
+            # the connection state is checked when handled, the init response queued before may not be handled yet
+            self._latest_notified_version = msg_received['content']['global_model']['version']
+            self._submit_message_handler(self._handle_queued_notify_message, msg_received)
 
 
         elif message_type == MessageType.SERVER_PING_TO_CLIENT:
@@ -192,6 +225,24 @@ class Client(object):
             self.state.is_stop_condition = True
 
 
+    def _submit_message_handler(self, handler, msg_received: dict):
+        def run():
+            try:
+                handler(msg_received)
+            except Exception:
+                LOGGER.exception(f"Fail to handle the message {msg_received['headers']['message_type']}")
+        self._message_executor.submit(run)
+
+    def _handle_queued_notify_message(self, msg_received: dict):
+        if not self.state.is_connected:
+            return
+        version = msg_received['content']['global_model']['version']
+        if self._latest_notified_version is not None and version < self._latest_notified_version:
+            LOGGER.info(f"Skip the notification of global model version {version}, version {self._latest_notified_version} is already notified")
+            return
+        self._handle_server_notify_message(msg_received)
+
+
     def _start_consumer(self):
         # LOGGER.info()
         LOGGER.info("CONSUMER THREAD IS RUNNING")
@@ -264,8 +315,8 @@ class Client(object):
             LOGGER.info("*" * 20)
             LOGGER.info(notify_evaluation_message.to_dict())
             LOGGER.info("*" * 20)
-            message = ExchangeMessage(headers= headers, content= notify_evaluation_message.to_dict()).to_json()
-            self._components.queue_producer.send_data(message)
+            message = ExchangeMessage(headers= headers, content= notify_evaluation_message.to_dict())
+            self._components.queue_producer.send_message(message)
 
             # # check the stop conditions
             # if performance > self.config.model_config.stop_conditions.expected_performance or loss < self.config.model_config.stop_conditions.expected_loss:
@@ -286,6 +337,9 @@ class Client(object):
 
     # queue handling functions
     def _handle_server_init_response(self, msg_received):
+        if self.state.is_connected:
+            # another response to init was queued and handled first
+            return
         LOGGER.info("Server Response to Init Message")
         message_utils.print_message(msg_received)
         
@@ -338,6 +392,22 @@ class Client(object):
 
 
         self._components.add_cloud_storage(storage_info= storage_info)
+        # compress the local weight files with the codec negotiated with the server,
+        # downloads detect the codec of each file by themselves
+        self._components.cloud_storage.codec = server_init_response.compression
+        LOGGER.info(f"Weight files are uploaded with compression: {server_init_response.compression}")
+
+        self._federated_layers = server_init_response.model_info.federated_layers
+        if self._federated_layers:
+            LOGGER.info(f"Only the layers {self._federated_layers} are exchanged with the server, the others stay local")
+
+        if server_init_response.model_info.storage_layout == "sharded":
+            LOGGER.info("Models are stored as content addressed layer shards")
+            self._sharded_storage = ShardedModelStorage(cloud_storage= self._components.cloud_storage,
+                                                        shard_folder= f"{remote_global_folder}/{SHARD_FOLDER}",
+                                                        local_shard_folder= os.path.join(self.local_storage_path.GLOBAL_MODEL_ROOT_FOLDER, SHARD_FOLDER))
+        else:
+            self._sharded_storage = None
 
         self.state.is_connected = True
 
@@ -414,17 +484,23 @@ class Client(object):
 
                 local_path = os.path.join(self.local_storage_path.GLOBAL_MODEL_ROOT_FOLDER, file_name)
 
-                file_exists = self._components.cloud_storage.is_file_exists(file_path= remote_path)
-                
-                download_success = False
+                # a diff from a version held locally is much smaller than the full model
+                download_success = self._download_global_delta(global_model= server_model_udpate.global_model, local_file_path= local_path)
 
-                if file_exists:
+                file_exists = download_success or self._components.cloud_storage.is_file_exists(file_path= remote_path)
+
+                if download_success:
+                    self._consecutive_global_deltas += 1
+                    LOGGER.info(f"Rebuilt global model {file_name} from a diff")
+                elif file_exists:
                     LOGGER.info("*" * 20)
                     LOGGER.info(f"{remote_path} exists in the cloud. Start updating new global model process")
                     LOGGER.info("*" * 20)
                     # to make sure the other process related to the new global model version start
                     # only when the downloading process success
                     download_success = self._attempt_to_download(remote_file_path= remote_path, local_file_path= local_path)
+                    if download_success:
+                        self._consecutive_global_deltas = 0
                 else:
                     # download_success = False
                     LOGGER.info("*" * 20)
@@ -434,8 +510,10 @@ class Client(object):
             if download_success:
                 # Only update info when download is success
                 # update local version (the latest global model that the client have)
-                self.global_model_info.update(**server_model_udpate.global_model.to_dict(), 
-                                                learning_rate = server_model_udpate.learning_rate)
+                global_model = server_model_udpate.global_model
+                self.global_model_info.update(version= global_model.version, avg_loss= global_model.avg_loss,
+                                              avg_qod= global_model.avg_qod, total_data_size= global_model.total_data_size,
+                                              learning_rate = server_model_udpate.learning_rate)
 
 
                 LOGGER.info(f"Successfully downloaded new global model {self.global_model_info.name}, version {self.global_model_info.version}")
@@ -464,8 +542,8 @@ class Client(object):
         if msg_received['content']['client_id'] == self.config.client_id:
             message_utils.print_message(msg_received)
             headers = self._create_headers(message_type= MessageType.CLIENT_PING_MESSAGE)
-            message = ExchangeMessage(headers= headers, content=ResponseToPing().to_dict()).to_json()
-            self._components.queue_producer.send_data(message)
+            message = ExchangeMessage(headers= headers, content=ResponseToPing().to_dict())
+            self._components.queue_producer.send_message(message)
 
 
     def _start_publish_new_local_update_thread(self):
@@ -488,13 +566,20 @@ class Client(object):
                 while True:
                     # make a copy of the latest local model udpate and send it
                     new_update_info: LocalModelUploadInfo = LocalModelUploadInfo(**self._local_model_upload_info.to_dict())
-                    with open(new_update_info.local_weight_path, 'wb') as f:
-                        pickle.dump(new_update_info.weight_array, f)
+                    encoding = self._save_local_update(new_update_info)
 
-                    LOGGER.info(f'Saved new local model {new_update_info.filename} to {new_update_info.local_weight_path}')
+                    LOGGER.info(f'Saved new local model {new_update_info.filename} to {new_update_info.local_weight_path} ({encoding})')
   
-                    if self._components.cloud_storage.upload(local_file_path= new_update_info.local_weight_path, 
-                                                remote_file_path= new_update_info.remote_weight_path) is True:
+                    file_size = os.path.getsize(new_update_info.local_weight_path)
+                    upload_start = time()
+                    if self._upload_model(local_file_path= new_update_info.local_weight_path, 
+                                          remote_file_path= new_update_info.remote_weight_path) is True:
+                        self._transfer_monitor.record_upload(file_size, time() - upload_start)
+                        if self._update_encoder is not None:
+                            # what was sent is not owed anymore
+                            self._update_encoder.commit()
+                        if self.config.upload.min_relative_change:
+                            self._last_uploaded_weights = new_update_info.weight_array
                 
                         # After training, notify new model to the server.
                         LOGGER.info("*" * 20)
@@ -506,13 +591,14 @@ class Client(object):
                                                     file_name=new_update_info.filename,
                                                     global_version_used=new_update_info.global_version_used, 
                                                     loss=new_update_info.train_loss,
-                                                    performance=new_update_info.train_acc)
+                                                    performance=new_update_info.train_acc,
+                                                    encoding=encoding)
                         
-                        message = ExchangeMessage(headers= headers, content= notify_local_model_message.to_dict()).to_json()
+                        message = ExchangeMessage(headers= headers, content= notify_local_model_message.to_dict())
                         
-                        self._components.queue_producer.send_data(message)
+                        self._components.queue_producer.send_message(message)
                         # self._update_profile()
-                        LOGGER.info(message)
+                        LOGGER.info(message.to_dict())
                         LOGGER.info('Notify new model to the server successfully')
                         LOGGER.info("*" * 20)
 
@@ -520,6 +606,91 @@ class Client(object):
 
 
 
+    def _save_local_update(self, update_info: LocalModelUploadInfo) -> str:
+        """
+        encode the weights as configured right before writing them,
+        only the latest update is uploaded so superseded ones are never encoded.
+        return the name of the encoding
+        """
+        upload_config = self.config.upload
+        quantization, delta = upload_config.quantization, upload_config.delta
+        if upload_config.target_transfer_time and self._update_encoder is None:
+            encoding = self._choose_upload_encoding(update_info.weight_array)
+            quantization = encoding.replace("delta-", "") if encoding.replace("delta-", "") != "full" else None
+            delta = encoding.startswith("delta")
+
+        base_weights = None
+        if self._update_encoder is not None or delta:
+            base_weights = self._load_base_global_weights(update_info.global_version_used)
+
+        if (self._update_encoder is not None or delta) and base_weights is None:
+            LOGGER.info(f"Send the full weights of {update_info.filename}, its base global model is missing")
+
+        if self._update_encoder is not None and base_weights is not None:
+            self._update_encoder.encode(update_info.weight_array, base_weights,
+                                        base_version= update_info.global_version_used).save(update_info.local_weight_path)
+            return "sparse" if upload_config.sparsity else "low_rank"
+        if self._update_encoder is not None:
+            # the full weights carry everything that was not sent yet
+            self._update_encoder.reset()
+
+        delta = delta and base_weights is not None
+        if delta:
+            weights = subtract_base(update_info.weight_array, base_weights)
+        else:
+            weights = update_info.weight_array
+
+        if quantization:
+            weights = quantize(weights, dtype= quantization, per_channel= upload_config.per_channel)
+        if delta:
+            DeltaWeights(weights, base_version= update_info.global_version_used).save(update_info.local_weight_path)
+        elif quantization:
+            weights.save(update_info.local_weight_path)
+        else:
+            save_weights(update_info.local_weight_path, weights)
+
+        encoding = quantization or "full"
+        if delta:
+            encoding = f"delta-{encoding}"
+        raw_nbytes = sum([np.asarray(layer).nbytes for layer in update_info.weight_array])
+        if raw_nbytes:
+            self._transfer_monitor.record_size_ratio(encoding, os.path.getsize(update_info.local_weight_path) / raw_nbytes)
+        return encoding
+
+    def _choose_upload_encoding(self, weight_array: list) -> str:
+        """
+        the most faithful encoding whose upload should fit in the target transfer time
+        """
+        upload_config = self.config.upload
+        raw_nbytes = sum([np.asarray(layer).nbytes for layer in weight_array])
+        for encoding in upload_config.adaptive_encodings:
+            upload_time = self._transfer_monitor.estimate_upload_time(encoding, raw_nbytes)
+            # nothing measured yet: start lossless
+            if upload_time is None or upload_time <= upload_config.target_transfer_time:
+                return encoding
+        return upload_config.adaptive_encodings[-1]
+
+    def _get_update_encoder(self):
+        upload_config = self.config.upload
+        if upload_config.sparsity:
+            return TopKSparsifier(density= upload_config.sparsity)
+        if upload_config.low_rank:
+            return LowRankCompressor(rank= upload_config.low_rank, min_size= upload_config.low_rank_min_size)
+        return None
+
+    def _load_base_global_weights(self, version: int) -> list:
+        # the global model an update is encoded against, None if it was already cleaned
+        base_file_name = f"{version}.{self._file_extension}"
+        file_exist, base_weights = self.load_weights_from_file(folder= self.local_storage_path.GLOBAL_MODEL_ROOT_FOLDER,
+                                                               file_name= base_file_name)
+        if not file_exist:
+            LOGGER.info(f"Global model {base_file_name} is not available locally anymore")
+            return None
+        if self._federated_layers:
+            return select_layers(base_weights, self._get_layer_mask(num_layers= len(base_weights)))
+        return base_weights
+
+
     def _load_config_info(self, config: dict) -> ClientConfig:
         # for multiple user to run on the same queue, 
         # set bucket name to be the queue name
@@ -529,6 +700,8 @@ class Client(object):
 
 
         client_id = config['client_id'] or str(uuid.uuid4())
+        # the routing keys of the messages for this client are built from it
+        config['client_id'] = client_id
         config['queue_consumer']['queue_name'] = f"queue_{client_id}_{config['queue_exchange']}"
 
         client_publish_queue_name = f"server-listen-queue-{queue_exchange}"
@@ -538,7 +711,14 @@ class Client(object):
             config['queue_consumer']['queue_exchange'] = queue_exchange
             config['queue_producer']['queue_exchange'] = queue_exchange
 
-        return ClientConfig(**config)
+        client_config = ClientConfig(**config)
+        # only receive the messages sent to this client and the broadcast ones,
+        # instead of every message for every client (e.g. client.# -> client.<client_id>, client.broadcast)
+        queue_consumer = client_config.queue_consumer
+        if queue_consumer.exchange_type in ("topic", "direct") and not queue_consumer.binding_keys:
+            queue_consumer.binding_keys = [queue_consumer.get_client_routing_key(client_config.client_id),
+                                           queue_consumer.get_broadcast_routing_key()]
+        return client_config
 
     def _get_local_storage_path(self) -> LocalStoragePath:
         # create local folder for storage
@@ -563,23 +743,78 @@ class Client(object):
         client_init_message: ClientInitConnection = ClientInitConnection(
                                                     role=self.config.role,
                                                     system_info= SystemInfo().to_dict(),
-                                                    data_description=DataDescription(**data_description).to_dict()
+                                                    data_description=DataDescription(**data_description).to_dict(),
+                                                    supported_codecs= available_codecs()
                                                     )
         
 
         headers = self._create_headers(message_type= MessageType.CLIENT_INIT_MESSAGE)
-        message = ExchangeMessage(headers= headers, content= client_init_message.to_dict()).to_json()
-        self._components.queue_producer.send_data(message)
+        message = ExchangeMessage(headers= headers, content= client_init_message.to_dict())
+        self._components.queue_producer.send_message(message)
 
 
 
 
+    def _download_global_delta(self, global_model, local_file_path: str) -> bool:
+        """
+        download the diff to the new global model from the latest base held locally and apply it,
+        return False to fall back to the full model
+        """
+        # lossy diffs drift from the global model, resync from the full model regularly
+        resync_period = global_model.delta_resync_period
+        if resync_period and self._consecutive_global_deltas >= resync_period:
+            LOGGER.info(f"{self._consecutive_global_deltas} global models rebuilt from a diff in a row, download the full model")
+            return False
+
+        held_bases = [base_version for base_version in global_model.delta_bases
+                      if os.path.isfile(os.path.join(self.local_storage_path.GLOBAL_MODEL_ROOT_FOLDER, f"{base_version}.{self._file_extension}"))]
+        if not held_bases:
+            return False
+
+        base_version = max(held_bases)
+        file_name = delta_file_name(global_model.version, base_version, self._file_extension)
+        remote_path = f"{self.global_model_info.remote_folder_path}/{DELTA_FOLDER}/{file_name}"
+        delta_path = f"{local_file_path}.delta"
+
+        # one attempt only, the full model is the fallback
+        if not self._components.cloud_storage.download(remote_file_path= remote_path, local_file_path= delta_path):
+            LOGGER.info(f"Fail to download the diff {remote_path}, download the full model")
+            return False
+
+        try:
+            _, base_weights = self.load_weights_from_file(folder= self.local_storage_path.GLOBAL_MODEL_ROOT_FOLDER,
+                                                          file_name= f"{base_version}.{self._file_extension}")
+            delta = load_model(delta_path)
+            delta.bind(base_weights)
+            save_weights(local_file_path, delta.to_layers())
+            return True
+        except (ValueError, AttributeError) as e:
+            LOGGER.info(f"Unable to apply the diff {remote_path}: {e}, download the full model")
+            return False
+        finally:
+            os.remove(delta_path)
+
+
+    def _upload_model(self, local_file_path: str, remote_file_path: str) -> bool:
+        if self._sharded_storage is not None:
+            return self._sharded_storage.upload_model(local_file_path= local_file_path, remote_file_path= remote_file_path)
+        return self._components.cloud_storage.upload(local_file_path= local_file_path, remote_file_path= remote_file_path)
+
+    def _download_model(self, remote_file_path: str, local_file_path: str) -> bool:
+        download_start = time()
+        if self._sharded_storage is not None:
+            download_success = self._sharded_storage.download_model(remote_file_path= remote_file_path, local_file_path= local_file_path)
+        else:
+            download_success = self._components.cloud_storage.download(remote_file_path= remote_file_path, local_file_path= local_file_path)
+        if download_success:
+            self._transfer_monitor.record_download(os.path.getsize(local_file_path), time() - download_start)
+        return download_success
+
     def _attempt_to_download(self, remote_file_path: str, local_file_path: str) -> bool:
         LOGGER.info("Downloading new global model............")
 
         for i in range(self.config.download_attempt):
-            if self._components.cloud_storage.download(remote_file_path= remote_file_path, 
-                                            local_file_path= local_file_path):
+            if self._download_model(remote_file_path= remote_file_path, local_file_path= local_file_path):
                 return True
             
             LOGGER.info(f"{i + 1} attempt: download model failed, retry in 5 seconds.")
@@ -659,6 +894,54 @@ class Client(object):
             self.model.fit(images, labels)
             break
 
+    def load_global_weights_from_file(self, file_name: str):
+        """
+        load a global model to be set to the local model:
+        the layers that are not federated are taken from the local model, they are never exchanged
+        """
+        file_exist, weights = self.load_weights_from_file(folder= self.local_storage_path.GLOBAL_MODEL_ROOT_FOLDER, file_name= file_name)
+        if file_exist and self._federated_layers:
+            local_weights = self.model.get_weights()
+            # a model that is not built yet takes the whole global model
+            if len(local_weights) == len(weights):
+                layer_mask = self._get_layer_mask(num_layers= len(weights))
+                weights = merge_layers(local_weights, layer_mask, select_layers(weights, layer_mask))
+        return file_exist, weights
+
+    def _is_negligible_update(self, weight_array: list) -> bool:
+        """
+        whether the update barely moved since the reference weights and is not worth uploading
+        """
+        upload_config = self.config.upload
+        if not upload_config.min_relative_change:
+            return False
+        # a synchronous round waits for the update of every connected client, it must always be sent
+        if self.server_training_config.strategy in SYNCHRONOUS_STRATEGIES:
+            return False
+        if upload_config.max_skipped_updates is not None and self._skipped_updates >= upload_config.max_skipped_updates:
+            self._skipped_updates = 0
+            return False
+
+        if upload_config.change_reference == "global":
+            reference_weights = self._load_base_global_weights(self.training_process_info.global_version_used)
+        else:
+            reference_weights = self._last_uploaded_weights
+        if reference_weights is None or len(reference_weights) != len(weight_array):
+            return False
+
+        change = relative_change(weight_array, reference_weights, per_layer= upload_config.change_per_layer)
+        if change >= upload_config.min_relative_change:
+            self._skipped_updates = 0
+            return False
+
+        self._skipped_updates += 1
+        LOGGER.info(f"Skip the local update of epoch {self.training_process_info.local_epoch}: relative change {change:.2e} "
+                    f"is below {upload_config.min_relative_change} ({self._skipped_updates} updates skipped in a row)")
+        return True
+
+    def _get_layer_mask(self, num_layers: int) -> list:
+        return resolve_layer_mask(self._federated_layers, num_layers)
+
     def load_weights_from_file(self, folder: str, file_name: str):
         full_path = os.path.join(folder, file_name)
 
@@ -668,8 +951,8 @@ class Client(object):
 
         weights = []
         if file_exist:
-            with open(full_path, "rb") as f:
-                weights: List = pickle.load(f)
+            # global models come from the server, the first one (initial model) may still be pickled
+            weights: List = load_weights(full_path, allow_pickle= True)
 
         return file_exist, weights
     
@@ -693,7 +976,15 @@ class Client(object):
         # regardless of os
         remote_file_path = f"{self._remote_upload_folder}/{filename}"
 
-        self._local_model_upload_info.update(weight_array= self.model.get_weights(), 
+        # only the federated layers are uploaded
+        # the weights are copied out of the model once, the federated layers are views on that copy
+        weight_array = self.model.get_weights()
+        if self._federated_layers:
+            weight_array = select_layers(weight_array, self._get_layer_mask(num_layers= len(weight_array)))
+        if self._is_negligible_update(weight_array):
+            return
+
+        self._local_model_upload_info.update(weight_array= weight_array, 
                                             filename= filename, local_weight_path= save_location, 
                                             global_version_used= self.training_process_info.global_version_used,
                                             remote_weight_path= remote_file_path,
@@ -57,12 +57,49 @@ class TestingParams(MessageObject):
         self.batch_size = batch_size
 
 
+class UploadConfig(MessageObject):
+    def __init__(self, quantization: str = None, per_channel: bool = False, sparsity: float = None,
+                 delta: bool = False, low_rank: int = None, low_rank_min_size: int = 4096,
+                 min_relative_change: float = None, change_reference: str = "uploaded",
+                 change_per_layer: bool = False, max_skipped_updates: int = None,
+                 target_transfer_time: float = None, adaptive_encodings: list = None):
+        # encode the local weights before uploading them
+        # quantization: None (full precision), int8 or float16
+        # per_channel: int8 only, one scale and zero point per output channel instead of per layer
+        # sparsity: fraction of the entries of the update (local - global version used) sent per layer, e.g. 0.01,
+        # the rest is accumulated and sent later. takes precedence over quantization
+        # delta: send local - global version used (quantized if configured) instead of the weights
+        # low_rank: rank of the factorization the update (local - global version used) of the dense and conv layers
+        # of at least low_rank_min_size entries is sent as, the rest is accumulated and sent later
+        self.quantization = quantization
+        self.per_channel = per_channel
+        self.sparsity = sparsity
+        self.delta = delta
+        self.low_rank = low_rank
+        self.low_rank_min_size = low_rank_min_size
+        # skip the updates whose relative change ||w - w_ref|| / ||w_ref|| is below min_relative_change,
+        # w_ref being the last uploaded weights (uploaded) or the global model they were trained from (global).
+        # change_per_layer: use the largest change of a single layer instead of the whole model
+        # max_skipped_updates: upload anyway after this number of consecutive skipped updates
+        # never skipped under fedavg, whose rounds wait for the update of every client
+        self.min_relative_change = min_relative_change
+        self.change_reference = change_reference
+        self.change_per_layer = change_per_layer
+        self.max_skipped_updates = max_skipped_updates
+        # target_transfer_time (seconds): pick, for each update, the first encoding of adaptive_encodings
+        # whose upload is expected to fit in it given the measured throughput (falls back to the last one).
+        # it replaces quantization and delta, the sparse and low rank encoders keep precedence
+        self.target_transfer_time = target_transfer_time
+        self.adaptive_encodings = adaptive_encodings or ["full", "float16", "int8", "delta-int8"]
+
+
 class ClientConfig(MessageObject):
     def __init__(self, queue_exchange: str, client_id: str = "", role: str = "trainer", 
                  gpu_index: int = 0, save_log: bool = True, tracking_point: int = None, 
                  download_attempt: int = 10, dataset: dict = None, stop_conditions: dict = None,
                  cleaning_config: dict = None, training_params: dict = None, testing_params: dict = None,
                  queue_consumer: dict = None, queue_producer: dict = None,
+                 upload: dict = None,
                  ):
 
         # these property provide default values
@@ -84,6 +121,7 @@ class ClientConfig(MessageObject):
         self.cleaning_config = CleaningConfig(**cleaning_config)
         self.stop_conditions = StopConditions(**stop_conditions)
         self.testing_params = TestingParams(**testing_params)
+        self.upload = UploadConfig(**(upload or {}))
 
         # these properties need to correctly specify
         self.queue_exchange = queue_exchange
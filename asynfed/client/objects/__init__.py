@@ -4,4 +4,5 @@ from .local_model_upload_info import LocalModelUploadInfo
 
 from .global_model_info import GlobalModelInfo
 from .server_training_config import ServerTrainingConfig
-# from .frameworks import 
\ No newline at end of file
+# from .frameworks import 
+from .transfer_monitor import TransferMonitor
@@ -0,0 +1,44 @@
+from typing import Dict
+
+
+# size of an encoded update relative to the full precision weights, until one is measured
+DEFAULT_SIZE_RATIOS = {"full": 1.0, "float16": 0.5, "int8": 0.25, "delta-float16": 0.5, "delta-int8": 0.25}
+
+
+class TransferMonitor(object):
+    '''
+    throughput of the transfers with the cloud storage (moving average, in bytes per second, compression included)
+    and the size ratio each upload encoding achieved, to estimate how long an upload will take
+    '''
+    def __init__(self, smoothing: float = 0.3):
+        self.smoothing = smoothing
+        self.upload_throughput: float = None
+        self.download_throughput: float = None
+        self._size_ratios: Dict[str, float] = {}
+
+    def _average(self, average: float, value: float) -> float:
+        if average is None:
+            return value
+        return (1 - self.smoothing) * average + self.smoothing * value
+
+    def record_upload(self, nbytes: int, seconds: float):
+        if seconds > 0:
+            self.upload_throughput = self._average(self.upload_throughput, nbytes / seconds)
+
+    def record_download(self, nbytes: int, seconds: float):
+        if seconds > 0:
+            self.download_throughput = self._average(self.download_throughput, nbytes / seconds)
+
+    def record_size_ratio(self, encoding: str, ratio: float):
+        self._size_ratios[encoding] = self._average(self._size_ratios.get(encoding), ratio)
+
+    def estimate_upload_time(self, encoding: str, nbytes: int) -> float:
+        """
+        seconds to upload a model of nbytes (full precision) with the given encoding, None before any transfer
+        """
+        # before the first upload, the download throughput is the best guess
+        throughput = self.upload_throughput or self.download_throughput
+        if not throughput:
+            return None
+        ratio = self._size_ratios.get(encoding, DEFAULT_SIZE_RATIOS.get(encoding, 1.0))
+        return ratio * nbytes / throughput
@@ -25,14 +25,52 @@ class MessageType:
 
 
 
+# last word of the routing key of the messages sent to every client
+BROADCAST_ROUTING_WORD = "broadcast"
+
+
 class QueueConfig(MessageObject):
     def __init__(self, queue_name: str, queue_exchange: str, exchange_type: str, 
-                 routing_key: str, endpoint: str, **kwargs):
+                 routing_key: str, endpoint: str, message_encoding: str = "json",
+                 prefetch_count: int = None, publish_queue_size: int = 1000, publish_batch_size: int = 64,
+                 publisher_confirms: bool = False, binding_keys: list = None, **kwargs):
         self.queue_name = queue_name
         self.queue_exchange = queue_exchange
         self.exchange_type = exchange_type
         self.routing_key = routing_key
         self.endpoint = endpoint
+        # encoding of the messages sent: json, orjson, msgpack or auto (the fastest json encoder available).
+        # msgpack needs the package on every peer
+        # received messages are decoded from their content type whatever this is
+        self.message_encoding = message_encoding
+        # max number of unacked messages delivered to the consumer, None for the default of its host
+        self.prefetch_count = prefetch_count
+        # producer only: max number of messages waiting to be published (senders block beyond),
+        # max number of queued messages taken at once and published one after the other before serving the connection
+        # (publishing is serial, it is not a batched confirm), and whether each publish waits for the broker to confirm it
+        self.publish_queue_size = publish_queue_size
+        self.publish_batch_size = publish_batch_size
+        self.publisher_confirms = publisher_confirms
+        # consumer only: keys the queue is bound with, the routing key alone when None
+        self.binding_keys = binding_keys
+
+    def get_binding_keys(self) -> list:
+        return self.binding_keys or [self.routing_key]
+
+    def get_client_routing_key(self, client_id: str) -> str:
+        """
+        key of the messages for one client, e.g. client.# -> client.<client_id>
+        """
+        return f"{self._routing_key_prefix()}.{client_id}"
+
+    def get_broadcast_routing_key(self) -> str:
+        """
+        key of the messages for every client, e.g. client.# -> client.broadcast
+        """
+        return f"{self._routing_key_prefix()}.{BROADCAST_ROUTING_WORD}"
+
+    def _routing_key_prefix(self) -> str:
+        return self.routing_key.split(".")[0]
     
 
 class LocalStoragePath():
@@ -1,4 +1,5 @@
 
 
 from .message import MessageObject, ExchangeMessage, deserialize, print_message
+from .message_encoders import get_encoder, get_decoder, available_encoders
 
@@ -17,8 +17,11 @@ class DataDescription(MessageObject):
 
 
 class ClientInitConnection(MessageObject):
-    def __init__(self, role: str = "trainer", system_info: dict = None, data_description: dict = None) -> None:
+    def __init__(self, role: str = "trainer", system_info: dict = None, data_description: dict = None,
+                 supported_codecs: list = None) -> None:
         self.role = role
         self.system_info = SystemInfo(**(system_info or {}))
         self.data_description = DataDescription(**(data_description or {}))
+        # compression codecs the client is able to read and write
+        self.supported_codecs = supported_codecs or ["none"]
 
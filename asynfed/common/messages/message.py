@@ -1,13 +1,19 @@
 import logging
 import json
 
-
 from abc import ABC
 
+from .message_encoders import get_encoder, get_decoder
+
+
 class MessageObject(ABC):
     def to_dict(self):
-        return {key: value if not isinstance(value, MessageObject) else value.to_dict() for key, value in self.__dict__.items()}
-    
+        # copy the attributes at once, then only convert the nested message objects
+        result = self.__dict__.copy()
+        for key, value in result.items():
+            if isinstance(value, MessageObject):
+                result[key] = value.to_dict()
+        return result
 
 
 class ExchangeMessage(MessageObject):      
@@ -33,12 +39,21 @@ class ExchangeMessage(MessageObject):
 
     def to_json(self):
         return json.dumps(self.to_dict())
+
+    def encode(self, encoder= None) -> bytes:
+        """
+        serialize with a message encoder (see message_encoders), json by default
+        """
+        return (encoder or get_encoder("json")).encode(self.to_dict())
     
 
 
 
-def deserialize(json_str) -> dict:
-    return json.loads(json_str)
+def deserialize(body, content_type: str = None) -> dict:
+    """
+    body: the raw message, decoded according to its content type header (json when there is none)
+    """
+    return get_decoder(content_type).decode(body)
 
 def print_message(dict_to_print):
     def check_value(value):
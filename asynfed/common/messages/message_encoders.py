@@ -0,0 +1,98 @@
+import json
+from typing import List
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# messages published without a content type are json
+DEFAULT_CONTENT_TYPE = "application/json"
+
+
+class JsonEncoder(object):
+    '''json with the standard library, always available'''
+    name = "json"
+    content_type = "application/json"
+
+    def is_available(self) -> bool:
+        return True
+
+    def encode(self, message: dict) -> bytes:
+        return json.dumps(message).encode("utf-8")
+
+    def decode(self, body: bytes) -> dict:
+        return json.loads(body)
+
+
+class OrjsonEncoder(JsonEncoder):
+    '''same wire format as json, encoded and decoded faster, requires the orjson package'''
+    name = "orjson"
+
+    def is_available(self) -> bool:
+        return orjson is not None
+
+    def encode(self, message: dict) -> bytes:
+        # numpy scalars may slip into the stats of a message
+        return orjson.dumps(message, option= orjson.OPT_SERIALIZE_NUMPY)
+
+    def decode(self, body: bytes) -> dict:
+        return orjson.loads(body)
+
+
+class MsgpackEncoder(object):
+    '''compact binary format, requires the msgpack package on both sides'''
+    name = "msgpack"
+    content_type = "application/msgpack"
+
+    def is_available(self) -> bool:
+        return msgpack is not None
+
+    def encode(self, message: dict) -> bytes:
+        return msgpack.packb(message, use_bin_type= True)
+
+    def decode(self, body: bytes) -> dict:
+        return msgpack.unpackb(body, raw= False)
+
+
+ENCODERS = {encoder.name: encoder for encoder in [MsgpackEncoder(), OrjsonEncoder(), JsonEncoder()]}
+
+
+def available_encoders() -> List[str]:
+    return [name for name, encoder in ENCODERS.items() if encoder.is_available()]
+
+
+def get_encoder(name: str = "json"):
+    """
+    name: msgpack, orjson, json, or auto for the fastest json one available.
+    auto never picks msgpack, peers without the package could not read it: it has to be configured explicitly.
+    an unavailable encoder falls back to the fastest json one, which every peer can read
+    """
+    if name == "auto":
+        return ENCODERS["orjson"] if ENCODERS["orjson"].is_available() else ENCODERS["json"]
+    encoder = ENCODERS.get(name or "json")
+    if encoder is None:
+        raise ValueError(f"Unknown message encoding {name}, choose one of {list(ENCODERS)} or auto")
+    if not encoder.is_available():
+        return ENCODERS["orjson"] if ENCODERS["orjson"].is_available() else ENCODERS["json"]
+    return encoder
+
+
+def get_decoder(content_type: str = None):
+    """
+    the decoder of a message from its content type header
+    """
+    content_type = content_type or DEFAULT_CONTENT_TYPE
+    if content_type == MsgpackEncoder.content_type:
+        if not ENCODERS["msgpack"].is_available():
+            raise ValueError("Received a msgpack message but the msgpack package is not installed")
+        return ENCODERS["msgpack"]
+    if content_type == JsonEncoder.content_type:
+        return ENCODERS["orjson"] if ENCODERS["orjson"].is_available() else ENCODERS["json"]
+    raise ValueError(f"Unsupported message content type {content_type}")
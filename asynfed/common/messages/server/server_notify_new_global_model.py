@@ -5,8 +5,13 @@ class GlobalModel(MessageObject):
     # def __init__(self, name: str, version: int, 
     #                     total_data_size: int, avg_loss: float, avg_qod: float):
     def __init__(self, version: int, total_data_size: int = None, 
-                 avg_loss: float = None, avg_qod: float = None):
+                 avg_loss: float = None, avg_qod: float = None, delta_bases: list = None,
+                 delta_resync_period: int = 0):
         self.version = version
+        # previous versions a diff to this version is published from
+        self.delta_bases = delta_bases or []
+        # number of consecutive diffs after which the full model is downloaded instead, 0 for never
+        self.delta_resync_period = delta_resync_period
         # self.name = name
         self.total_data_size = total_data_size
         self.avg_qod = avg_qod
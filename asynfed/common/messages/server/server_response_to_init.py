@@ -12,7 +12,8 @@ class ExchangeAt(MessageObject):
 
 class ModelInfo(MessageObject):
     def __init__(self, global_folder: str, name: str, version: str, file_extension: str, 
-                 learning_rate: float = None, exchange_at: dict = None):
+                 learning_rate: float = None, exchange_at: dict = None, storage_layout: str = "file",
+                 federated_layers: list = None):
         # url = "{global_folder}/{name}/{version}.{file_extension}"
         self.global_folder = global_folder
         self.name = name
@@ -20,6 +21,10 @@ class ModelInfo(MessageObject):
         self.file_extension = file_extension
         self.exchange_at = ExchangeAt(**(exchange_at or {}))
         self.learning_rate = learning_rate
+        # file: one weight file per model, sharded: per layer shards and a manifest
+        self.storage_layout = storage_layout
+        # layers exchanged with the server, None for the whole model
+        self.federated_layers = federated_layers
 
 
 
@@ -39,8 +44,10 @@ class StorageInfo(MessageObject):
 
 class ServerRespondToInit(MessageObject):
     def __init__(self, model_info: dict, epoch_update_frequency: int,
-                 storage_info: dict, strategy: str = "asynfed"):
+                 storage_info: dict, strategy: str = "asynfed", compression: str = "none"):
         self.strategy = strategy
+        # codec the client compresses its weight files with
+        self.compression = compression
         self.epoch_update_frequency = epoch_update_frequency
         self.model_info: ModelInfo = ModelInfo(**model_info)
         self.storage_info: StorageInfo = StorageInfo(**storage_info)
@@ -1,2 +1,3 @@
 from .queue_consumer import AmqpConsumer
-from .queue_producer import AmqpProducer
\ No newline at end of file
+from .queue_producer import AmqpProducer
+from .message_dispatcher import OrderedDispatcher
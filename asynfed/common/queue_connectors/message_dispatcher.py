@@ -0,0 +1,53 @@
+import collections
+import concurrent.futures
+import logging
+from threading import Lock
+from typing import Callable, Dict
+
+LOGGER = logging.getLogger(__name__)
+
+
+class OrderedDispatcher(object):
+    '''
+    - Runs message handlers on a pool of worker threads instead of the consumer thread.
+    - Handlers submitted with the same key (e.g. a client id) run one at a time, in submission order,
+        handlers of different keys run concurrently, so a slow one only delays the messages of its own key.
+    '''
+
+    def __init__(self, max_workers: int = 4, name: str = "message_dispatcher"):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers= max_workers, thread_name_prefix= name)
+        # per key: the handlers waiting behind the one running, a key is present while it has a handler running
+        self._pending: Dict[str, collections.deque] = {}
+        self._lock = Lock()
+
+    def submit(self, key: str, handler: Callable, *args, on_done: Callable = None):
+        """
+        run handler(*args) after the handlers already submitted with key.
+        on_done() is called once it returns, even if it raised (e.g. to ack the message)
+        """
+        with self._lock:
+            if key in self._pending:
+                self._pending[key].append((handler, args, on_done))
+                return
+            self._pending[key] = collections.deque([(handler, args, on_done)])
+        self._executor.submit(self._drain, key)
+
+    def _drain(self, key: str):
+        while True:
+            with self._lock:
+                tasks = self._pending[key]
+                if not tasks:
+                    del self._pending[key]
+                    return
+                handler, args, on_done = tasks.popleft()
+
+            try:
+                handler(*args)
+            except Exception:
+                LOGGER.exception(f"Fail to handle a message of {key}")
+            finally:
+                if on_done is not None:
+                    on_done()
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait= wait)
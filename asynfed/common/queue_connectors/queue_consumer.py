@@ -1,16 +1,23 @@
-import pika, json, logging
+import pika, logging
 
 LOGGER = logging.getLogger(__name__)
 logging.getLogger('pika').setLevel(logging.WARNING)
 LOGGER.setLevel(logging.INFO)
 
 from asynfed.common.config import QueueConfig
+import asynfed.common.messages as message_utils
 
 
 class AmqpConsumer(object):
-    def __init__(self, config: QueueConfig, host_object: object = None):
+    def __init__(self, config: QueueConfig, host_object: object = None, auto_ack: bool = True, prefetch_count: int = 1):
+        """
+        auto_ack: when False, the host acks each message with ack once it is processed,
+            up to prefetch_count messages are then delivered before the first one is acked
+        """
         self._host_object = host_object
         self._config: QueueConfig = config
+        self._auto_ack = auto_ack
+        self._prefetch_count = config.prefetch_count or prefetch_count
         self._setup_connection()
 
 
@@ -20,21 +27,43 @@ class AmqpConsumer(object):
         self._channel.exchange_declare(exchange= self._config.queue_exchange, exchange_type= self._config.exchange_type)
         self._queue = self._channel.queue_declare(queue= self._config.queue_name, exclusive= False)
         self._queue_name = self._queue.method.queue
-        self._channel.queue_bind(exchange= self._config.queue_exchange, queue= self._queue_name, 
-                                 routing_key= self._config.routing_key)
+        for binding_key in self._config.get_binding_keys():
+            self._channel.queue_bind(exchange= self._config.queue_exchange, queue= self._queue_name,
+                                     routing_key= binding_key)
+        if self._config.routing_key not in self._config.get_binding_keys():
+            # the queue may outlive a run that bound it with the routing key (e.g. client.#)
+            self._channel.queue_unbind(exchange= self._config.queue_exchange, queue= self._queue_name,
+                                       routing_key= self._config.routing_key)
 
 
     def on_request(self, ch, method, props, body):
         if self._host_object != None:
             self._host_object.on_message_received(ch, method, props, body)
         else:
-            mess = json.loads(str(body.decode("utf-8")))
-            LOGGER.info(mess)
+            try:
+                LOGGER.info(message_utils.deserialize(body, props.content_type))
+            except Exception:
+                LOGGER.exception(f"Unable to decode a message (content type {props.content_type})")
+            if not self._auto_ack:
+                ch.basic_ack(delivery_tag= method.delivery_tag)
+
+    def ack(self, ch, delivery_tag: int):
+        """
+        ack a message from any thread, the ack itself runs on the consumer thread.
+        a message delivered on a channel that was closed since is redelivered instead
+        """
+        def _ack():
+            if ch.is_open:
+                ch.basic_ack(delivery_tag= delivery_tag)
+        try:
+            ch.connection.add_callback_threadsafe(_ack)
+        except Exception as e:
+            LOGGER.info(f"Unable to ack message {delivery_tag}, it will be redelivered: {e}")
 
     def start(self):
         try:
-            self._channel.basic_qos(prefetch_count=1)
-            self._channel.basic_consume(queue= self._queue_name, on_message_callback= self.on_request, auto_ack=True)
+            self._channel.basic_qos(prefetch_count= self._prefetch_count)
+            self._channel.basic_consume(queue= self._queue_name, on_message_callback= self.on_request, auto_ack= self._auto_ack)
             self._channel.start_consuming()
             
         except Exception as e:
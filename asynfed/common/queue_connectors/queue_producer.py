@@ -1,5 +1,10 @@
+import atexit
+import collections
 import pika, uuid
 import logging
+import queue
+from threading import Event, Thread
+from time import sleep, time
 
 
 LOGGER = logging.getLogger(__name__)
@@ -7,11 +12,50 @@ logging.getLogger('pika').setLevel(logging.WARNING)
 LOGGER.setLevel(logging.INFO)
 
 from asynfed.common.config import QueueConfig
+from asynfed.common.messages import ExchangeMessage, get_encoder
+
+
+# attempts: number of times the broker refused the message
+PublishRequest = collections.namedtuple("PublishRequest", ["routing_key", "properties", "body", "attempts"], defaults= [0])
+
 
 class AmqpProducer(object):
+    '''
+    - Messages can be sent from any thread: send_data only puts them in a bounded queue
+        (blocking the caller when it is full) and returns.
+    - A single I/O thread owns the connection, takes the queued messages up to publish_batch_size at once
+        and publishes them one after the other, then keeps the connection alive (heartbeats) while idle.
+    - When the connection is lost, it reconnects with an exponential backoff and publishes
+        the messages not sent yet, in order.
+    - With publisher confirms, each publish waits for the broker to confirm that message (confirms are not batched),
+        so that the ones lost with a connection are sent again. A message the broker refuses is published again,
+        up to MAX_PUBLISH_ATTEMPTS times, then dropped with an error.
+    '''
+
+    # seconds between two reconnection attempts, doubled after each failure up to the max
+    MIN_RECONNECT_DELAY = 1
+    MAX_RECONNECT_DELAY = 30
+    # times a message refused by the broker (nack, unroutable) is published before being dropped
+    MAX_PUBLISH_ATTEMPTS = 5
+
     def __init__(self, config: QueueConfig):
         self._config = config
-        self._setup_connection()
+        self._encoder = get_encoder(config.message_encoding)
+        LOGGER.info(f"Messages are sent encoded with {self._encoder.name}")
+
+        self._publish_queue: queue.Queue = queue.Queue(maxsize= config.publish_queue_size)
+        # messages taken from the queue and not published yet, retried first after a reconnection.
+        # a message is marked done in the queue once published
+        self._pending: collections.deque = collections.deque()
+        self._connection = None
+        self._channel = None
+        self._closing = Event()
+
+        self._io_thread = Thread(target= self._run, name= "amqp_producer_io_thread")
+        self._io_thread.daemon = True
+        self._io_thread.start()
+        # deliver what is still queued (e.g. the stop message) when the program exits
+        atexit.register(self.close)
 
 
     def _setup_connection(self):
@@ -20,26 +64,100 @@ class AmqpProducer(object):
         self._channel.exchange_declare(exchange= self._config.queue_exchange, exchange_type= self._config.exchange_type)
         self._queue = self._channel.queue_declare(queue= self._config.queue_name, exclusive= False)
         self._queue_name = self._queue.method.queue
-        self._channel.queue_bind(exchange=self._config.queue_exchange, queue= self._queue_name, 
+        self._channel.queue_bind(exchange=self._config.queue_exchange, queue= self._queue_name,
                                  routing_key= self._config.routing_key)
+        if self._config.publisher_confirms:
+            self._channel.confirm_delivery()
+
 
+    def send_message(self, message: ExchangeMessage, corr_id=None, routing_key= None, expiration= 1000):
+        """
+        encode a message with the configured encoder and send it, its content type tells the receiver how to decode it
+        """
+        self.send_data(message.encode(self._encoder), corr_id= corr_id, routing_key= routing_key,
+                       expiration= expiration, content_type= self._encoder.content_type)
+
+    def send_data(self, body_mess, corr_id=None, routing_key= None, expiration= 1000, content_type= None):
+        if not corr_id:
+            corr_id = str(uuid.uuid4())
+        if not routing_key:
+            routing_key = self._config.routing_key
+        properties = pika.BasicProperties(correlation_id= corr_id, expiration= str(expiration),
+                                          content_type= content_type)
+        self._publish_queue.put(PublishRequest(routing_key= routing_key, properties= properties, body= body_mess))
+
+    def close(self, timeout: float = 10):
+        """
+        wait (up to timeout seconds) for the queued messages to be published, then close the connection
+        """
+        if self._closing.is_set():
+            return
+        deadline = time() + timeout
+        while self._publish_queue.unfinished_tasks and time() < deadline:
+            sleep(0.05)
+        self._closing.set()
+        self._io_thread.join(timeout= max(deadline - time(), 0.5))
+
+
+    def _run(self):
+        reconnect_delay = self.MIN_RECONNECT_DELAY
+        while not self._closing.is_set():
+            try:
+                self._setup_connection()
+                reconnect_delay = self.MIN_RECONNECT_DELAY
+                self._publish_loop()
+            except Exception as e:
+                LOGGER.info(e)
+                LOGGER.warning(f"Connection lost with {len(self._pending) + self._publish_queue.qsize()} messages to send. "
+                               f"Reconnecting in {reconnect_delay} seconds...")
+                self._closing.wait(reconnect_delay)
+                reconnect_delay = min(reconnect_delay * 2, self.MAX_RECONNECT_DELAY)
 
-    def send_data(self, body_mess, corr_id=None, routing_key= None, expiration= 1000):
         try:
-            if not corr_id:
-                corr_id = str(uuid.uuid4())
-            if not routing_key:
-                routing_key = self._config.routing_key
-            self.sub_properties = pika.BasicProperties(correlation_id= corr_id, expiration= str(expiration))
-            self._channel.basic_publish(exchange= self._config.queue_exchange, routing_key= routing_key,
-                                       properties=self.sub_properties, body= body_mess)
-
-        # except pika.exceptions.StreamLostError as e:
-        except Exception as e:
-            LOGGER.info(e)
-            LOGGER.exception("Connection lost. Reconnecting...")
-            self._setup_connection()
-            self.send_data(body_mess, corr_id, routing_key, expiration)
+            if self._connection is not None and self._connection.is_open:
+                self._connection.close()
+        except Exception:
+            pass
+
+    def _publish_loop(self):
+        while not self._closing.is_set():
+            if not self._pending:
+                try:
+                    # wake up regularly to serve the heartbeats
+                    self._pending.append(self._publish_queue.get(timeout= 1))
+                except queue.Empty:
+                    self._connection.process_data_events(time_limit= 0)
+                    continue
+
+            # take what else is queued at once, up to a batch
+            while len(self._pending) < self._config.publish_batch_size:
+                try:
+                    self._pending.append(self._publish_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            while self._pending:
+                request: PublishRequest = self._pending[0]
+                try:
+                    self._channel.basic_publish(exchange= self._config.queue_exchange, routing_key= request.routing_key,
+                                                properties= request.properties, body= request.body)
+                except (pika.exceptions.UnroutableError, pika.exceptions.NackError) as e:
+                    # the broker refused this message, the connection is still fine: publish it again after a while,
+                    # the messages behind it wait to keep the order
+                    request = request._replace(attempts= request.attempts + 1)
+                    if request.attempts < self.MAX_PUBLISH_ATTEMPTS:
+                        LOGGER.warning(f"The broker did not accept the message {request.properties.correlation_id} ({e}), "
+                                       f"publish it again in {self.MIN_RECONNECT_DELAY} seconds")
+                        self._pending[0] = request
+                        self._closing.wait(self.MIN_RECONNECT_DELAY)
+                        self._connection.process_data_events(time_limit= 0)
+                        continue
+                    LOGGER.error(f"The broker refused the message {request.properties.correlation_id} {request.attempts} times ({e}), drop it")
+                self._pending.popleft()
+                self._publish_queue.task_done()
+
+            # handle the frames received meanwhile (heartbeats, ...)
+            self._connection.process_data_events(time_limit= 0)
 
     def get(self) -> dict:
-        return self._config.to_dict()
\ No newline at end of file
+        return self._config.to_dict()
@@ -1,3 +1,5 @@
 from .boto3_storage_connector import Boto3Connector
 from .aws_storage_connector import AWSConnector
-from .minio_storage_connector import MinioConnector
\ No newline at end of file
+from .minio_storage_connector import MinioConnector
+from .compression import available_codecs, get_codec, negotiate_codec, PORTABLE_CODECS
+from .sharded_storage import ShardedModelStorage, SHARD_FOLDER
@@ -1,11 +1,49 @@
 from abc import ABC, abstractmethod
 import os
-from time import sleep
+from threading import Event
+from time import sleep, time
 import logging
 
 logging.getLogger(__name__)
 
 from asynfed.common.messages.server.server_response_to_init import StorageInfo
+from .compression import CompressingReader, DecompressingWriter, get_codec
+
+
+class TransferInterrupted(Exception):
+    pass
+
+
+def _check_transfer(remote_file_path: str, deadline: float = None, cancel_event: Event = None):
+    if cancel_event is not None and cancel_event.is_set():
+        raise TransferInterrupted(f"The download of {remote_file_path} is cancelled")
+    if deadline is not None and time() > deadline:
+        raise TransferInterrupted(f"The download of {remote_file_path} is over its deadline")
+
+
+class _InterruptibleWriter(object):
+    '''
+    checks the deadline and the cancel event before every chunk written by the transfer,
+    raising from write aborts the download
+    '''
+    def __init__(self, writer, remote_file_path: str, deadline: float = None, cancel_event: Event = None):
+        self._writer = writer
+        self._remote_file_path = remote_file_path
+        self._deadline = deadline
+        self._cancel_event = cancel_event
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+    def write(self, data: bytes) -> int:
+        _check_transfer(self._remote_file_path, self._deadline, self._cancel_event)
+        return self._writer.write(data)
+
+    def close(self):
+        self._writer.close()
 
 
 class Boto3Connector(ABC):
@@ -14,6 +52,8 @@ class Boto3Connector(ABC):
         self._parent_thread = parent
         self._bucket_name: str = ""
         self._time_sleep: int = 0
+        # codec used to compress uploaded files when none is given to upload
+        self.codec: str = "none"
 
         # s3 is the return object of the function boto3.client 
         self._s3 = None
@@ -24,7 +64,7 @@ class Boto3Connector(ABC):
     def _setup_connection(self, storage_info: StorageInfo):
         pass
 
-    def upload(self, local_file_path: str, remote_file_path: str, try_time=5):
+    def upload(self, local_file_path: str, remote_file_path: str, try_time=5, codec: str = None):
         # check if local_file_path is exist, if not create one
         if not os.path.exists(local_file_path):
             os.makedirs(local_file_path.split(os.path.sep)[:-1])
@@ -32,7 +72,7 @@ class Boto3Connector(ABC):
         if self._parent_thread is None:
             try:
                 logging.info(f'Uploading {local_file_path} to {remote_file_path}...')
-                self._s3.upload_file(local_file_path, self._bucket_name, remote_file_path)
+                self._upload_file(local_file_path, remote_file_path, codec= codec)
                 logging.info(f'Successfully uploaded {local_file_path} to {remote_file_path}')
                 return True
             except Exception as e:
@@ -43,7 +83,7 @@ class Boto3Connector(ABC):
             while t < try_time:
                 try:
                     logging.info(f'Uploading {local_file_path} to {remote_file_path}...')
-                    self._s3.upload_file(local_file_path, self._bucket_name, remote_file_path)
+                    self._upload_file(local_file_path, remote_file_path, codec= codec)
                     logging.info(f'Successfully uploaded {local_file_path} to {remote_file_path}')
                     self._parent_thread.on_upload(True)
                     break
@@ -54,13 +94,43 @@ class Boto3Connector(ABC):
             self._parent_thread.on_upload(False)
 
 
-    def download(self, remote_file_path, local_file_path, try_time= 5):
-        
+    def _upload_file(self, local_file_path: str, remote_file_path: str, codec: str = None):
+        codec = codec or self.codec
+        if codec == "none":
+            self._s3.upload_file(local_file_path, self._bucket_name, remote_file_path)
+            return
+        # compress chunk by chunk while streaming to the storage
+        with open(local_file_path, "rb") as f:
+            self._s3.upload_fileobj(CompressingReader(f, get_codec(codec)), self._bucket_name, remote_file_path)
+
+    def _download_file(self, remote_file_path: str, local_file_path: str, deadline: float = None, cancel_event: Event = None):
+        # compressed objects are detected from their frame header and decompressed while downloading,
+        # the file only appears under its final name once it is complete
+        partial_file_path = f"{local_file_path}.part"
+        try:
+            with open(partial_file_path, "wb") as f:
+                writer = DecompressingWriter(f)
+                if deadline is not None or cancel_event is not None:
+                    writer = _InterruptibleWriter(writer, remote_file_path, deadline= deadline, cancel_event= cancel_event)
+                self._s3.download_fileobj(self._bucket_name, remote_file_path, writer)
+                writer.close()
+            # a download cancelled while its last chunk was written is not kept either
+            _check_transfer(remote_file_path, deadline, cancel_event)
+            os.replace(partial_file_path, local_file_path)
+        finally:
+            if os.path.exists(partial_file_path):
+                os.remove(partial_file_path)
+
+    def download(self, remote_file_path, local_file_path, try_time= 5, deadline: float = None, cancel_event: Event = None):
+        """
+        deadline (a time() value) and cancel_event: the transfer is interrupted as soon as the deadline is over
+        or the event is set, nothing is written to local_file_path then
+        """
         # call synchronously
         if self._parent_thread is None:
             try:
                 logging.info(f'Saving {remote_file_path} to {local_file_path}...')
-                self._s3.download_file(self._bucket_name, remote_file_path, local_file_path)
+                self._download_file(remote_file_path, local_file_path, deadline= deadline, cancel_event= cancel_event)
                 logging.info(f'Saved {remote_file_path} to {local_file_path}')
                 return True
             except Exception as e:
@@ -72,7 +142,7 @@ class Boto3Connector(ABC):
             while t < try_time:
                 try:
                     logging.info(f'Saving {remote_file_path} to {local_file_path}...')
-                    self._s3.download_file(self._bucket_name, remote_file_path, local_file_path)
+                    self._download_file(remote_file_path, local_file_path)
                     logging.info(f'Saved {remote_file_path} to {local_file_path}')
                     result = True
                     break
@@ -83,6 +153,20 @@ class Boto3Connector(ABC):
                     raise e
             self._parent_thread.on_download(result)
 
+    def touch(self, remote_file_path: str) -> bool:
+        """
+        refresh the last modified time of a remote file by copying it onto itself,
+        return False if it does not exist (or can not be copied)
+        """
+        try:
+            self._s3.copy_object(Bucket=self._bucket_name, Key=remote_file_path,
+                                 CopySource={"Bucket": self._bucket_name, "Key": remote_file_path},
+                                 MetadataDirective="REPLACE")
+            return True
+        except Exception as e:
+            logging.info(f"Unable to touch {remote_file_path}: {e}")
+            return False
+
     def is_file_exists(self, file_path: str) -> bool:
         """
         Check if a file with the given file_path exists in the bucket with the given bucket_name.
@@ -0,0 +1,241 @@
+import logging
+import lzma
+import zlib
+from typing import BinaryIO, List
+
+LOGGER = logging.getLogger(__name__)
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# a compressed object starts with the frame magic, the length of the codec name and the codec name,
+# the compressed stream follows. files without the magic are stored as they are
+FRAME_MAGIC = b"AFZ1"
+# size of the chunks read from the source file and handed to the codec
+CHUNK_SIZE = 1024 * 1024
+
+
+class Codec(object):
+    '''
+    a streaming codec: compressor() and decompressor() return objects
+    that process one chunk at a time, so a file is never held in memory as a whole
+    '''
+    name = "none"
+
+    def is_available(self) -> bool:
+        return True
+
+    def compressor(self):
+        return _Passthrough()
+
+    def decompressor(self):
+        return _Passthrough()
+
+
+class _Passthrough(object):
+    def compress(self, data: bytes) -> bytes:
+        return data
+
+    def decompress(self, data: bytes) -> bytes:
+        return data
+
+    def flush(self) -> bytes:
+        return b""
+
+
+class ZlibCodec(Codec):
+    '''deflate (lz77 + huffman), fast, in the standard library'''
+    name = "zlib"
+
+    def __init__(self, level: int = 1):
+        self.level = level
+
+    def compressor(self):
+        return zlib.compressobj(self.level)
+
+    def decompressor(self):
+        return zlib.decompressobj()
+
+
+class LzmaCodec(Codec):
+    '''high ratio, slow, in the standard library'''
+    name = "lzma"
+
+    def __init__(self, preset: int = 6):
+        self.preset = preset
+
+    def compressor(self):
+        return lzma.LZMACompressor(preset= self.preset)
+
+    def decompressor(self):
+        return lzma.LZMADecompressor()
+
+
+class Lz4Codec(Codec):
+    '''fastest lz codec, requires the lz4 package'''
+    name = "lz4"
+
+    def is_available(self) -> bool:
+        return lz4_frame is not None
+
+    def compressor(self):
+        return _Lz4Compressor()
+
+    def decompressor(self):
+        return lz4_frame.LZ4FrameDecompressor()
+
+
+class _Lz4Compressor(object):
+    def __init__(self):
+        self._compressor = lz4_frame.LZ4FrameCompressor()
+        self._started = False
+
+    def compress(self, data: bytes) -> bytes:
+        if not self._started:
+            self._started = True
+            return self._compressor.begin() + self._compressor.compress(data)
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        if not self._started:
+            self._started = True
+            return self._compressor.begin() + self._compressor.flush()
+        return self._compressor.flush()
+
+
+class ZstdCodec(Codec):
+    '''fast with a ratio close to lzma, requires the zstandard package'''
+    name = "zstd"
+
+    def __init__(self, level: int = 3):
+        self.level = level
+
+    def is_available(self) -> bool:
+        return zstandard is not None
+
+    def compressor(self):
+        return zstandard.ZstdCompressor(level= self.level).compressobj()
+
+    def decompressor(self):
+        return zstandard.ZstdDecompressor().decompressobj()
+
+
+CODECS = {codec.name: codec for codec in [Codec(), Lz4Codec(), ZstdCodec(), ZlibCodec(), LzmaCodec()]}
+# in the standard library: every client can read files compressed with them,
+# whatever it has installed (e.g. a client that joins after the file was uploaded)
+PORTABLE_CODECS = ["none", "zlib", "lzma"]
+
+
+def available_codecs() -> List[str]:
+    """
+    names of the codecs that can be used on this machine
+    """
+    return [name for name, codec in CODECS.items() if codec.is_available()]
+
+
+def get_codec(name: str) -> Codec:
+    codec = CODECS.get(name or "none")
+    if codec is None or not codec.is_available():
+        raise ValueError(f"Compression codec {name} is not available, available codecs: {available_codecs()}")
+    return codec
+
+
+def negotiate_codec(preferred: List[str], supported: List[str]) -> str:
+    """
+    the first preferred codec that is supported by the other side and available here, "none" otherwise
+    """
+    available = available_codecs()
+    for name in preferred or []:
+        if name in supported and name in available:
+            return name
+    return "none"
+
+
+class CompressingReader(object):
+    '''
+    read only file object that compresses the source file chunk by chunk while it is read,
+    to be streamed to the cloud storage
+    '''
+    def __init__(self, source: BinaryIO, codec: Codec):
+        self._source = source
+        self._compressor = codec.compressor()
+        self._buffer = bytearray(FRAME_MAGIC + bytes([len(codec.name)]) + codec.name.encode("ascii"))
+        self._eof = False
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+    def read(self, size: int = -1) -> bytes:
+        while not self._eof and (size is None or size < 0 or len(self._buffer) < size):
+            chunk = self._source.read(CHUNK_SIZE)
+            if chunk:
+                self._buffer += self._compressor.compress(chunk)
+            else:
+                self._buffer += self._compressor.flush()
+                self._eof = True
+
+        if size is None or size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+class DecompressingWriter(object):
+    '''
+    write only file object that detects the codec from the frame header
+    and decompresses chunk by chunk into the target file while the object is downloaded.
+    objects without a frame header are written as they are
+    '''
+    def __init__(self, target: BinaryIO):
+        self._target = target
+        self._decompressor = None
+        self._header = bytearray()
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+    def write(self, data: bytes) -> int:
+        if self._decompressor is None:
+            self._header += data
+            if not self._read_frame_header():
+                return len(data)
+            data, self._header = bytes(self._header), None
+        self._target.write(self._decompressor.decompress(data))
+        return len(data)
+
+    def _read_frame_header(self) -> bool:
+        header = self._header
+        if len(header) < len(FRAME_MAGIC) + 1:
+            # a shorter object can not be compressed, close() writes it as it is
+            return False
+        if header[:len(FRAME_MAGIC)] != FRAME_MAGIC:
+            self._decompressor = _Passthrough()
+            return True
+        name_end = len(FRAME_MAGIC) + 1 + header[len(FRAME_MAGIC)]
+        if len(header) < name_end:
+            return False
+        self._decompressor = get_codec(header[len(FRAME_MAGIC) + 1: name_end].decode("ascii")).decompressor()
+        del header[:name_end]
+        return True
+
+    def close(self):
+        if self._decompressor is None:
+            # too short to hold a frame header, it is stored as it is
+            self._target.write(bytes(self._header))
+        elif hasattr(self._decompressor, "flush"):
+            self._target.write(self._decompressor.flush())
@@ -0,0 +1,225 @@
+import collections
+import hashlib
+import json
+import logging
+import os
+import uuid
+from threading import Lock
+
+import numpy as np
+
+from asynfed.common.weights import load_weights, read_header, save_weights
+
+LOGGER = logging.getLogger(__name__)
+
+
+MANIFEST_FORMAT = "asynfed-manifest"
+MANIFEST_VERSION = 1
+# shards are stored in this sub folder of the global model folder
+SHARD_FOLDER = "shards"
+
+
+def layer_hash(layer: np.ndarray) -> str:
+    """
+    content address of a layer: sha256 of its dtype, shape and data
+    """
+    layer = np.ascontiguousarray(layer)
+    digest = hashlib.sha256(f"{layer.dtype.str}{layer.shape}".encode())
+    digest.update(layer.reshape(-1).view(np.uint8))
+    return digest.hexdigest()
+
+
+def read_manifest(file_path: str) -> dict:
+    """
+    return the manifest stored in file_path, None if it is a regular weight file
+    """
+    with open(file_path, "rb") as f:
+        if f.read(1) != b"{":
+            return None
+        f.seek(0)
+        try:
+            manifest = json.load(f)
+        except ValueError:
+            return None
+    return manifest if manifest.get("format") == MANIFEST_FORMAT else None
+
+
+class ShardedModelStorage(object):
+    '''
+    - Stores a model as one object per layer, keyed by the hash of its content, in a shared shard folder,
+        plus a small manifest (layer hashes and file metadata) under the usual model path.
+    - Layers already in the storage (frozen or unchanged ones) are never uploaded again,
+        and only the shards missing from the local shard cache are downloaded.
+    - Downloading a path that holds a regular weight file (e.g. the initial model) still works.
+    '''
+
+    def __init__(self, cloud_storage, shard_folder: str, local_shard_folder: str, keep_manifests: int = 4):
+        """
+        Args:
+            cloud_storage (Boto3Connector): storage the shards and manifests are uploaded to.
+            shard_folder (str): remote folder of the shards.
+            local_shard_folder (str): local cache of the shards.
+            keep_manifests (int, optional): the local cache keeps the shards of this number of the last downloaded models. Defaults to 4.
+        """
+        self.cloud_storage = cloud_storage
+        self.shard_folder = shard_folder
+        self.local_shard_folder = local_shard_folder
+        os.makedirs(self.local_shard_folder, exist_ok= True)
+
+        self._recent_manifests = collections.deque(maxlen= max(keep_manifests, 1))
+        # shards that were unreferenced at the last garbage collection, with their last modified time then
+        self._unreferenced_shards = {}
+        self._lock = Lock()
+
+    def _local_shard_path(self, shard_hash: str) -> str:
+        return os.path.join(self.local_shard_folder, shard_hash)
+
+    def upload_model(self, local_file_path: str, remote_file_path: str, codec: str = None) -> bool:
+        """
+        upload the shards of a weight file that are not in the storage yet, then its manifest.
+        the shards already in the storage are touched, so that the garbage collection sees they are in use again
+        """
+        header, _ = read_header(local_file_path)
+        # the file is our own, the initial model may still be pickled
+        layers = load_weights(local_file_path, allow_pickle= True)
+        metadata = header["metadata"] if header is not None else {}
+
+        shards = [{"hash": layer_hash(layer), "shape": list(np.shape(layer)), "dtype": np.asarray(layer).dtype.str}
+                  for layer in layers]
+        with self._lock:
+            # the shards of the uploaded model are kept in the local cache like those of a downloaded one
+            self._recent_manifests.append(set(shard["hash"] for shard in shards))
+
+        for shard, layer in zip(shards, layers):
+            if not self._upload_shard(shard["hash"], layer, codec= codec):
+                return False
+        self._prune_local_shards()
+
+        manifest_path = f"{local_file_path}.manifest"
+        with open(manifest_path, "w") as f:
+            json.dump({"format": MANIFEST_FORMAT, "version": MANIFEST_VERSION, "shards": shards, "metadata": metadata}, f)
+        try:
+            return self.cloud_storage.upload(manifest_path, remote_file_path, codec= "none")
+        finally:
+            os.remove(manifest_path)
+
+    def _upload_shard(self, shard_hash: str, layer: np.ndarray, codec: str = None) -> bool:
+        remote_shard_path = f"{self.shard_folder}/{shard_hash}"
+        # always ask the storage, the shard may have been garbage collected since it was last seen.
+        # reusing a shard refreshes its last modified time, the garbage collection then keeps it
+        # until the manifest referencing it is uploaded
+        if self.cloud_storage.touch(remote_shard_path):
+            return True
+
+        # the shard also goes to the local cache
+        local_shard_path = self._local_shard_path(shard_hash)
+        if not os.path.isfile(local_shard_path):
+            partial_shard_path = f"{local_shard_path}.{uuid.uuid4().hex}.part"
+            save_weights(partial_shard_path, [layer])
+            os.replace(partial_shard_path, local_shard_path)
+
+        return self.cloud_storage.upload(local_shard_path, remote_shard_path, codec= codec)
+
+    def download_model(self, remote_file_path: str, local_file_path: str, **transfer_options) -> bool:
+        """
+        download a manifest and the shards missing locally, then write the whole model to local_file_path.
+        transfer_options (deadline, cancel_event) are given to every download of the cloud storage
+        """
+        manifest_path = f"{local_file_path}.{uuid.uuid4().hex}.manifest"
+        if not self.cloud_storage.download(remote_file_path= remote_file_path, local_file_path= manifest_path, **transfer_options):
+            return False
+
+        manifest = read_manifest(manifest_path)
+        if manifest is None:
+            # a regular weight file
+            os.replace(manifest_path, local_file_path)
+            return True
+        os.remove(manifest_path)
+
+        shard_hashes = [shard["hash"] for shard in manifest["shards"]]
+        with self._lock:
+            # pin the shards of this model before fetching them
+            self._recent_manifests.append(set(shard_hashes))
+
+        layers = []
+        for shard_hash in shard_hashes:
+            layer = self._load_shard(shard_hash, **transfer_options)
+            if layer is None:
+                return False
+            layers.append(layer)
+
+        save_weights(local_file_path, layers, metadata= manifest["metadata"])
+        LOGGER.info(f"Assembled {local_file_path} from {len(layers)} shards")
+        self._prune_local_shards()
+        return True
+
+    def _load_shard(self, shard_hash: str, **transfer_options) -> np.ndarray:
+        local_shard_path = self._local_shard_path(shard_hash)
+        for _ in range(2):
+            if not os.path.isfile(local_shard_path):
+                if not self.cloud_storage.download(remote_file_path= f"{self.shard_folder}/{shard_hash}",
+                                                   local_file_path= local_shard_path, **transfer_options):
+                    LOGGER.info(f"Fail to download the shard {shard_hash}")
+                    return None
+            try:
+                # a memory map stays valid even if the shard is pruned afterwards
+                layer = load_weights(local_shard_path)[0]
+            except FileNotFoundError:
+                # pruned by another download in the meantime
+                continue
+            except ValueError as e:
+                LOGGER.info(f"The shard {shard_hash} is not a valid weight file: {e}")
+                layer = None
+
+            # the content must match the address it was looked up by
+            if layer is not None and layer_hash(layer) == shard_hash:
+                return layer
+            LOGGER.info(f"The content of the shard {shard_hash} does not match its hash, download it again")
+            try:
+                os.remove(local_shard_path)
+            except FileNotFoundError:
+                pass
+        return None
+
+    def _prune_local_shards(self):
+        with self._lock:
+            kept_shards = set().union(*self._recent_manifests)
+            for file_name in os.listdir(self.local_shard_folder):
+                if file_name not in kept_shards and not file_name.endswith(".part"):
+                    try:
+                        os.remove(self._local_shard_path(file_name))
+                    except FileNotFoundError:
+                        pass
+
+    def collect_garbage(self, manifest_paths: list):
+        """
+        delete the remote shards no manifest of manifest_paths references.
+        a shard is only deleted when it was already unreferenced at the previous collection and was not modified since
+        (uploaded or touched to be reused), so that the shards of a model being uploaded are not deleted before its manifest is
+        """
+        referenced_shards = set()
+        for remote_file_path in manifest_paths:
+            local_manifest_path = os.path.join(self.local_shard_folder, f"{uuid.uuid4().hex}.manifest.part")
+            if not self.cloud_storage.download(remote_file_path= remote_file_path, local_file_path= local_manifest_path):
+                # unknown content, keep everything this time
+                LOGGER.info(f"Unable to read {remote_file_path}, skip the shard garbage collection")
+                return
+            manifest = read_manifest(local_manifest_path)
+            os.remove(local_manifest_path)
+            if manifest is not None:
+                referenced_shards.update(shard["hash"] for shard in manifest["shards"])
+
+        last_modified = self.cloud_storage.list_files_last_modified(folder_path= self.shard_folder)
+        if last_modified is None:
+            LOGGER.info(f"Unable to list {self.shard_folder}, skip the shard garbage collection")
+            return
+        remote_shards = {remote_file_path.split("/")[-1]: remote_file_path for remote_file_path in last_modified}
+        unreferenced_shards = {shard_hash: last_modified[remote_shards[shard_hash]]
+                               for shard_hash in set(remote_shards) - referenced_shards}
+        delete_list = [remote_shards[shard_hash] for shard_hash, modified in unreferenced_shards.items()
+                       if self._unreferenced_shards.get(shard_hash) == modified]
+        self._unreferenced_shards = unreferenced_shards
+
+        if delete_list:
+            LOGGER.info(f"Delete {len(delete_list)} unreferenced shards in {self.shard_folder}")
+            self.cloud_storage.delete_files(delete_list)
@@ -0,0 +1,8 @@
+from .flat_weights import FlatWeights, WeightLayout, WeightAggregator, WeightAccumulator, ShardExecutor, aligned_zeros, is_encoded_model
+from .weight_file import save_weights, load_weights, read_header, read_metadata, is_weight_file
+from .quantization import QuantizedWeights, quantize
+from .delta import DeltaWeights, subtract_base, relative_change, delta_file_name, DELTA_FOLDER
+from .sparsification import SparseDelta, TopKSparsifier
+from .low_rank import LowRankDelta, LowRankCompressor
+from .layer_mask import resolve_layer_mask, select_layers, merge_layers
+from .encoding import load_model, is_encoded, get_base_version
@@ -0,0 +1,133 @@
+from typing import List, Tuple
+
+import numpy as np
+
+from .quantization import QuantizedWeights
+from .weight_file import save_weights
+
+
+# global model diffs are published in this sub folder of the global model folder
+DELTA_FOLDER = "deltas"
+
+
+class DeltaWeights(object):
+    '''
+    a model sent as its difference with a global version (the base): local - base,
+    stored as plain layers or encoded (e.g. quantized, deltas have a much smaller range than the weights).
+    decoding needs the base to be bound first (bind), then writes base + delta layer by layer
+    '''
+    def __init__(self, delta, base_version: int):
+        # list of layers or an encoded model (QuantizedWeights)
+        self.delta = delta
+        self.base_version = base_version
+        self.base_layers: list = None
+
+    def __len__(self):
+        return len(self.layers)
+
+    @property
+    def layers(self) -> List[np.ndarray]:
+        # only their shapes are used to lay out the aggregating buffers
+        return self.delta.layers if hasattr(self.delta, "decode_layer") else self.delta
+
+    @property
+    def nbytes(self) -> int:
+        if hasattr(self.delta, "decode_layer"):
+            return self.delta.nbytes
+        return sum([np.asarray(layer).nbytes for layer in self.delta])
+
+    def bind(self, base_layers: list):
+        if len(base_layers) != len(self.layers) or any(np.shape(base) != np.shape(layer) for base, layer in zip(base_layers, self.layers)):
+            raise ValueError(f"The global model {self.base_version} does not match the shape of the delta update")
+        self.base_layers = base_layers
+
+    def decode_layer(self, index: int, out: np.ndarray, alpha: float = 1.0):
+        """
+        write alpha * (base + delta) into out (same shape), without any temporary array
+        """
+        if self.base_layers is None:
+            raise ValueError(f"The global model {self.base_version} the delta update is based on is not bound")
+        if hasattr(self.delta, "decode_layer"):
+            self.delta.decode_layer(index, out)
+        else:
+            np.copyto(out, self.delta[index], casting= "unsafe")
+        np.add(out, self.base_layers[index], out= out, casting= "unsafe")
+        if alpha != 1.0:
+            np.multiply(out, alpha, out= out, casting= "unsafe")
+
+    def to_layers(self) -> List[np.ndarray]:
+        layers = []
+        for index, base_layer in enumerate(self.base_layers):
+            layer = np.empty(np.shape(base_layer), dtype= np.asarray(base_layer).dtype)
+            self.decode_layer(index, layer)
+            layers.append(layer)
+        return layers
+
+    def to_file_layers(self) -> Tuple[List[np.ndarray], dict]:
+        if hasattr(self.delta, "to_file_layers"):
+            file_layers, delta_metadata = self.delta.to_file_layers()
+        else:
+            file_layers, delta_metadata = list(self.delta), {}
+        metadata = {"encoding": "delta", "base_version": self.base_version, "delta": delta_metadata}
+        return file_layers, metadata
+
+    @classmethod
+    def from_file_layers(cls, file_layers: List[np.ndarray], metadata: dict) -> "DeltaWeights":
+        delta_metadata = metadata["delta"]
+        if delta_metadata.get("encoding") == "quantized":
+            delta = QuantizedWeights.from_file_layers(file_layers, delta_metadata)
+        elif delta_metadata.get("encoding") is None:
+            delta = file_layers
+        else:
+            raise ValueError(f"Unsupported encoding of a delta update: {delta_metadata['encoding']}")
+        return cls(delta= delta, base_version= metadata["base_version"])
+
+    def save(self, file_path: str, metadata: dict = None):
+        file_layers, delta_metadata = self.to_file_layers()
+        save_weights(file_path, file_layers, metadata= {**(metadata or {}), **delta_metadata})
+
+
+def subtract_base(layers: list, base_layers: list) -> List[np.ndarray]:
+    """
+    local - base, float layers in float32
+    """
+    deltas = []
+    for layer, base_layer in zip(layers, base_layers):
+        layer = np.asarray(layer)
+        if np.issubdtype(layer.dtype, np.floating):
+            deltas.append(np.subtract(layer, base_layer, dtype= np.float32))
+        else:
+            deltas.append(layer - base_layer)
+    return deltas
+
+
+def relative_change(layers: list, reference_layers: list, per_layer: bool = False) -> float:
+    """
+    ||layers - reference|| / ||reference|| over the float layers,
+    the largest ratio of a single layer when per_layer
+    """
+    changes, total_change, total_reference = [], 0.0, 0.0
+    for layer, reference_layer in zip(layers, reference_layers):
+        layer = np.asarray(layer)
+        if not np.issubdtype(layer.dtype, np.floating) or layer.size == 0:
+            continue
+        difference = np.subtract(layer, reference_layer, dtype= np.float32).reshape(-1)
+        reference_layer = np.asarray(reference_layer, dtype= np.float32).reshape(-1)
+        change = float(np.dot(difference, difference))
+        reference = float(np.dot(reference_layer, reference_layer))
+        total_change += change
+        total_reference += reference
+        changes.append(np.sqrt(change / reference) if reference > 0 else (np.inf if change > 0 else 0.0))
+
+    if per_layer:
+        return max(changes, default= 0.0)
+    if total_reference == 0:
+        return np.inf if total_change > 0 else 0.0
+    return float(np.sqrt(total_change / total_reference))
+
+
+def delta_file_name(version: int, base_version: int, file_extension: str) -> str:
+    """
+    name of the diff from the global model base_version to version, e.g. 12.from-11.pkl
+    """
+    return f"{version}.from-{base_version}.{file_extension}"
@@ -0,0 +1,40 @@
+from .delta import DeltaWeights
+from .low_rank import LowRankDelta
+from .quantization import QuantizedWeights
+from .sparsification import SparseDelta
+from .weight_file import load_weights, read_header
+
+
+def load_model(file_path: str, mmap: bool = True, allow_pickle: bool = False):
+    """
+    load a weight file as it was encoded:
+    a list of layers for plain files, a QuantizedWeights for quantized ones,
+    a SparseDelta, a DeltaWeights or a LowRankDelta for updates relative to a global model (to be bound to it before decoding)
+    """
+    header, _ = read_header(file_path)
+    file_layers = load_weights(file_path, mmap= mmap, allow_pickle= allow_pickle)
+    encoding = header["metadata"].get("encoding") if header is not None else None
+
+    if encoding is None:
+        return file_layers
+    if encoding == "quantized":
+        return QuantizedWeights.from_file_layers(file_layers, header["metadata"])
+    if encoding == "sparse":
+        return SparseDelta.from_file_layers(file_layers, header["metadata"])
+    if encoding == "delta":
+        return DeltaWeights.from_file_layers(file_layers, header["metadata"])
+    if encoding == "low_rank":
+        return LowRankDelta.from_file_layers(file_layers, header["metadata"])
+    raise ValueError(f"{file_path} uses the unknown encoding {encoding}")
+
+
+def is_encoded(file_path: str) -> bool:
+    header, _ = read_header(file_path)
+    return header is not None and header["metadata"].get("encoding") is not None
+
+
+def get_base_version(model) -> int:
+    """
+    the global version an encoded update is relative to, None for self-contained models
+    """
+    return getattr(model, "base_version", None)
@@ -0,0 +1,364 @@
+import concurrent.futures
+import logging
+from typing import Callable, List
+
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+
+thread_pool_ref = concurrent.futures.ThreadPoolExecutor
+
+
+# the start of every buffer and every layer inside it is aligned to 64 bytes
+# (one cache line, also the width of the widest simd registers)
+ALIGNMENT = 64
+
+# below this number of elements per shard, handing the work to another thread costs more than it saves
+MIN_SHARD_SIZE = 1 << 16
+
+
+def aligned_zeros(shape, dtype= np.float32, alignment: int = ALIGNMENT) -> np.ndarray:
+    """
+    allocate a zero-filled array whose first element is aligned to `alignment` bytes
+    """
+    dtype = np.dtype(dtype)
+    shape = (shape,) if isinstance(shape, (int, np.integer)) else tuple(shape)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    raw = np.zeros(nbytes + alignment, dtype= np.uint8)
+    start = -raw.ctypes.data % alignment
+    return raw[start: start + nbytes].view(dtype).reshape(shape)
+
+
+class WeightLayout(object):
+    '''
+    the index of a model stored in one flat buffer:
+    shape, size and offset (in elements) of every layer.
+    each layer starts at an aligned offset, the gap between two layers is zero padding
+    '''
+    def __init__(self, shapes: list, dtype= np.float32):
+        self.dtype = np.dtype(dtype)
+        self.shapes: List[tuple] = [tuple(int(dim) for dim in shape) for shape in shapes]
+        self.sizes: List[int] = [int(np.prod(shape)) for shape in self.shapes]
+
+        # number of elements of one alignment block
+        self.block: int = max(ALIGNMENT // self.dtype.itemsize, 1)
+        self.offsets: List[int] = []
+        offset = 0
+        for size in self.sizes:
+            self.offsets.append(offset)
+            offset += -(-size // self.block) * self.block
+        # total number of elements of the buffer, padding included
+        self.size: int = offset
+
+    @classmethod
+    def from_layers(cls, layers: list, dtype= np.float32) -> "WeightLayout":
+        return cls(shapes= [np.shape(layer) for layer in layers], dtype= dtype)
+
+    def matches(self, layers: list) -> bool:
+        return len(layers) == len(self.shapes) and all(np.shape(layer) == shape for layer, shape in zip(layers, self.shapes))
+
+    def segments(self, start: int, stop: int):
+        """
+        yield (layer index, start, stop) of the part of every layer that falls in [start, stop) of the buffer,
+        start and stop being counted in elements from the beginning of the layer
+        """
+        for index, (offset, size) in enumerate(zip(self.offsets, self.sizes)):
+            if offset >= stop:
+                break
+            segment_start = max(start, offset)
+            segment_stop = min(stop, offset + size)
+            if segment_start < segment_stop:
+                yield index, segment_start - offset, segment_stop - offset
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def __eq__(self, other):
+        return isinstance(other, WeightLayout) and self.dtype == other.dtype and self.shapes == other.shapes
+
+
+class ShardExecutor(object):
+    '''
+    run numpy operations over shards (contiguous element ranges) of flat buffers on a thread pool.
+    numpy releases the GIL inside copies, ufuncs and blas calls, so the shards of one buffer
+    are processed on separate cores without copying anything between threads.
+    with a single thread, everything runs in the calling thread
+    '''
+    def __init__(self, num_threads: int = 1):
+        self.num_threads = max(int(num_threads or 1), 1)
+        self._pool = None
+        if self.num_threads > 1:
+            self._pool = thread_pool_ref(max_workers= self.num_threads, thread_name_prefix= "aggregating_shard")
+
+    def split(self, layout: WeightLayout) -> List[slice]:
+        """
+        split the buffer of the layout in at most num_threads shards of the same size,
+        each shard starts on an alignment block
+        """
+        num_shards = max(min(self.num_threads, layout.size // MIN_SHARD_SIZE), 1)
+        shard_size = -(-layout.size // num_shards)
+        shard_size = -(-shard_size // layout.block) * layout.block
+        return [slice(start, min(start + shard_size, layout.size)) for start in range(0, layout.size, shard_size)]
+
+    def run(self, function: Callable, shards: list):
+        """
+        call function on every shard (or any other work item, e.g. a layer index) and wait for all of them
+        """
+        if self._pool is None or len(shards) < 2:
+            for shard in shards:
+                function(shard)
+            return
+        # consuming the results waits for every shard and raises the first exception
+        list(self._pool.map(function, shards))
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait= False)
+
+
+def is_encoded_model(model) -> bool:
+    """
+    encoded models (e.g. QuantizedWeights) are decoded layer by layer into a float buffer
+    through decode_layer(index, out, alpha), their `layers` only give the shapes
+    """
+    return hasattr(model, "decode_layer")
+
+
+def _layers_of(model) -> list:
+    if isinstance(model, FlatWeights):
+        return model.to_layers()
+    if is_encoded_model(model):
+        return model.layers
+    return model
+
+
+class FlatWeights(object):
+    '''
+    a whole model stored as one aligned contiguous buffer plus its layout.
+    layers are exposed as views on the buffer, nothing is copied when reading them
+    '''
+    def __init__(self, layout: WeightLayout, buffer: np.ndarray = None):
+        self.layout = layout
+        if buffer is None:
+            buffer = aligned_zeros(layout.size, dtype= layout.dtype)
+        self.buffer: np.ndarray = buffer
+
+    @classmethod
+    def from_layers(cls, layers: list, dtype= np.float32) -> "FlatWeights":
+        flat_weights = cls(WeightLayout.from_layers(layers, dtype= dtype))
+        flat_weights.load(layers)
+        return flat_weights
+
+    def load(self, layers: list, executor: ShardExecutor = None):
+        """
+        copy (and cast if needed) a list of layers into the buffer,
+        shard by shard on the executor if one is given
+        """
+        if is_encoded_model(layers):
+            self.decode(layers, executor= executor)
+            return
+        if isinstance(layers, FlatWeights):
+            layers = layers.to_layers()
+        if not self.layout.matches(layers):
+            raise ValueError("The shape of the given layers does not match the layout of the buffer")
+        # flat views of the source layers, contiguous layers are not copied
+        sources = [np.ravel(layer) for layer in layers]
+
+        def load_shard(shard: slice):
+            for index, start, stop in self.layout.segments(shard.start, shard.stop):
+                offset = self.layout.offsets[index]
+                np.copyto(self.buffer[offset + start: offset + stop], sources[index][start: stop], casting= "unsafe")
+
+        if executor is None:
+            load_shard(slice(0, self.layout.size))
+        else:
+            executor.run(load_shard, executor.split(self.layout))
+
+    def decode(self, model, alpha: float = 1.0, executor: ShardExecutor = None):
+        """
+        write alpha * the decoded layers of an encoded model into the buffer, layer by layer
+        """
+        if not self.layout.matches(model.layers):
+            raise ValueError("The shape of the given layers does not match the layout of the buffer")
+
+        def decode_layer(index: int):
+            model.decode_layer(index, out= self.layer(index), alpha= alpha)
+
+        indices = list(range(len(self.layout)))
+        if executor is None:
+            for index in indices:
+                decode_layer(index)
+        else:
+            executor.run(decode_layer, indices)
+
+    def layer(self, index: int) -> np.ndarray:
+        offset = self.layout.offsets[index]
+        return self.buffer[offset: offset + self.layout.sizes[index]].reshape(self.layout.shapes[index])
+
+    def to_layers(self) -> List[np.ndarray]:
+        return [self.layer(index) for index in range(len(self.layout))]
+
+    def zero(self):
+        self.buffer.fill(0)
+
+    @property
+    def nbytes(self) -> int:
+        return self.buffer.nbytes
+
+
+class WeightAggregator(object):
+    '''
+    compute weighted sums of models into a preallocated accumulator that is reused from round to round.
+    the plain models of a round are loaded into the rows of a reused staging matrix,
+    then their sum is a single matrix-vector product: alpha @ stacked_updates,
+    computed shard by shard (column ranges of the staging matrix) on the executor.
+    encoded models are never expanded into a staging row: each one is decoded and scaled
+    into a single reused scratch buffer, then added to the accumulator
+    '''
+    def __init__(self, executor: ShardExecutor = None):
+        self._executor = executor or ShardExecutor()
+        self._layout: WeightLayout = None
+        # (capacity, layout.size) staging matrix, one row per plain model
+        self._stack: np.ndarray = None
+        # one model, for the encoded models decoded one at a time
+        self._scratch: FlatWeights = None
+        self._result: FlatWeights = None
+
+    def _prepare(self, layout: WeightLayout, num_plain_models: int, has_encoded_models: bool):
+        if self._layout != layout:
+            LOGGER.info(f"Allocate aggregating buffers for a model of {len(layout)} layers, {layout.size} parameters")
+            self._layout = layout
+            self._stack = None
+            self._scratch = None
+            self._result = FlatWeights(layout)
+
+        if num_plain_models and (self._stack is None or self._stack.shape[0] < num_plain_models):
+            # every row length is a multiple of the alignment block, so every row is aligned as well
+            self._stack = aligned_zeros((num_plain_models, layout.size), dtype= layout.dtype)
+        if has_encoded_models and self._scratch is None:
+            self._scratch = FlatWeights(layout)
+
+    def weighted_sum(self, weights: list, alphas: List[float]) -> FlatWeights:
+        """
+        weights: list of models, each model is either a list of layers, a FlatWeights or an encoded model
+        alphas: the weight of each model in the sum
+        return a FlatWeights view on the reused accumulator,
+        its content is only valid until the next call
+        """
+        if len(weights) != len(alphas):
+            raise ValueError(f"Got {len(weights)} models but {len(alphas)} alpha values")
+        if not weights:
+            raise ValueError("Need at least one model to aggregate")
+
+        plain = [(model, alpha) for model, alpha in zip(weights, alphas) if not is_encoded_model(model)]
+        encoded = [(model, alpha) for model, alpha in zip(weights, alphas) if is_encoded_model(model)]
+        self._prepare(WeightLayout.from_layers(_layers_of(weights[0])), len(plain), bool(encoded))
+
+        result = self._result.buffer
+        if plain:
+            for row, (model, _) in zip(self._stack, plain):
+                FlatWeights(self._layout, buffer= row).load(model, executor= self._executor)
+
+            alpha_vector = np.asarray([alpha for _, alpha in plain], dtype= self._layout.dtype)
+            stack = self._stack[:len(plain)]
+
+            def sum_shard(shard: slice):
+                np.dot(alpha_vector, stack[:, shard], out= result[shard])
+
+            self._executor.run(sum_shard, self._executor.split(self._layout))
+        else:
+            self._result.zero()
+
+        scratch = self._scratch.buffer if encoded else None
+
+        def add_shard(shard: slice):
+            result[shard] += scratch[shard]
+
+        for model, alpha in encoded:
+            self._scratch.decode(model, alpha= alpha, executor= self._executor)
+            self._executor.run(add_shard, self._executor.split(self._layout))
+        return self._result
+
+
+class WeightAccumulator(object):
+    '''
+    running (unnormalized) weighted sum of models, updated in place one model at a time.
+    only holds the sum and one scratch buffer, regardless of the number of models added.
+    every update is done shard by shard on the executor
+    '''
+    def __init__(self, executor: ShardExecutor = None):
+        self._executor = executor or ShardExecutor()
+        self._sum: FlatWeights = None
+        self._scratch: FlatWeights = None
+        self.total_alpha: float = 0.0
+        self.count: int = 0
+
+    def add(self, model, alpha: float):
+        layers = _layers_of(model)
+        # (re)allocate only while the sum is empty, a model that does not match
+        # the models already added is rejected
+        if self._sum is None or (self.count == 0 and not self._sum.layout.matches(layers)):
+            layout = WeightLayout.from_layers(layers)
+            self._sum = FlatWeights(layout)
+            self._scratch = FlatWeights(layout)
+
+        if not self._sum.layout.matches(layers):
+            raise ValueError("The shape of the given layers does not match the layout of the running sum")
+        layout = self._sum.layout
+        sum_buffer = self._sum.buffer
+        scratch_buffer = self._scratch.buffer
+
+        if is_encoded_model(model):
+            # decode and scale layer by layer into the scratch buffer
+            self._scratch.decode(model, alpha= alpha, executor= self._executor)
+
+            def add_shard(shard: slice):
+                sum_buffer[shard] += scratch_buffer[shard]
+        else:
+            sources = [np.ravel(layer) for layer in layers]
+
+            def add_shard(shard: slice):
+                # scale while copying (and casting) into the scratch buffer,
+                # then add the whole shard at once, nothing is allocated per model
+                for index, start, stop in layout.segments(shard.start, shard.stop):
+                    offset = layout.offsets[index]
+                    np.multiply(sources[index][start: stop], alpha, out= scratch_buffer[offset + start: offset + stop], casting= "unsafe")
+                sum_buffer[shard] += scratch_buffer[shard]
+
+        self._executor.run(add_shard, self._executor.split(layout))
+        self.total_alpha += alpha
+        self.count += 1
+
+    def subtract(self, model, alpha: float):
+        """
+        remove a model previously added with the same alpha
+        """
+        self.add(model, -alpha)
+        # add counted it as a new model
+        self.count -= 2
+
+    @property
+    def weights(self) -> FlatWeights:
+        """
+        the unnormalized sum
+        """
+        return self._sum
+
+    def normalize(self) -> FlatWeights:
+        """
+        divide the sum by the total alpha in place and return it
+        """
+        total_alpha = self.total_alpha
+        sum_buffer = self._sum.buffer
+
+        def normalize_shard(shard: slice):
+            sum_buffer[shard] /= total_alpha
+
+        self._executor.run(normalize_shard, self._executor.split(self._sum.layout))
+        return self._sum
+
+    def reset(self):
+        if self._sum is not None:
+            self._sum.zero()
+        self.total_alpha = 0.0
+        self.count = 0
@@ -0,0 +1,41 @@
+from typing import List
+
+
+def resolve_layer_mask(federated_layers: list, num_layers: int) -> List[int]:
+    """
+    indices of the layers (in the get_weights order) that take part in the federation, None for all of them.
+    federated_layers: layer indices (negative ones count from the end) or slices as "start:stop" strings,
+    e.g. ["-10:"] for the last 10 weight tensors
+    """
+    if not federated_layers:
+        return None
+
+    indices = set()
+    for layer in federated_layers:
+        if isinstance(layer, str) and ":" in layer:
+            start, stop = [int(bound) if bound.strip() else None for bound in layer.split(":", 1)]
+            indices.update(range(num_layers)[slice(start, stop)])
+        else:
+            index = int(layer)
+            if not -num_layers <= index < num_layers:
+                raise ValueError(f"Federated layer {index} is out of range for a model of {num_layers} layers")
+            indices.add(index % num_layers)
+    return sorted(indices)
+
+
+def select_layers(layers: list, mask: List[int]) -> list:
+    if mask is None:
+        return layers
+    return [layers[index] for index in mask]
+
+
+def merge_layers(layers: list, mask: List[int], selected_layers: list) -> list:
+    """
+    a copy of the list layers with the masked layers replaced by selected_layers
+    """
+    if mask is None:
+        return list(selected_layers)
+    merged_layers = list(layers)
+    for index, layer in zip(mask, selected_layers):
+        merged_layers[index] = layer
+    return merged_layers
@@ -0,0 +1,164 @@
+from typing import List, Tuple
+
+import numpy as np
+
+from .weight_file import save_weights
+
+
+def _matrix_shape(shape: tuple) -> tuple:
+    # dense kernels (in, out) as they are, conv kernels (h, w, in, out) as (h * w * in, out)
+    return (int(np.prod(shape[:-1])), int(shape[-1]))
+
+
+class LowRankDelta(object):
+    '''
+    a model sent as its difference with a global version (the base),
+    each large 2-D (or 4-D conv) layer delta approximated by P @ Q.T with P, Q of rank r,
+    the other layers (biases, batch norm, ...) sent dense.
+    decoding needs the base to be bound first (bind), then writes base + delta layer by layer
+    '''
+    def __init__(self, factors: List[tuple], shapes: List[tuple], base_version: int):
+        # per layer: (P, Q) for the factorized layers, (dense delta,) for the others
+        self.factors = factors
+        self.shapes = [tuple(shape) for shape in shapes]
+        self.base_version = base_version
+        self.base_layers: list = None
+
+    def __len__(self):
+        return len(self.shapes)
+
+    @property
+    def layers(self) -> List[np.ndarray]:
+        # zero memory stand-ins, only their shapes are used to lay out the aggregating buffers
+        return [np.broadcast_to(np.zeros((), dtype= factors[0].dtype), shape) for factors, shape in zip(self.factors, self.shapes)]
+
+    @property
+    def nbytes(self) -> int:
+        return sum([array.nbytes for factors in self.factors for array in factors])
+
+    def bind(self, base_layers: list):
+        if len(base_layers) != len(self.shapes) or any(np.shape(layer) != shape for layer, shape in zip(base_layers, self.shapes)):
+            raise ValueError(f"The global model {self.base_version} does not match the shape of the low rank update")
+        self.base_layers = base_layers
+
+    def decode_layer(self, index: int, out: np.ndarray, alpha: float = 1.0):
+        """
+        write alpha * (base + delta) into out (same shape), the product P @ Q.T is written in out directly
+        """
+        if self.base_layers is None:
+            raise ValueError(f"The global model {self.base_version} the low rank update is based on is not bound")
+        factors = self.factors[index]
+        if len(factors) == 2 and out.dtype == factors[0].dtype:
+            np.matmul(factors[0], factors[1].T, out= out.reshape(_matrix_shape(self.shapes[index])))
+        elif len(factors) == 2:
+            np.copyto(out, (factors[0] @ factors[1].T).reshape(self.shapes[index]), casting= "unsafe")
+        else:
+            np.copyto(out, factors[0], casting= "unsafe")
+        np.add(out, self.base_layers[index], out= out, casting= "unsafe")
+        if alpha != 1.0:
+            np.multiply(out, alpha, out= out, casting= "unsafe")
+
+    def to_layers(self) -> List[np.ndarray]:
+        layers = []
+        for index, base_layer in enumerate(self.base_layers):
+            layer = np.empty(self.shapes[index], dtype= np.asarray(base_layer).dtype)
+            self.decode_layer(index, layer)
+            layers.append(layer)
+        return layers
+
+    def to_file_layers(self) -> Tuple[List[np.ndarray], dict]:
+        file_layers = [array for factors in self.factors for array in factors]
+        metadata = {"encoding": "low_rank", "base_version": self.base_version,
+                    "low_rank": {"shapes": [list(shape) for shape in self.shapes],
+                                 "factorized": [len(factors) == 2 for factors in self.factors]}}
+        return file_layers, metadata
+
+    @classmethod
+    def from_file_layers(cls, file_layers: List[np.ndarray], metadata: dict) -> "LowRankDelta":
+        factors, position = [], 0
+        for factorized in metadata["low_rank"]["factorized"]:
+            num_arrays = 2 if factorized else 1
+            factors.append(tuple(file_layers[position: position + num_arrays]))
+            position += num_arrays
+        return cls(factors= factors, shapes= metadata["low_rank"]["shapes"], base_version= metadata["base_version"])
+
+    def save(self, file_path: str, metadata: dict = None):
+        file_layers, low_rank_metadata = self.to_file_layers()
+        save_weights(file_path, file_layers, metadata= {**(metadata or {}), **low_rank_metadata})
+
+
+class LowRankCompressor(object):
+    '''
+    client side PowerSGD style compression: one power iteration per update,
+    warm started from the Q factors of the previous update, with error feedback
+    (what the rank r approximation misses is added to the next update)
+    '''
+    def __init__(self, rank: int, min_size: int = 4096):
+        if rank < 1:
+            raise ValueError(f"The rank of the low rank updates must be at least 1, got {rank}")
+        self.rank = rank
+        # layers with fewer entries are sent dense
+        self.min_size = min_size
+        self._residual: List[np.ndarray] = None
+        self._pending_residual: List[np.ndarray] = None
+        self._q_factors: dict = {}
+        self._rng = np.random.default_rng()
+
+    def _is_factorized(self, layer: np.ndarray) -> bool:
+        if layer.ndim < 2 or layer.size < self.min_size or not np.issubdtype(layer.dtype, np.floating):
+            return False
+        rows, columns = _matrix_shape(layer.shape)
+        # the factors must be smaller than the layer
+        return self.rank * (rows + columns) < rows * columns
+
+    def encode(self, local_layers: list, base_layers: list, base_version: int) -> LowRankDelta:
+        """
+        approximate (local - base + residual) of every large layer by a rank r product,
+        other layers are sent whole. call commit once the update is uploaded
+        """
+        if self._residual is not None and [np.shape(layer) for layer in self._residual] != [np.shape(layer) for layer in local_layers]:
+            self._residual = None
+            self._q_factors = {}
+
+        all_factors, residual = [], []
+        for index, (local_layer, base_layer) in enumerate(zip(local_layers, base_layers)):
+            local_layer = np.asarray(local_layer)
+            if not self._is_factorized(local_layer):
+                all_factors.append((local_layer - base_layer,))
+                residual.append(np.zeros(local_layer.shape, dtype= np.float32))
+                continue
+
+            delta = np.subtract(local_layer, base_layer, dtype= np.float32)
+            if self._residual is not None:
+                delta += self._residual[index]
+            matrix = delta.reshape(_matrix_shape(delta.shape))
+
+            q = self._q_factors.get(index)
+            if q is None:
+                q = self._rng.standard_normal((matrix.shape[1], self.rank)).astype(np.float32)
+            p, _ = np.linalg.qr(matrix @ q)
+            q = matrix.T @ p
+            self._q_factors[index] = q
+            all_factors.append((p, q))
+
+            # what the approximation misses stays in the residual
+            matrix -= p @ q.T
+            residual.append(delta)
+
+        self._pending_residual = residual
+        return LowRankDelta(factors= all_factors, shapes= [np.shape(layer) for layer in local_layers], base_version= base_version)
+
+    def commit(self):
+        """
+        the last encoded update reached the server, keep its residual for the next one
+        """
+        if self._pending_residual is not None:
+            self._residual = self._pending_residual
+            self._pending_residual = None
+
+    def reset(self):
+        """
+        the full weights were sent instead, nothing is owed anymore
+        """
+        self._residual = None
+        self._pending_residual = None
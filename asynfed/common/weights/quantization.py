@@ -0,0 +1,114 @@
+from typing import List, Tuple
+
+import numpy as np
+
+from .weight_file import save_weights
+
+
+QUANTIZATION_DTYPES = ("int8", "float16")
+
+
+class QuantizedWeights(object):
+    '''
+    a model whose float layers are stored as int8, with a scale and a zero point per layer
+    (or per output channel, the last axis), or as float16. other layers are kept as they are.
+    layers are dequantized one at a time straight into the float buffer that consumes them,
+    the full precision model is never materialized
+    '''
+    def __init__(self, layers: List[np.ndarray], scales: List[np.ndarray], zero_points: List[np.ndarray]):
+        self.layers = layers
+        # None for the layers that are only cast
+        self.scales = scales
+        self.zero_points = zero_points
+
+    def __len__(self):
+        return len(self.layers)
+
+    @property
+    def nbytes(self) -> int:
+        arrays = self.layers + [array for array in self.scales + self.zero_points if array is not None]
+        return sum([array.nbytes for array in arrays])
+
+    def decode_layer(self, index: int, out: np.ndarray, alpha: float = 1.0):
+        """
+        write alpha * dequantized layer into out (same shape), without any temporary array
+        """
+        layer = self.layers[index]
+        scale = self.scales[index]
+        if scale is None:
+            # cast first, a float16 layer times a python float would be computed in float16
+            np.copyto(out, layer, casting= "unsafe")
+            if alpha != 1.0:
+                np.multiply(out, alpha, out= out, casting= "unsafe")
+        else:
+            np.subtract(layer, self.zero_points[index], out= out, casting= "unsafe")
+            np.multiply(out, scale * alpha, out= out, casting= "unsafe")
+
+    def to_layers(self) -> List[np.ndarray]:
+        layers = []
+        for index, layer in enumerate(self.layers):
+            dtype = np.float32 if self.scales[index] is not None or layer.dtype == np.float16 else layer.dtype
+            dequantized_layer = np.empty(layer.shape, dtype= dtype)
+            self.decode_layer(index, dequantized_layer)
+            layers.append(dequantized_layer)
+        return layers
+
+    def to_file_layers(self) -> Tuple[List[np.ndarray], dict]:
+        """
+        the arrays to write in a weight file (quantized layers first, then scales and zero points)
+        and the metadata to rebuild the model from them
+        """
+        file_layers = list(self.layers)
+        scale_indices, zero_point_indices = [], []
+        for scale, zero_point in zip(self.scales, self.zero_points):
+            if scale is None:
+                scale_indices.append(None)
+                zero_point_indices.append(None)
+            else:
+                scale_indices.append(len(file_layers))
+                zero_point_indices.append(len(file_layers) + 1)
+                file_layers += [scale, zero_point]
+        metadata = {"encoding": "quantized",
+                    "quantization": {"num_layers": len(self.layers), "scales": scale_indices, "zero_points": zero_point_indices}}
+        return file_layers, metadata
+
+    @classmethod
+    def from_file_layers(cls, file_layers: List[np.ndarray], metadata: dict) -> "QuantizedWeights":
+        info = metadata["quantization"]
+        scales = [file_layers[index] if index is not None else None for index in info["scales"]]
+        zero_points = [file_layers[index] if index is not None else None for index in info["zero_points"]]
+        return cls(layers= file_layers[:info["num_layers"]], scales= scales, zero_points= zero_points)
+
+    def save(self, file_path: str, metadata: dict = None):
+        file_layers, quantization_metadata = self.to_file_layers()
+        save_weights(file_path, file_layers, metadata= {**(metadata or {}), **quantization_metadata})
+
+
+def quantize(layers: list, dtype: str = "int8", per_channel: bool = False) -> QuantizedWeights:
+    """
+    dtype: int8 (affine quantization, zero is always exactly representable) or float16
+    per_channel: int8 only, one scale and zero point per output channel (last axis) for layers of 2 dimensions or more
+    """
+    if dtype not in QUANTIZATION_DTYPES:
+        raise ValueError(f"Unsupported quantization {dtype}, choose one of {QUANTIZATION_DTYPES}")
+
+    quantized_layers, scales, zero_points = [], [], []
+    for layer in layers:
+        layer = np.asarray(layer)
+        scale = zero_point = None
+        if not np.issubdtype(layer.dtype, np.floating) or layer.size == 0:
+            quantized_layer = layer
+        elif dtype == "float16":
+            quantized_layer = layer.astype(np.float16)
+        else:
+            axis = tuple(range(layer.ndim - 1)) if per_channel and layer.ndim > 1 else None
+            low = np.minimum(np.asarray(layer.min(axis= axis), dtype= np.float32), 0)
+            high = np.maximum(np.asarray(layer.max(axis= axis), dtype= np.float32), 0)
+            scale = (high - low) / 255
+            scale = np.where(scale > 0, scale, 1.0).astype(np.float32)
+            zero_point = (-128 - np.round(low / scale)).astype(np.float32)
+            quantized_layer = np.clip(np.round(layer / scale) + zero_point, -128, 127).astype(np.int8)
+        quantized_layers.append(quantized_layer)
+        scales.append(scale)
+        zero_points.append(zero_point)
+    return QuantizedWeights(layers= quantized_layers, scales= scales, zero_points= zero_points)
@@ -0,0 +1,138 @@
+import math
+from typing import List, Tuple
+
+import numpy as np
+
+from .weight_file import save_weights
+
+
+class SparseDelta(object):
+    '''
+    a model sent as the top-k entries of its difference with a global version (the base):
+    per layer, the flat indices and the values of the kept entries.
+    decoding needs the base to be bound first (bind), then writes base + delta layer by layer
+    '''
+    def __init__(self, indices: List[np.ndarray], values: List[np.ndarray], shapes: List[tuple], base_version: int):
+        self.indices = indices
+        self.values = values
+        self.shapes = [tuple(shape) for shape in shapes]
+        self.base_version = base_version
+        self.base_layers: list = None
+
+    def __len__(self):
+        return len(self.shapes)
+
+    @property
+    def layers(self) -> List[np.ndarray]:
+        # zero memory stand-ins, only their shapes are used to lay out the aggregating buffers
+        return [np.broadcast_to(np.zeros((), dtype= values.dtype), shape) for values, shape in zip(self.values, self.shapes)]
+
+    @property
+    def nbytes(self) -> int:
+        return sum([array.nbytes for array in self.indices + self.values])
+
+    def bind(self, base_layers: list):
+        if len(base_layers) != len(self.shapes) or any(np.shape(layer) != shape for layer, shape in zip(base_layers, self.shapes)):
+            raise ValueError(f"The global model {self.base_version} does not match the shape of the sparse update")
+        self.base_layers = base_layers
+
+    def decode_layer(self, index: int, out: np.ndarray, alpha: float = 1.0):
+        """
+        write alpha * (base + delta) into out (same shape)
+        """
+        if self.base_layers is None:
+            raise ValueError(f"The global model {self.base_version} the sparse update is based on is not bound")
+        np.multiply(self.base_layers[index], alpha, out= out, casting= "unsafe")
+        # indices are unique, out is contiguous so reshape gives a view
+        out.reshape(-1)[self.indices[index]] += (alpha * self.values[index]).astype(out.dtype, copy= False)
+
+    def to_layers(self) -> List[np.ndarray]:
+        layers = []
+        for index, shape in enumerate(self.shapes):
+            layer = np.empty(shape, dtype= np.result_type(self.base_layers[index], self.values[index]))
+            self.decode_layer(index, layer)
+            layers.append(layer)
+        return layers
+
+    def to_file_layers(self) -> Tuple[List[np.ndarray], dict]:
+        file_layers = []
+        for indices, values in zip(self.indices, self.values):
+            file_layers += [indices, values]
+        metadata = {"encoding": "sparse", "base_version": self.base_version,
+                    "sparse": {"shapes": [list(shape) for shape in self.shapes]}}
+        return file_layers, metadata
+
+    @classmethod
+    def from_file_layers(cls, file_layers: List[np.ndarray], metadata: dict) -> "SparseDelta":
+        return cls(indices= file_layers[0::2], values= file_layers[1::2],
+                   shapes= metadata["sparse"]["shapes"], base_version= metadata["base_version"])
+
+    def save(self, file_path: str, metadata: dict = None):
+        file_layers, sparse_metadata = self.to_file_layers()
+        save_weights(file_path, file_layers, metadata= {**(metadata or {}), **sparse_metadata})
+
+
+class TopKSparsifier(object):
+    '''
+    client side top-k sparsification with error feedback:
+    the entries that are not sent are kept as a residual and added to the next update,
+    so that every change eventually reaches the server
+    '''
+    def __init__(self, density: float):
+        if not 0 < density <= 1:
+            raise ValueError(f"The density of the sparse updates must be in (0, 1], got {density}")
+        self.density = density
+        self._residual: List[np.ndarray] = None
+        self._pending_residual: List[np.ndarray] = None
+
+    def encode(self, local_layers: list, base_layers: list, base_version: int) -> SparseDelta:
+        """
+        keep the k largest magnitude entries of (local - base + residual) of every float layer,
+        other layers are sent whole. call commit once the update is uploaded
+        """
+        if self._residual is not None and [np.shape(layer) for layer in self._residual] != [np.shape(layer) for layer in local_layers]:
+            self._residual = None
+
+        all_indices, all_values, residual = [], [], []
+        for index, (local_layer, base_layer) in enumerate(zip(local_layers, base_layers)):
+            local_layer = np.asarray(local_layer)
+            if not np.issubdtype(local_layer.dtype, np.floating):
+                all_indices.append(np.arange(local_layer.size, dtype= np.int64))
+                all_values.append((local_layer - base_layer).reshape(-1))
+                residual.append(np.zeros(local_layer.shape, dtype= np.float32))
+                continue
+
+            delta = np.subtract(local_layer, base_layer, dtype= np.float32)
+            if self._residual is not None:
+                delta += self._residual[index]
+            flat_delta = delta.reshape(-1)
+
+            k = min(max(int(math.ceil(self.density * flat_delta.size)), 1), flat_delta.size)
+            indices = np.argpartition(np.abs(flat_delta), flat_delta.size - k)[flat_delta.size - k:]
+            indices.sort()
+            index_dtype = np.int32 if flat_delta.size < 2 ** 31 else np.int64
+            all_indices.append(indices.astype(index_dtype))
+            all_values.append(flat_delta[indices].copy())
+
+            # what is not sent stays in the residual
+            flat_delta[indices] = 0
+            residual.append(delta)
+
+        self._pending_residual = residual
+        return SparseDelta(indices= all_indices, values= all_values,
+                           shapes= [np.shape(layer) for layer in local_layers], base_version= base_version)
+
+    def commit(self):
+        """
+        the last encoded update reached the server, keep its residual for the next one
+        """
+        if self._pending_residual is not None:
+            self._residual = self._pending_residual
+            self._pending_residual = None
+
+    def reset(self):
+        """
+        the full weights were sent instead, nothing is owed anymore
+        """
+        self._residual = None
+        self._pending_residual = None
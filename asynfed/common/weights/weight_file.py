@@ -0,0 +1,118 @@
+import json
+import logging
+import pickle
+import struct
+from typing import List, Tuple
+
+import numpy as np
+
+from .flat_weights import ALIGNMENT, FlatWeights
+
+LOGGER = logging.getLogger(__name__)
+
+
+# file layout:
+#   preamble: magic (8 bytes) | format version (uint16) | flags (uint16) | header length (uint32), little endian
+#   header: utf-8 json {"layers": [{"name", "shape", "dtype", "offset"}, ...], "metadata": {...}}
+#   zero padding up to the next aligned position, where the data section starts
+#   data: the raw buffer of every layer, each one starting at an aligned offset (in bytes, from the start of the data section)
+MAGIC = b"ASYNFEDW"
+FORMAT_VERSION = 1
+PREAMBLE = struct.Struct("<8sHHI")
+
+
+def _align(nbytes: int) -> int:
+    return -(-nbytes // ALIGNMENT) * ALIGNMENT
+
+
+def is_weight_file(file_path: str) -> bool:
+    with open(file_path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def save_weights(file_path: str, weights, names: List[str] = None, metadata: dict = None):
+    """
+    write a model (list of layers or FlatWeights) to file_path in the binary weight format
+    names: name of each layer, defaults to layer_<index>
+    metadata: json serializable info stored in the header
+    """
+    if isinstance(weights, FlatWeights):
+        layers = weights.to_layers()
+    else:
+        layers = [np.asarray(layer) for layer in weights]
+    if names is not None and len(names) != len(layers):
+        raise ValueError(f"Got {len(layers)} layers but {len(names)} layer names")
+
+    entries = []
+    offset = 0
+    for index, layer in enumerate(layers):
+        if layer.dtype.hasobject:
+            raise ValueError(f"Layer {index} has dtype {layer.dtype}, only numeric layers can be saved")
+        entries.append({"name": names[index] if names is not None else f"layer_{index}",
+                        "shape": list(layer.shape), "dtype": layer.dtype.str, "offset": offset})
+        offset += _align(layer.nbytes)
+
+    header = json.dumps({"layers": entries, "metadata": metadata or {}}).encode("utf-8")
+    data_start = _align(PREAMBLE.size + len(header))
+
+    with open(file_path, "wb") as f:
+        f.write(PREAMBLE.pack(MAGIC, FORMAT_VERSION, 0, len(header)))
+        f.write(header)
+        f.write(bytes(data_start - PREAMBLE.size - len(header)))
+        if isinstance(weights, FlatWeights):
+            # the layers of a flat buffer are already at the same aligned offsets, write it at once
+            f.write(weights.buffer.view(np.uint8))
+        else:
+            for layer in layers:
+                f.write(np.ascontiguousarray(layer).reshape(-1).view(np.uint8))
+                f.write(bytes(_align(layer.nbytes) - layer.nbytes))
+
+
+def read_header(file_path: str) -> Tuple[dict, int]:
+    """
+    return the header of a weight file and the position of its data section,
+    (None, 0) if the file is not in the binary weight format
+    """
+    with open(file_path, "rb") as f:
+        preamble = f.read(PREAMBLE.size)
+        if len(preamble) < PREAMBLE.size or preamble[:len(MAGIC)] != MAGIC:
+            return None, 0
+        _, format_version, _, header_length = PREAMBLE.unpack(preamble)
+        if format_version > FORMAT_VERSION:
+            raise ValueError(f"{file_path} uses weight file format {format_version}, this version only reads up to {FORMAT_VERSION}")
+        header = json.loads(f.read(header_length).decode("utf-8"))
+    return header, _align(PREAMBLE.size + header_length)
+
+
+def read_metadata(file_path: str) -> dict:
+    header, _ = read_header(file_path)
+    return header["metadata"] if header is not None else {}
+
+
+def load_weights(file_path: str, mmap: bool = True, allow_pickle: bool = False) -> List[np.ndarray]:
+    """
+    load the layers of a weight file.
+    mmap: the layers are read only views on a memory map of the file, nothing is copied or read upfront
+    allow_pickle: fall back to pickle for files that are not in the binary weight format.
+        pickle can run arbitrary code, only allow it for files produced by the server itself
+    """
+    header, data_start = read_header(file_path)
+    if header is None:
+        if not allow_pickle:
+            raise ValueError(f"{file_path} is not a binary weight file, refuse to unpickle it")
+        LOGGER.info(f"{file_path} is not a binary weight file, load it with pickle")
+        with open(file_path, "rb") as f:
+            return pickle.load(f)
+
+    if mmap:
+        raw = np.memmap(file_path, dtype= np.uint8, mode= "r")
+    else:
+        raw = np.fromfile(file_path, dtype= np.uint8)
+
+    layers = []
+    for entry in header["layers"]:
+        dtype = np.dtype(entry["dtype"])
+        start = data_start + entry["offset"]
+        nbytes = int(np.prod(entry["shape"])) * dtype.itemsize
+        layers.append(raw[start: start + nbytes].view(dtype).reshape(entry["shape"]))
+    return layers
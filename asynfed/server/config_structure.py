@@ -57,7 +57,11 @@ class InfluxdbConfig(MessageObject):
 
 class Strategy(MessageObject):
     def __init__(self, name: str, m: int, n: int, update_period: int = None,
-                 use_loss: bool = False, beta: float = 0.5):
+                 use_loss: bool = False, beta: float = 0.5, incremental: bool = False,
+                 download_workers: int = 8, download_timeout: int = 120,
+                 queue_max_size: int = None, queue_max_staleness: int = None,
+                 aggregation_workers: int = 1, publish_queue_size: int = 2,
+                 global_cache_size: int = 5):
         self.name = name
         self.use_loss = use_loss
         self.beta = beta
@@ -65,6 +69,24 @@ class Strategy(MessageObject):
         self.m = m
         self.n = n
         self.update_period = update_period
+        # asyn2f only: aggregate each local update as soon as it is notified
+        self.incremental = incremental
+        # number of local models downloaded concurrently in an aggregating round
+        # and the max time (in second) to download each of them
+        self.download_workers = download_workers
+        self.download_timeout = download_timeout
+        # kafl only: bound of the model queue, whose updates stay memory-mapped from their downloaded files:
+        # max number of updates and max number of global versions an update can lag behind before being evicted
+        self.queue_max_size = queue_max_size
+        self.queue_max_staleness = queue_max_staleness
+        # number of threads the weighted sum is split across (by ranges of the flat weight buffer)
+        # when above 1, limit the blas threads (e.g. OPENBLAS_NUM_THREADS=1) to avoid oversubscribing the cores
+        self.aggregation_workers = aggregation_workers
+        # max number of global models waiting to be uploaded while the next rounds are aggregated,
+        # the aggregator blocks when the queue is full
+        self.publish_queue_size = publish_queue_size
+        # number of recent global models kept in memory to rebuild the updates sent relative to them (e.g. sparse updates)
+        self.global_cache_size = global_cache_size
 
 
 class StopConditions(MessageObject):
@@ -84,10 +106,34 @@ class ModelConfig(MessageObject):
     def __init__(self, name: str = "", initial_model_path: str = "initial_model.pkl", 
                  file_extension: str = "pkl", stop_conditions: dict = None,
                  synchronous_learning_rate: dict = None,
-                 model_exchange_at: dict = None):
+                 model_exchange_at: dict = None, compression: list = None,
+                 delta_bases: int = 0, delta_quantization: str = None, delta_resync_period: int = 10,
+                 storage_layout: str = "file",
+                 federated_layers: list = None):
         self.name = name
         self.initial_model_path = initial_model_path
         self.file_extension = file_extension
+        # codecs to compress weight files with, by order of preference: none, lz4, zstd, zlib, lzma
+        # the first one supported by the client is used, lz4 and zstd need their python package.
+        # the files every client may read (global models, diffs, and layer shards that global models can share)
+        # only use the standard library ones: none, zlib, lzma
+        if isinstance(compression, str):
+            compression = [compression]
+        self.compression = compression or ["none"]
+        # number of previous versions a diff to each new global model is published from,
+        # clients holding one of them download the diff instead of the full model.
+        # delta_quantization: None (exact), float16 or int8, clients then hold an approximation of the global model
+        self.delta_bases = delta_bases
+        self.delta_quantization = delta_quantization
+        # with a delta_quantization, the quantization error of the diffs applied in a row adds up:
+        # clients download the full model again after this number of consecutive diffs (0 for never)
+        self.delta_resync_period = delta_resync_period
+        # file: one object per model, sharded: one content addressed object per layer plus a manifest per model,
+        # unchanged layers are then never uploaded or downloaded again
+        self.storage_layout = storage_layout
+        # layers that take part in the federation, as indices in the weight list or "start:stop" slices
+        # (e.g. ["-10:"] for the head), None for all of them. the other layers stay local to each client
+        self.federated_layers = federated_layers
 
         # these 2 objects support default values
 
@@ -103,13 +149,16 @@ class ServerConfig(MessageObject):
     def __init__(self, server_id: str, min_clients: int = 1, ping_period: int = 300, save_log: bool = True, 
                  model_config: dict = None, cleaning_config: dict = None, 
                  cloud_storage: dict = None, queue_consumer: dict = None,
-                 queue_producer: dict = None, influxdb: dict = None, strategy: dict = None
+                 queue_producer: dict = None, influxdb: dict = None, strategy: dict = None,
+                 message_workers: int = 4
                  ):
 
         # these property provide default values
         self.min_clients = min_clients or 1
         self.ping_period = ping_period
         self.save_log = save_log
+        # number of threads handling client messages, messages of a client are still handled in order
+        self.message_workers = message_workers
 
         # this object provide default values
         cleaning_config = cleaning_config or {}
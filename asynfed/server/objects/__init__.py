@@ -1,2 +1,6 @@
 from .worker import Worker
-from .best_model import BestModel
\ No newline at end of file
+from .pending_update import PendingUpdate
+from .model_queue import ModelQueue
+from .best_model import BestModel
+from .publish_job import PublishJob
+from .global_model_cache import GlobalModelCache
@@ -0,0 +1,58 @@
+import collections
+import logging
+import os
+from threading import Lock
+from typing import Callable, List
+
+import numpy as np
+
+from asynfed.common.weights import load_weights
+
+LOGGER = logging.getLogger(__name__)
+
+
+class GlobalModelCache(object):
+    """
+    - LRU cache of the most recent global models, used to rebuild updates sent relative to a global version.
+    - Models are memory mapped from the local global model folder,
+        a version that is not there anymore is downloaded from the cloud storage.
+    """
+
+    def __init__(self, local_folder: str, file_extension: str, download: Callable[[str, str], bool], capacity: int = 5) -> None:
+        """
+        Args:
+            local_folder (str): local folder of the global models.
+            file_extension (str): extension of the global model files.
+            download (Callable[[str, str], bool]): download(file name, local file path), return whether it succeeded.
+            capacity (int, optional): max number of global versions kept. Defaults to 5.
+        """
+        self.local_folder = local_folder
+        self.file_extension = file_extension
+        self.capacity = max(capacity or 1, 1)
+        self._download = download
+        self._models = collections.OrderedDict()
+        self._lock = Lock()
+
+    def get(self, version: int) -> List[np.ndarray]:
+        """
+        return the layers of a global version, None if it can not be found
+        """
+        with self._lock:
+            if version in self._models:
+                self._models.move_to_end(version)
+                return self._models[version]
+
+            file_name = f"{version}.{self.file_extension}"
+            local_path = os.path.join(self.local_folder, file_name)
+            if not os.path.isfile(local_path):
+                LOGGER.info(f"Global model {version} is not in {self.local_folder}, download it")
+                if not self._download(file_name, local_path):
+                    LOGGER.info(f"Fail to download global model {version}")
+                    return None
+
+            # global models are produced by the server, the initial one may still be pickled
+            layers = load_weights(local_path, allow_pickle= True)
+            self._models[version] = layers
+            if len(self._models) > self.capacity:
+                self._models.popitem(last= False)
+            return layers
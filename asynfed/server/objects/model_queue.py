@@ -0,0 +1,88 @@
+import collections
+import logging
+from threading import Lock
+from typing import List
+
+from .pending_update import PendingUpdate
+
+LOGGER = logging.getLogger(__name__)
+
+
+class ModelQueue(object):
+    """
+    - Bounded FIFO queue of pending updates, used by KAFL.
+    - It only holds storage references: the weights of a queued update are memory-mapped
+        from its downloaded file, their pages are read from disk when the update is aggregated.
+    - When the queue is full, the stalest update (oldest global version used) is evicted.
+        Updates trained on a global version too old compared to the current one are evicted as well.
+    """
+
+    def __init__(self, max_size: int = None, max_staleness: int = None) -> None:
+        """
+        Args:
+            max_size (int, optional): max number of queued updates. Defaults to None (no limit).
+            max_staleness (int, optional): max difference between the current global version
+                and the global version an update was trained on. Defaults to None (no limit).
+        """
+        self.max_size = max_size
+        self.max_staleness = max_staleness
+
+        self._queue = collections.deque()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def append(self, update: PendingUpdate, current_version: int = None):
+        with self._lock:
+            if current_version is not None:
+                self._evict_stale(current_version)
+
+            if self.max_size is not None and len(self._queue) >= self.max_size:
+                self._evict_stalest()
+
+            self._queue.append(update)
+
+    def evict_stale(self, current_version: int):
+        """
+        evict the updates trained on a global version too old compared to current_version
+        """
+        with self._lock:
+            self._evict_stale(current_version)
+
+    def popleft_many(self, num_updates: int, current_version: int = None) -> List[PendingUpdate]:
+        """
+        pop the num_updates oldest updates
+        """
+        with self._lock:
+            if current_version is not None:
+                self._evict_stale(current_version)
+            return [self._queue.popleft() for _ in range(min(num_updates, len(self._queue)))]
+
+    def putback(self, updates: List[PendingUpdate]):
+        """
+        put popped updates back at the front of the queue, in their order
+        """
+        with self._lock:
+            self._queue.extendleft(reversed(updates))
+
+    def _evict_stale(self, current_version: int):
+        if self.max_staleness is None:
+            return
+        stale_updates = [update for update in self._queue if current_version - update.global_version_used > self.max_staleness]
+        for update in stale_updates:
+            LOGGER.info(f"Evict the update {update.remote_file_path} of {update.worker_id}: trained on global version {update.global_version_used}, current version is {current_version}")
+            self._remove(update)
+
+    def _evict_stalest(self):
+        # min keeps the first (oldest) update among those trained on the same global version
+        stalest_update = min(self._queue, key= lambda update: update.global_version_used)
+        LOGGER.info(f"Model queue is full ({self.max_size} updates), evict the update {stalest_update.remote_file_path} of {stalest_update.worker_id} trained on global version {stalest_update.global_version_used}")
+        self._remove(stalest_update)
+
+    def _remove(self, update: PendingUpdate):
+        # remove by identity, snapshots of two updates may compare equal
+        for index, queued_update in enumerate(self._queue):
+            if queued_update is update:
+                del self._queue[index]
+                break
@@ -0,0 +1,32 @@
+import os
+from typing import Any, NamedTuple
+
+
+class PendingUpdate(NamedTuple):
+    """
+    - Immutable snapshot of a local update waiting to be aggregated.
+    - Cheap to hand off between the consumer thread and the aggregator:
+        the weight array is a handle shared with whoever loaded it, it is never copied.
+    """
+    worker_id: str
+    remote_file_path: str
+    global_version_used: int
+    local_version: int
+    qod: float
+    data_size: int
+    loss: float
+    performance: float = 0.0
+    weight_array: Any = None
+
+    def get_local_weight_file_path(self, local_model_root_folder: str):
+        filename = self.remote_file_path.split(os.path.sep)[-1]
+        return os.path.join(local_model_root_folder, self.worker_id, filename)
+
+    def get_remote_weight_file_path(self):
+        return self.remote_file_path
+
+    def with_weights(self, weight_array) -> "PendingUpdate":
+        return self._replace(weight_array= weight_array)
+
+    def __str__(self):
+        return f"Update of {self.worker_id} | weight file {self.remote_file_path} | global version used {self.global_version_used} | qod: {self.qod} | datasize: {self.data_size} | loss: {self.loss}"
@@ -0,0 +1,19 @@
+from typing import NamedTuple
+
+
+class PublishJob(NamedTuple):
+    """
+    - A new global model waiting to be uploaded and announced to the clients.
+    - Everything the notify message needs is captured when the model is handed off,
+        so that the aggregator can move on to the next version meanwhile.
+    """
+    version: int
+    local_file_path: str
+    remote_file_path: str
+    total_data_size: int
+    avg_loss: float
+    avg_qod: float
+    learning_rate: float = None
+
+    def __str__(self):
+        return f"Global model {self.version} | local file {self.local_file_path} | remote file {self.remote_file_path} | lr: {self.learning_rate}"
@@ -3,6 +3,8 @@ import os
 from asynfed.common.utils.time_ultils import time_now
 from asynfed.common.messages.client import SystemInfo
 
+from .pending_update import PendingUpdate
+
 
 class Worker:
     """
@@ -21,6 +23,8 @@ class Worker:
         self.data_size = data_size
         self.cloud_access_key: cloud_access_key
         self.cloud_secret_key: cloud_secret_key
+        # compression codecs the worker is able to read and write
+        self.supported_codecs: list = ["none"]
 
         # the initial state
         self.last_ping = time_now()
@@ -32,6 +36,8 @@ class Worker:
         # the cloud storage path where the file is located
         self.global_version_used: int = 0
         self.remote_file_path: str = ""
+        # encoding of the latest local update, as reported by the client (the weight file describes itself)
+        self.update_encoding: str = None
 
         # 
         self.performance = 0.0
@@ -55,6 +61,15 @@ class Worker:
     def get_remote_weight_file_path(self):
         return self.remote_file_path
 
+    def snapshot(self, weight_array= None) -> PendingUpdate:
+        """
+        freeze the info of the latest local update of this worker
+        """
+        return PendingUpdate(worker_id= self.worker_id, remote_file_path= self.remote_file_path,
+                             global_version_used= self.global_version_used, local_version= self.update_local_version_used,
+                             qod= self.qod, data_size= self.data_size, loss= self.loss,
+                             performance= self.performance, weight_array= weight_array)
+
     def reset(self):
         """
         reset all properties 
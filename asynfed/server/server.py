@@ -4,28 +4,32 @@ from datetime import datetime
 from threading import Thread, Lock
 from time import sleep, time
 import concurrent.futures
-import copy
 import json
 import logging
 import os
+import queue
 import sys
 import uuid
 
+import numpy as np
+
 # Third party imports
 from asynfed.common.config import CloudStoragePath, LocalStoragePath, MessageType
 from asynfed.common.messages.client import ClientInitConnection, ClientModelUpdate, NotifyEvaluation, TesterRequestStop
 from asynfed.common.messages.server import GlobalModel, ServerModelUpdate, PingToClient, ServerRequestStop
 from asynfed.common.messages.server.server_response_to_init import ModelInfo, StorageInfo, ServerRespondToInit
-from asynfed.common.queue_connectors import AmqpConsumer, AmqpProducer
+from asynfed.common.queue_connectors import AmqpConsumer, AmqpProducer, OrderedDispatcher
 
 from asynfed.common.messages import ExchangeMessage
 import asynfed.common.messages as message_utils
 import asynfed.common.utils.time_ultils as time_utils
 import asynfed.common.utils.storage_cleaner as storage_cleaner
+from asynfed.common.storage_connectors import negotiate_codec, PORTABLE_CODECS, ShardedModelStorage, SHARD_FOLDER
+from asynfed.common.weights import DeltaWeights, load_weights, quantize, subtract_base, delta_file_name, DELTA_FOLDER
 
 # Local imports
 from .config_structure import ServerConfig
-from .objects import BestModel, Worker
+from .objects import BestModel, Worker, PublishJob
 
 from .monitor.influxdb import InfluxDB
 from .strategies import Strategy, Asyn2fStrategy, KAFLMStepStrategy, FedAvgStrategy
@@ -124,13 +128,19 @@ class Server(object):
         self._strategy: Strategy = self._set_up_strategy()
 
         self.cloud_storage = self._set_up_cloud_storage()
+        self.sharded_storage: ShardedModelStorage = self._set_up_sharded_storage()
         self.worker_manager: WorkerManager = WorkerManager()
         # self.worker_manager: WorkerManager = WorkerManager(lock= self.lock)
         # self._influxdb: InfluxDB = InfluxDB(self.config['influxdb'])
 
         # queue
         # put self in to handle message from client (on_message_received)
-        self._queue_consumer: AmqpConsumer = AmqpConsumer(self.config.queue_consumer, self)
+        # messages are acked manually once handled, a few per dispatcher worker are delivered ahead
+        self._queue_consumer: AmqpConsumer = AmqpConsumer(self.config.queue_consumer, self, auto_ack= False,
+                                                          prefetch_count= 4 * self.config.message_workers)
+        self._message_dispatcher: OrderedDispatcher = OrderedDispatcher(max_workers= self.config.message_workers,
+                                                                        name= "server_message_handler")
+        self._connection_lock = Lock()
         self._queue_producer: AmqpProducer = AmqpProducer(self.config.queue_producer)
 
 
@@ -146,6 +156,14 @@ class Server(object):
         self._clean_storage_thread = Thread(target= self._clean_storage, name="server_clean_storage_thread")
         self._clean_storage_thread.daemon = True
 
+        # publish thread
+        # the aggregator hands every new global model to this thread and starts the next round right away,
+        # models are uploaded and notified one at a time, in version order
+        self._publish_queue: queue.Queue = queue.Queue(maxsize= self.config.strategy.publish_queue_size)
+        self._latest_published_version: int = None
+        self._publish_thread = Thread(target= self._publish, name= "server_publish_thread")
+        self._publish_thread.daemon = True
+
         # -------------  Thread --------------
 
 
@@ -166,6 +184,7 @@ class Server(object):
         self._consumer_thread.start()
         self._ping_thread.start()
         self._clean_storage_thread.start()
+        self._publish_thread.start()
 
 
     def start(self):
@@ -174,14 +193,25 @@ class Server(object):
 
 
     def on_message_received(self, ch, method, props, body):
-        msg_received = message_utils.deserialize(body.decode('utf-8'))
+        try:
+            msg_received = message_utils.deserialize(body, props.content_type)
+        except Exception:
+            LOGGER.exception(f"Drop a message that can not be decoded (content type {props.content_type})")
+            self._queue_consumer.ack(ch, method.delivery_tag)
+            return
         now = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
         # when the server receive the message from client
         # update the timestamp of the client 
         # so that timestamp accross geographical regions could be consistent
         msg_received['headers']['timestamp'] = now
 
-        # Format the datetime object as a string and return it
+        # the consumer thread only decodes, handlers run on the dispatcher in the order each client sent its messages.
+        # the message is acked once handled, so that the ones in flight are redelivered if the server stops
+        self._message_dispatcher.submit(msg_received['headers'].get('client_id'), self._handle_message, msg_received,
+                                        on_done= lambda: self._queue_consumer.ack(ch, method.delivery_tag))
+
+
+    def _handle_message(self, msg_received: dict):
         msg_type = msg_received['headers']['message_type']
         if msg_type == MessageType.CLIENT_INIT_MESSAGE:
             self._respond_connection(msg_received)
@@ -199,89 +229,110 @@ class Server(object):
     # function for queue consumer to call
     # handling when receiving message
     def _respond_connection(self, message: dict):
-        message_utils.print_message(message)
-
-        session_id, reconnect = self.check_client_identity_when_joining(message)
-        client_id: str = message['headers']['client_id']
-        access_key, secret_key = self.cloud_storage.get_client_key()
+        # init messages of different clients are handled concurrently,
+        # the worker registration and the wait for min_clients are done by one at a time
+        with self._connection_lock:
+            message_utils.print_message(message)
+
+            session_id, reconnect = self.check_client_identity_when_joining(message)
+            client_id: str = message['headers']['client_id']
+
+            # the client compresses its weight files with the first preferred codec it supports
+            worker: Worker = self.worker_manager.get_worker_by_id(client_id)
+            worker.supported_codecs = ClientInitConnection(**message['content']).supported_codecs
+            supported_codecs = worker.supported_codecs
+            if self.sharded_storage is not None:
+                # the shards of a local model can be reused by the global models, that every client reads
+                supported_codecs = [codec for codec in supported_codecs if codec in PORTABLE_CODECS]
+            codec = negotiate_codec(self.config.model_config.compression, supported_codecs)
+            access_key, secret_key = self.cloud_storage.get_client_key()
 
-        # notify newest global model to worker
-        model_url = self.cloud_storage.get_newest_global_model()
+            # notify newest global model to worker
+            model_url = self.cloud_storage.get_newest_global_model()
 
-        # always use forward slash for the cloud storage regardless os
-        model_version = self._strategy.extract_model_version(folder_path= model_url)
+            # always use forward slash for the cloud storage regardless os
+            model_version = self._strategy.extract_model_version(folder_path= model_url)
 
-        # update the current version for the strategy 
-        # if the server is just on the first round
-        if self._strategy.current_version == None:
-            self._strategy.current_version = model_version
+            # update the current version for the strategy 
+            # if the server is just on the first round
+            if self._strategy.current_version == None:
+                self._strategy.current_version = model_version
+            # newer versions may still be waiting in the publish queue,
+            # only point the client to a model that is already uploaded
+            if self._latest_published_version == None:
+                self._latest_published_version = model_version
+            published_version = self._latest_published_version
 
-        # model info
-        exchange_at= self.config.model_config.model_exchange_at.to_dict()
+            # model info
+            exchange_at= self.config.model_config.model_exchange_at.to_dict()
 
 
-        model_info: ModelInfo = ModelInfo(global_folder= self.config.cloud_storage.global_model_root_folder, 
-                                          learning_rate= self._strategy.get_learning_rate(),
-                                          name= self.config.model_config.name, version=self._strategy.current_version,
-                                          file_extension= self._strategy.file_extension, exchange_at= exchange_at)
+            model_info: ModelInfo = ModelInfo(global_folder= self.config.cloud_storage.global_model_root_folder, 
+                                              learning_rate= self._strategy.get_learning_rate(version= published_version),
+                                              name= self.config.model_config.name, version= published_version,
+                                              file_extension= self._strategy.file_extension, exchange_at= exchange_at,
+                                              storage_layout= self.config.model_config.storage_layout,
+                                              federated_layers= self.config.model_config.federated_layers)
         
-        # check the correctness of message when sending
-        message_utils.print_message(model_info.to_dict())
+            # check the correctness of message when sending
+            message_utils.print_message(model_info.to_dict())
 
-        client_folder = f"{self._cloud_storage_path.CLIENT_MODEL_ROOT_FOLDER}/{client_id}"
+            client_folder = f"{self._cloud_storage_path.CLIENT_MODEL_ROOT_FOLDER}/{client_id}"
 
-        # storage info
-        storage_info: StorageInfo = StorageInfo(type= self.config.cloud_storage.type,
-                                                access_key= access_key, secret_key= secret_key, 
-                                                bucket_name= self.config.cloud_storage.bucket_name,
-                                                region_name= self.config.cloud_storage.region_name,
-                                                client_upload_folder= client_folder)
+            # storage info
+            storage_info: StorageInfo = StorageInfo(type= self.config.cloud_storage.type,
+                                                    access_key= access_key, secret_key= secret_key, 
+                                                    bucket_name= self.config.cloud_storage.bucket_name,
+                                                    region_name= self.config.cloud_storage.region_name,
+                                                    client_upload_folder= client_folder)
 
-        if not self._aws_s3:
-            storage_info.endpoint_url = self.config.cloud_storage.minio.endpoint_url
+            if not self._aws_s3:
+                storage_info.endpoint_url = self.config.cloud_storage.minio.endpoint_url
 
 
-        # send message
-        headers: dict = self._create_headers(message_type= MessageType.SERVER_INIT_RESPONSE)
-        headers['session_id'] = session_id
-        headers['reconnect'] = reconnect
-        headers['client_id'] = client_id
+            # send message
+            headers: dict = self._create_headers(message_type= MessageType.SERVER_INIT_RESPONSE)
+            headers['session_id'] = session_id
+            headers['reconnect'] = reconnect
+            headers['client_id'] = client_id
 
-        response_to_init: ServerRespondToInit = ServerRespondToInit(strategy= self.config.strategy.name,
-                                                    epoch_update_frequency= self.config.strategy.n,
-                                                    model_info= model_info.to_dict(),
-                                                    storage_info= storage_info.to_dict())
+            response_to_init: ServerRespondToInit = ServerRespondToInit(strategy= self.config.strategy.name,
+                                                        epoch_update_frequency= self.config.strategy.n,
+                                                        model_info= model_info.to_dict(),
+                                                        storage_info= storage_info.to_dict(),
+                                                        compression= codec)
         
 
-        message_utils.print_message(response_to_init.to_dict())
-        message = ExchangeMessage(headers=headers, content=response_to_init.to_dict()).to_json()
-
-        # after receiving a sufficient number of clients
-        # send normally
-        if not self.wait_for_other_clients:
-            self._queue_producer.send_data(message)
-        else:
-            self.init_messages[client_id] = message
-            connected_workers = self.worker_manager.list_connected_workers()
-            if "tester" in connected_workers:
-                num_workers = len(connected_workers) - 1
-            else:
-                num_workers = len(connected_workers)
-
-            if num_workers == self.config.min_clients:
-                self.wait_for_other_clients = False
-                LOGGER.info("*" * 50)
-                LOGGER.info("Minimum number of client have joined. About to send init message to all clients")
-                LOGGER.info("Set time to keep track of the total training time")
-                LOGGER.info("*" * 50)
-                self.manage_training_time.begin_timing()
-
+            message_utils.print_message(response_to_init.to_dict())
+            message = ExchangeMessage(headers=headers, content=response_to_init.to_dict())
 
-                print(connected_workers)
-                for worker_id in connected_workers:
-                    self._queue_producer.send_data(self.init_messages[worker_id])
+            # after receiving a sufficient number of clients
+            # send normally
+            if not self.wait_for_other_clients:
+                self._queue_producer.send_message(message, routing_key= self.config.queue_producer.get_client_routing_key(client_id))
             else:
-                LOGGER.info(f"The min number of client require to start training: {self.config.min_clients}. Up to now, only {num_workers} workers have joined the network.")
+                self.init_messages[client_id] = message
+                connected_workers = self.worker_manager.list_connected_workers()
+                if "tester" in connected_workers:
+                    num_workers = len(connected_workers) - 1
+                else:
+                    num_workers = len(connected_workers)
+
+                if num_workers == self.config.min_clients:
+                    self.wait_for_other_clients = False
+                    LOGGER.info("*" * 50)
+                    LOGGER.info("Minimum number of client have joined. About to send init message to all clients")
+                    LOGGER.info("Set time to keep track of the total training time")
+                    LOGGER.info("*" * 50)
+                    self.manage_training_time.begin_timing()
+
+
+                    print(connected_workers)
+                    for worker_id in connected_workers:
+                        self._queue_producer.send_message(self.init_messages[worker_id],
+                                                          routing_key= self.config.queue_producer.get_client_routing_key(worker_id))
+                else:
+                    LOGGER.info(f"The min number of client require to start training: {self.config.min_clients}. Up to now, only {num_workers} workers have joined the network.")
 
 
     def _handle_client_notify_evaluation(self, message):
@@ -299,14 +350,16 @@ class Server(object):
             headers: dict = self._create_headers(message_type= MessageType.SERVER_STOP_TRAINING)
             require_to_stop: ServerRequestStop = ServerRequestStop()
 
-            message = ExchangeMessage(headers= headers, content= require_to_stop.to_dict()).to_json()
-            self._queue_producer.send_data(message)
+            message = ExchangeMessage(headers= headers, content= require_to_stop.to_dict())
+            self._queue_producer.send_message(message, routing_key= self.config.queue_producer.get_broadcast_routing_key())
             LOGGER.info("=" * 50)
             LOGGER.info("Stop condition met. Log out best model")
             LOGGER.info(self._best_model)
             LOGGER.info("=" * 50)
 
             self.stop_condition_is_met = True
+            # wake up the aggregating thread so that it closes the program
+            self.worker_manager.notify_update()
 
 
         else:
@@ -401,35 +454,26 @@ class Server(object):
         LOGGER.info("*" * 60)
         LOGGER.info("Set max version to be the current version of global model")
         previous_version_setting = self.config.model_config.stop_conditions.max_version
-        self.config.model_config.stop_conditions.max_version = self._strategy.current_version
+        self.config.model_config.stop_conditions.max_version = self._latest_published_version
         LOGGER.info(f"current max version setting: {previous_version_setting}, new current version: {self.config.model_config.stop_conditions.max_version}")
         LOGGER.info("*" * 60)
         
         # send stop message for trainer to stop training
         headers: dict = self._create_headers(message_type= MessageType.SERVER_STOP_TRAINING)
         require_to_stop: ServerRequestStop = ServerRequestStop()
-        message = ExchangeMessage(headers= headers, content= require_to_stop.to_dict()).to_json()
-        self._queue_producer.send_data(message)
+        message = ExchangeMessage(headers= headers, content= require_to_stop.to_dict())
+        self._queue_producer.send_message(message, routing_key= self.config.queue_producer.get_broadcast_routing_key())
 
 
 
     def publish_new_global_model(self):
+        """
+        hand the global model just written by the strategy to the publish thread.
+        only blocks when publish_queue_size models are already waiting to be uploaded
+        """
         # increment the current version to 1
         self._strategy.current_version += 1
 
-        self.manage_training_time.add_timestampt(self._strategy.current_version)
-
-        # check whether max time is reach
-        if self.manage_training_time:
-            if self.manage_training_time.is_max_time_reach(time_utils.time_now()):
-                LOGGER.info("Max training time is reached. Shortly the program will be close after receiving the accuracy of the last global model from tester.")
-                self._handle_when_max_time_is_reached()
-                # self.stop_condition_is_met = True
-
-        LOGGER.info("*" * 20)
-        LOGGER.info(f"CURRENT GLOBAL MODEL VERSION TO BE PUBLISHED: {self._strategy.current_version} with lr: {self._strategy.get_learning_rate()}")
-        LOGGER.info("*" * 20)
-
         current_global_model_filename = self._strategy.get_current_global_model_filename()
         local_filename = os.path.join(self.local_storage_path.GLOBAL_MODEL_ROOT_FOLDER, current_global_model_filename)
 
@@ -437,33 +481,137 @@ class Server(object):
         # regardless of os
         remote_filename = f"{self._cloud_storage_path.GLOBAL_MODEL_ROOT_FOLDER}/{current_global_model_filename}"
 
-        upload_success = self.cloud_storage.upload(local_filename, remote_filename)
+        # capture the stats of this version now, the strategy overwrites them in the next round
+        publish_job: PublishJob = PublishJob(version= self._strategy.current_version,
+                                             local_file_path= local_filename, remote_file_path= remote_filename,
+                                             total_data_size= self._strategy.global_model_update_data_size,
+                                             avg_loss= self._strategy.avg_loss, avg_qod= self._strategy.avg_qod,
+                                             learning_rate= self._strategy.get_learning_rate())
+        self._publish_queue.put(publish_job)
+
 
+    def _publish(self):
+        while True:
+            publish_job: PublishJob = self._publish_queue.get()
+            try:
+                self._publish_global_model(publish_job)
+            except Exception as e:
+                LOGGER.exception(f"Fail to publish global model {publish_job.version}: {e}")
+            finally:
+                self._publish_queue.task_done()
+
+
+    def _publish_global_model(self, publish_job: PublishJob):
+        self.manage_training_time.add_timestampt(publish_job.version)
+
+        LOGGER.info("*" * 20)
+        LOGGER.info(f"CURRENT GLOBAL MODEL VERSION TO BE PUBLISHED: {publish_job.version} with lr: {publish_job.learning_rate}")
+        LOGGER.info("*" * 20)
+
+        codec = self._get_global_model_codec()
+        if self.sharded_storage is not None:
+            upload_success = self.sharded_storage.upload_model(publish_job.local_file_path, publish_job.remote_file_path,
+                                                               codec= codec)
+        else:
+            upload_success = self.cloud_storage.upload(publish_job.local_file_path, publish_job.remote_file_path,
+                                                       codec= codec)
+        delta_bases = self._publish_global_deltas(publish_job, codec= codec) if upload_success else []
+
+        # notify only after the model is in the cloud
         if upload_success:
-            headers: dict = self._create_headers(message_type= MessageType.SERVER_NOTIFY_MESSAGE)
+            self._latest_published_version = publish_job.version
 
-            global_model = GlobalModel(version= self._strategy.current_version,
-                                       total_data_size= self._strategy.global_model_update_data_size,
-                                       avg_loss= self._strategy.avg_loss, avg_qod= self._strategy.avg_qod)
-            
+            # check whether max time is reach
+            if self.manage_training_time:
+                if self.manage_training_time.is_max_time_reach(time_utils.time_now()):
+                    LOGGER.info("Max training time is reached. Shortly the program will be close after receiving the accuracy of the last global model from tester.")
+                    self._handle_when_max_time_is_reached()
+                    # self.stop_condition_is_met = True
+
+            headers: dict = self._create_headers(message_type= MessageType.SERVER_NOTIFY_MESSAGE)
 
-            learning_rate = self._strategy.get_learning_rate()
+            global_model = GlobalModel(version= publish_job.version,
+                                       total_data_size= publish_job.total_data_size,
+                                       avg_loss= publish_job.avg_loss, avg_qod= publish_job.avg_qod,
+                                       delta_bases= delta_bases,
+                                       delta_resync_period= self._get_delta_resync_period())
 
             server_model_update: ServerModelUpdate = ServerModelUpdate(worker_id=[], global_model= global_model.to_dict(),
-                                                                       learning_rate= learning_rate)
+                                                                       learning_rate= publish_job.learning_rate)
             
 
-            message = ExchangeMessage(headers= headers, content= server_model_update).to_json()
+            message = ExchangeMessage(headers= headers, content= server_model_update)
 
 
-            self._queue_producer.send_data(message)
+            self._queue_producer.send_message(message, routing_key= self.config.queue_producer.get_broadcast_routing_key())
             
         else:
             LOGGER.info("-" * 40)
-            LOGGER.warning(f"Fail to upload model {current_global_model_filename} to the cloud storage. Not sending update new model message to clients")
+            LOGGER.warning(f"Fail to upload model {publish_job.remote_file_path} to the cloud storage. Not sending update new model message to clients")
             LOGGER.info("-" * 40)
 
 
+    def _get_delta_resync_period(self) -> int:
+        # exact diffs can be applied in a row forever
+        if not self.config.model_config.delta_quantization:
+            return 0
+        return self.config.model_config.delta_resync_period or 0
+
+    def _publish_global_deltas(self, publish_job: PublishJob, codec: str) -> list:
+        """
+        upload the diffs from the previous versions to the new global model,
+        return the versions a diff was published from
+        """
+        num_bases = self.config.model_config.delta_bases
+        if not num_bases:
+            return []
+
+        new_layers = load_weights(publish_job.local_file_path, allow_pickle= True)
+        local_delta_folder = os.path.join(self.local_storage_path.GLOBAL_MODEL_ROOT_FOLDER, DELTA_FOLDER)
+        os.makedirs(local_delta_folder, exist_ok= True)
+
+        delta_bases = []
+        for base_version in range(publish_job.version - 1, max(publish_job.version - 1 - num_bases, -1), -1):
+            base_layers = self._strategy.get_global_model(base_version)
+            if base_layers is None or [np.shape(layer) for layer in base_layers] != [np.shape(layer) for layer in new_layers]:
+                continue
+
+            delta = subtract_base(new_layers, base_layers)
+            if self.config.model_config.delta_quantization:
+                delta = quantize(delta, dtype= self.config.model_config.delta_quantization)
+
+            file_name = delta_file_name(publish_job.version, base_version, self.config.model_config.file_extension)
+            local_file_path = os.path.join(local_delta_folder, file_name)
+            remote_file_path = f"{self._cloud_storage_path.GLOBAL_MODEL_ROOT_FOLDER}/{DELTA_FOLDER}/{file_name}"
+            DeltaWeights(delta, base_version= base_version).save(local_file_path)
+            try:
+                if self.cloud_storage.upload(local_file_path, remote_file_path, codec= codec):
+                    delta_bases.append(base_version)
+            finally:
+                os.remove(local_file_path)
+
+        if delta_bases:
+            LOGGER.info(f"Published the diffs to global model {publish_job.version} from versions {delta_bases}")
+        return delta_bases
+
+
+    def _set_up_sharded_storage(self) -> ShardedModelStorage:
+        if self.config.model_config.storage_layout != "sharded":
+            return None
+        LOGGER.info("Models are stored as content addressed layer shards")
+        # keep the shards of the models downloaded concurrently in an aggregating round
+        return ShardedModelStorage(cloud_storage= self.cloud_storage,
+                                   shard_folder= f"{self._cloud_storage_path.GLOBAL_MODEL_ROOT_FOLDER}/{SHARD_FOLDER}",
+                                   local_shard_folder= os.path.join(self.local_storage_path.GLOBAL_MODEL_ROOT_FOLDER, SHARD_FOLDER),
+                                   keep_manifests= self.config.strategy.download_workers + 2)
+
+
+    def _get_global_model_codec(self) -> str:
+        # every worker downloads the same global model file, including those that join after it is uploaded:
+        # use the first preferred codec of the standard library, that all of them can read
+        return negotiate_codec(self.config.model_config.compression, PORTABLE_CODECS)
+
+
     def _set_up_cloud_storage(self) -> ServerStorageBoto3:
         self._aws_s3 = False
         if self.config.cloud_storage.type == "aws_s3":
@@ -502,7 +650,7 @@ class Server(object):
         strategy_object: Strategy
         if strategy == "asyn2f":
             strategy_object = Asyn2fStrategy(server= self, model_name= model_name, file_extension= self.config.model_config.file_extension,
-                                             m = self.config.strategy.m, 
+                                             m = self.config.strategy.m, incremental= self.config.strategy.incremental,
                                              initial_learning_rate= self.config.model_config.synchronous_learning_rate.initial_learning_rate,
                                              total_update_times= self.config.model_config.synchronous_learning_rate.total_update_times)
         elif strategy == "kafl":
@@ -537,8 +685,8 @@ class Server(object):
                 LOGGER.info(f'Ping to client {client_id}')
                 headers: dict = self._create_headers(message_type= MessageType.SERVER_PING_TO_CLIENT)
                 pint_to_client: PingToClient = PingToClient(client_id= client_id)
-                message = ExchangeMessage(headers= headers, content= pint_to_client.to_dict()).to_json()
-                self._queue_producer.send_data(message)
+                message = ExchangeMessage(headers= headers, content= pint_to_client.to_dict())
+                self._queue_producer.send_message(message, routing_key= self.config.queue_producer.get_client_routing_key(client_id))
             sleep(self.config.ping_period)
 
 
@@ -556,7 +704,8 @@ class Server(object):
 
             LOGGER.info("CLEANING TIME")
             # -------- Global Weight File Cleaning ------------ 
-            current_global_version = self._strategy.current_version or 1
+            # global models waiting in the publish queue are newer than the published one, they are kept
+            current_global_version = self._latest_published_version or self._strategy.current_version or 1
             global_threshold = current_global_version - self.config.cleaning_config.global_keep_version_num
 
             if self._best_model.model_name != "":
@@ -569,6 +718,11 @@ class Server(object):
             storage_cleaner.delete_remote_files(cloud_storage= self.cloud_storage,
                                     folder_path= self._cloud_storage_path.GLOBAL_MODEL_ROOT_FOLDER,
                                     threshold= global_threshold, best_version= best_global_model_version)
+            if self.config.model_config.delta_bases:
+                # diffs are named after the version they lead to
+                storage_cleaner.delete_remote_files(cloud_storage= self.cloud_storage,
+                                        folder_path= f"{self._cloud_storage_path.GLOBAL_MODEL_ROOT_FOLDER}/{DELTA_FOLDER}",
+                                        threshold= global_threshold)
             
             # delete local files
             storage_cleaner.delete_local_files(folder_path= self.local_storage_path.GLOBAL_MODEL_ROOT_FOLDER, 
@@ -579,11 +733,12 @@ class Server(object):
 
             # -------- Client weight files cleaning -----------
             current_workers = self.worker_manager.get_all_worker()
-            # get a deep copy of the list of current worker in the framework
-            workers = copy.deepcopy(current_workers)
+            # only the latest local version used of each worker is needed,
+            # read it once instead of copying the whole worker pool
+            local_versions_used = {w_id: worker.update_local_version_used for w_id, worker in list(current_workers.items())}
             
-            for w_id, worker in workers.items():
-                client_threshold = worker.update_local_version_used - self.config.cleaning_config.local_keep_version_num
+            for w_id, local_version_used in local_versions_used.items():
+                client_threshold = local_version_used - self.config.cleaning_config.local_keep_version_num
 
                 # delete remote files
                 # self._delete_remote_files(directory= w_id, threshold= client_threshold)
@@ -596,6 +751,16 @@ class Server(object):
                 storage_cleaner.delete_local_files(folder_path= local_directory, threshold= client_threshold)
             # -------- Client weight files cleaning -----------
 
+            # -------- Shards cleaning -----------
+            if self.sharded_storage is not None:
+                manifest_paths = self.cloud_storage.list_files(folder_path= self._cloud_storage_path.GLOBAL_MODEL_ROOT_FOLDER)
+                # an empty global folder means the listing failed, the shards can not be told apart
+                if manifest_paths:
+                    for w_id in local_versions_used:
+                        manifest_paths += self.cloud_storage.list_files(folder_path= f"{self._cloud_storage_path.CLIENT_MODEL_ROOT_FOLDER}/{w_id}")
+                    self.sharded_storage.collect_garbage(manifest_paths)
+            # -------- Shards cleaning -----------
+
 
 
 
@@ -111,6 +111,21 @@ class ServerStorageBoto3(Boto3Connector):
             return []
 
 
+    def list_files_last_modified(self, folder_path) -> dict:
+        """Maps every file in the folder to its last modified time, None if the listing fails"""
+        try:
+            folder_path = f"{folder_path}/"
+            last_modified = {}
+            paginator = self._s3.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=self._bucket_name, Prefix=folder_path, Delimiter='/'):
+                for object in page.get('Contents', []):
+                    if object['Key'] != folder_path:
+                        last_modified[object['Key']] = object['LastModified']
+            return last_modified
+        except Exception as e:
+            logging.error(e)
+            return None
+
         
     def delete_files(self, file_keys: List[str]):
         """Deletes a list of files from the MinIO bucket"""
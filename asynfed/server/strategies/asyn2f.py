@@ -1,20 +1,16 @@
-from time import sleep
 from typing import Dict, List
+import concurrent.futures
+import math
 import os
 
-import numpy as np
-import pickle
-
 import sys
 
-from threading import Lock
-lock = Lock()
+from threading import Event, Lock
+
+thread_pool_ref = concurrent.futures.ThreadPoolExecutor
 
 import asynfed.common.utils.time_ultils as time_utils
 
-from threading import Lock
-from time import sleep
-import copy
 import logging
 import os
 import shutil
@@ -24,9 +20,10 @@ from typing import Dict
 from asynfed.common.messages.client import ClientModelUpdate
 import asynfed.common.messages as message_utils
 
-from asynfed.server.objects import Worker
+from asynfed.server.objects import Worker, PendingUpdate
 from asynfed.server.storage_connectors.boto3 import ServerStorageBoto3
 from asynfed.common.config import LocalStoragePath
+from asynfed.common.weights import FlatWeights, WeightAggregator, WeightAccumulator, is_encoded
 
 
 from .strategy import Strategy
@@ -38,10 +35,31 @@ class Asyn2fStrategy(Strategy):
 
     # def __init__(self, server: Server, model_name: str, file_extension: str, m: int = 3):
     def __init__(self, server, total_update_times: int, initial_learning_rate: float,
-                    model_name: str, file_extension: str, m: int = 1):
+                    model_name: str, file_extension: str, m: int = 1, incremental: bool = False):
         super().__init__(server = server, total_update_times= total_update_times, initial_learning_rate= initial_learning_rate,
                          model_name= model_name, file_extension= file_extension)
         self.m = m
+        self._aggregator = WeightAggregator(executor= self._shard_executor)
+
+        # incremental mode: fold every local update into a running weighted sum
+        # as soon as it is notified, the aggregating step only normalizes and writes
+        self.incremental = incremental
+        self._round_lock = Lock()
+        # the running sum of the current round and a spare one
+        # that take turns so that new updates can be folded while the previous round is being written
+        self._round_sum: WeightAccumulator = WeightAccumulator(executor= self._shard_executor)
+        self._spare_sum: WeightAccumulator = WeightAccumulator(executor= self._shard_executor)
+        # the global version the running sum will produce
+        self._round_version: int = None
+        # worker id -> (alpha, update) of the updates folded in the current round.
+        # the weights are not kept: a replaced update is memory-mapped again from its local file to be subtracted
+        self._round_contributions: Dict[str, tuple] = {}
+        # the local models are downloaded and folded on these threads, not on the message handler
+        self._fold_executor = thread_pool_ref(max_workers= self._server.config.strategy.download_workers or 1,
+                                              thread_name_prefix= "server_fold_thread") if incremental else None
+
+        if self.incremental:
+            LOGGER.info("Asyn2f runs in incremental mode: local updates are aggregated as soon as they arrive")
 
 
     def handle_aggregating_process(self):
@@ -55,26 +73,43 @@ class Asyn2fStrategy(Strategy):
                 # close the program
                 sys.exit(0)
 
-            with lock:
-                n_local_updates = len(self._server.worker_manager.get_completed_workers())
+            # wake up as soon as m local updates are in (or the stop condition is met),
+            # the update period only bounds the wait
+            self._server.worker_manager.wait_for_update(self._is_ready_to_aggregate,
+                                                        timeout= self._server.config.strategy.update_period)
+            n_local_updates = self._count_local_updates()
 
-            if n_local_updates < self.m:
-                sleep(self._server.config.strategy.update_period)
+            if self._server.stop_condition_is_met or n_local_updates < self.m:
+                continue
 
-            else:
-                try:
-                    LOGGER.info(f'Update condition is met. Start update global model with {n_local_updates} local updates')
-                    self._update(n_local_updates)
+            try:
+                LOGGER.info(f'Update condition is met. Start update global model with {n_local_updates} local updates')
+                if self._update(n_local_updates):
                     self._server.publish_new_global_model()
 
-                except Exception as e:
-                    raise e
-                
-    def _update(self, n_local_updates: int):
-        if n_local_updates == 1:
+            except Exception as e:
+                raise e
+
+    def _count_local_updates(self) -> int:
+        if self.incremental:
+            return len(self._round_contributions)
+        return len(self._server.worker_manager.get_completed_workers())
+
+    def _is_ready_to_aggregate(self) -> bool:
+        return self._server.stop_condition_is_met or self._count_local_updates() >= self.m
+
+    def _update(self, n_local_updates: int) -> bool:
+        """
+        return whether a new global model was written
+        """
+        if self.incremental:
+            LOGGER.info("Writing the incrementally aggregated global model...")
+            self._write_round()
+
+        elif n_local_updates == 1:
             LOGGER.info("Only one update from client, passing the model to all other client in the network...")
             completed_worker: dict[str, Worker] = self._server.worker_manager.get_completed_workers()
-            self._pass_one_local_model(completed_worker)
+            return self._pass_one_local_model(completed_worker)
 
         else:
             LOGGER.info("Aggregating process...")
@@ -87,13 +122,14 @@ class Asyn2fStrategy(Strategy):
                 model_filename = worker.get_remote_weight_file_path().split(os.path.sep)[-1]
                 worker.update_local_version_used = self.extract_model_version(model_filename)
 
-            # pass out a copy of completed worker to aggregating process
-            worker_list = copy.deepcopy(completed_workers)
-            self.aggregate(worker_list, self._server.cloud_storage, self._server.local_storage_path)
+            # pass out an immutable snapshot of the completed workers to the aggregating process
+            pending_updates = {w_id: worker.snapshot() for w_id, worker in completed_workers.items()}
+            return self.aggregate(pending_updates, self._server.cloud_storage, self._server.local_storage_path)
+        return True
 
 
 
-    def _pass_one_local_model(self, completed_worker: Dict [str, Worker]):
+    def _pass_one_local_model(self, completed_worker: Dict [str, Worker]) -> bool:
         for w_id, worker in completed_worker.items():
             LOGGER.info(w_id)
             self.avg_loss = worker.loss
@@ -104,16 +140,32 @@ class Asyn2fStrategy(Strategy):
             # download worker weight file
             remote_weight_file = worker.get_remote_weight_file_path()
             local_weight_file = worker.get_local_weight_file_path(local_model_root_folder= self._server.local_storage_path.LOCAL_MODEL_ROOT_FOLDER)
-            self._server.cloud_storage.download(remote_file_path= remote_weight_file, 
-                                        local_file_path= local_weight_file)
+            # through the sharded storage when models are stored as layer shards
+            download_success = self._download(cloud_storage= self._server.cloud_storage, remote_file_path= remote_weight_file,
+                                              local_file_path= local_weight_file)
 
             # keep track of the latest local version of worker used for cleaning task
             # model_filename = local_weight_file.split(os.path.sep)[-1]
             worker.update_local_version_used = self.extract_model_version(local_weight_file)
 
+        if not download_success:
+            LOGGER.info(f"Fail to download {remote_weight_file}, no new global model this round")
+            return False
+
         # copy the worker model weight to the global model folder
+        # an encoded (e.g. quantized) update is decoded first, clients expect a plain global model
         save_location = os.path.join(self._server.local_storage_path.GLOBAL_MODEL_ROOT_FOLDER, self.get_new_global_model_filename())
-        shutil.copy(local_weight_file, save_location)
+        # a partial model is completed with the layers of the current global model
+        if is_encoded(local_weight_file) or self._server.config.model_config.federated_layers:
+            weights = self._get_model_weights(local_weight_file)
+            if weights is None:
+                # e.g. the global version the update is relative to is not available anymore
+                LOGGER.info(f"Unable to load the update {local_weight_file}, no new global model this round")
+                return False
+            self.save_global_model(save_location, weights.to_layers() if hasattr(weights, "to_layers") else weights)
+        else:
+            shutil.copy(local_weight_file, save_location)
+        return True
 
 
 
@@ -124,7 +176,13 @@ class Asyn2fStrategy(Strategy):
         client_model_update: ClientModelUpdate = ClientModelUpdate(**message['content'])
 
         # only update the remote local weight path, not download to the device
-        self._server.worker_manager.add_local_update(client_id, client_model_update)
+        # in incremental mode, the update only counts once it is folded into the running sum
+        self._server.worker_manager.add_local_update(client_id, client_model_update, notify= not self.incremental)
+
+        if self.incremental:
+            worker: Worker = self._server.worker_manager.get_worker_by_id(client_id)
+            update: PendingUpdate = worker.snapshot()._replace(local_version= self.extract_model_version(worker.get_remote_weight_file_path()))
+            self._fold_executor.submit(self._fold_local_update, update)
 
         # write to influx db
         # self._influxdb.write_training_process_data(timestamp, client_id, client_model_update)
@@ -135,14 +193,107 @@ class Asyn2fStrategy(Strategy):
         return all_clients
     
 
-    def _compute_alpha(self, worker: Worker) -> float:
+    def _compute_alpha(self, worker: PendingUpdate, update_version: int = None) -> float:
+        update_version = update_version or self.update_version
         # avoid division by zero
         alpha  = worker.qod * worker.data_size / (worker.loss + 1e-7)
-        alpha /= (self.update_version - worker.global_version_used)
+        alpha /= (update_version - worker.global_version_used)
         return alpha
 
-    def aggregate(self, completed_workers: Dict [str, Worker], cloud_storage: ServerStorageBoto3, 
-                  local_storage_path: LocalStoragePath):
+
+    def _fold_local_update(self, update: PendingUpdate):
+        try:
+            self._fold(update)
+        except Exception:
+            LOGGER.exception(f"Fail to fold the update {update.remote_file_path} of {update.worker_id}")
+        finally:
+            self._server.worker_manager.notify_update()
+
+    def _fold(self, update: PendingUpdate):
+        client_id = update.worker_id
+        remote_path = update.get_remote_weight_file_path()
+        if not self._server.cloud_storage.is_file_exists(file_path= remote_path):
+            LOGGER.info(f"worker {client_id}: weight file {remote_path} does not exist in the cloud. Not folding it into the running aggregate")
+            return
+
+        local_model_root_folder = self._server.local_storage_path.LOCAL_MODEL_ROOT_FOLDER
+        local_path = update.get_local_weight_file_path(local_model_root_folder= local_model_root_folder)
+        if not self._attempt_to_download(cloud_storage= self._server.cloud_storage, remote_file_path= remote_path, local_file_path= local_path):
+            return
+        weights = self._get_model_weights(local_path)
+        if weights is None:
+            return
+
+        with self._round_lock:
+            if self._round_version is None:
+                self._round_version = self.current_version + 1
+
+            # a worker contributes once per round, with its latest update
+            previous = self._round_contributions.get(client_id)
+            if previous is not None:
+                previous_alpha, previous_update = previous
+                if previous_update.local_version is not None and update.local_version is not None \
+                        and previous_update.local_version >= update.local_version:
+                    LOGGER.info(f"{client_id} already contributed a newer update {previous_update.remote_file_path} to this round, ignore {remote_path}")
+                    return
+
+                previous_path = previous_update.get_local_weight_file_path(local_model_root_folder= local_model_root_folder)
+                previous_weights = self._get_model_weights(previous_path) if os.path.isfile(previous_path) else None
+                if previous_weights is None:
+                    # e.g. the global version it is relative to is not available anymore
+                    LOGGER.info(f"Unable to reload {previous_path} to replace it, keep it in this round and ignore {remote_path}")
+                    return
+                LOGGER.info(f"{client_id} already contributed {previous_path} to this round, replace it with {local_path}")
+                self._round_sum.subtract(previous_weights, previous_alpha)
+                del previous_weights
+
+            alpha = self._compute_alpha(update, update_version= self._round_version)
+            self._round_sum.add(weights, alpha)
+            self._round_contributions[client_id] = (alpha, update)
+
+            LOGGER.info(f"Folded {client_id} into the running aggregate of global version {self._round_version}: "
+                        f"global version used: {update.global_version_used}, alpha: {alpha}, {len(self._round_contributions)} updates so far")
+
+
+    def _write_round(self):
+        # swap the running sum with the spare one,
+        # updates notified from now on go to the next global version
+        with self._round_lock:
+            round_sum = self._round_sum
+            contributions = self._round_contributions
+            self._round_sum = self._spare_sum
+            self._spare_sum = round_sum
+            self._round_contributions = {}
+            self._round_version += 1
+
+            for w_id in contributions.keys():
+                worker = self._server.worker_manager.get_worker_by_id(w_id)
+                worker.is_completed = False
+                # keep track of the latest local version of worker used for cleaning task
+                worker.update_local_version_used = contributions[w_id][1].local_version
+
+        updates = [update for _, update in contributions.values()]
+        self.avg_qod = sum([update.qod for update in updates]) / len(updates)
+        self.avg_loss = sum([update.loss for update in updates]) / len(updates)
+        self.global_model_update_data_size = sum([update.data_size for update in updates])
+        LOGGER.info(f"Total data: {self.global_model_update_data_size}, avg_loss: {self.avg_loss}, avg_qod: {self.avg_qod}")
+        for w_id, (alpha, _) in contributions.items():
+            LOGGER.info(f"{w_id}: {alpha / round_sum.total_alpha}")
+
+        merged_weights: FlatWeights = round_sum.normalize()
+        save_location = os.path.join(self._server.local_storage_path.GLOBAL_MODEL_ROOT_FOLDER, self.get_new_global_model_filename())
+        self.save_global_model(save_location, merged_weights)
+        round_sum.reset()
+
+        LOGGER.info('=' * 20)
+        LOGGER.info(save_location)
+        LOGGER.info('=' * 20)
+
+    def aggregate(self, completed_workers: Dict [str, PendingUpdate], cloud_storage: ServerStorageBoto3, 
+                  local_storage_path: LocalStoragePath) -> bool:
+        """
+        return whether a new global model was written
+        """
         LOGGER.info("-" * 20)
         LOGGER.info(f"Current global version before aggregating process: {self.current_version}")
         LOGGER.info(f"{len(completed_workers)} workers are expected to join this aggregating round")
@@ -155,6 +306,10 @@ class Asyn2fStrategy(Strategy):
 
         LOGGER.info(f"After checking for validity of remote file, the number of workers joining the aggregating process is now {len(completed_workers)}")
         LOGGER.info("*" * 20)
+        if not completed_workers:
+            # e.g. every download timed out, nothing to aggregate
+            LOGGER.info("No valid local model left, no new global model this round")
+            return False
 
         # increment the current version
         self.update_version = self.current_version + 1
@@ -169,6 +324,7 @@ class Asyn2fStrategy(Strategy):
         LOGGER.info(f"Total data: {self.global_model_update_data_size}, avg_loss: {self.avg_loss}, avg_qod: {self.avg_qod}")
 
         # calculate alpha of each  worker
+        alphas: Dict[str, float] = {}
         sum_alpha = 0.0
         LOGGER.info("*" * 20)
         for w_id, worker in completed_workers.items():
@@ -177,73 +333,96 @@ class Asyn2fStrategy(Strategy):
             # LOGGER.info(f"worker id {worker.worker_id} with global version used {worker.global_version_used}")
             LOGGER.info(f"substract: {self.update_version - worker.global_version_used}")
             
-            worker.alpha = self._compute_alpha(worker)
-            sum_alpha += worker.alpha
+            alphas[w_id] = self._compute_alpha(worker)
+            sum_alpha += alphas[w_id]
         LOGGER.info("*" * 20)
 
         LOGGER.info("*" * 20)
         LOGGER.info("Alpha after being normalized")
-        for w_id, worker in completed_workers.items():
-            worker.alpha /= sum_alpha
-            LOGGER.info(f"{w_id}: {worker.alpha}")
+        for w_id in completed_workers.keys():
+            alphas[w_id] /= sum_alpha
+            LOGGER.info(f"{w_id}: {alphas[w_id]}")
         LOGGER.info("*" * 20)
 
 
-        # dealing with a list of NumPy arrays of different shapes (each representing the weights of a different layer of a neural network). 
-        # This kind of heterogeneous structure is not conducive to the vectorized operations that make NumPy efficient
-        # loop through each layer in the list
-        # more efficient than converting the entire list into a single 'object'-dtype NumPy array
         # aggregating to get the new global weights
-        merged_weights = None
-        for w_id, worker in completed_workers.items():
-            # initialized zero array if merged weight is None
-            if merged_weights is None:
-                # choose dtype = float 32 to reduce the size of the weight file
-                merged_weights = [np.zeros(layer.shape, dtype=np.float32) for layer in worker.weight_array]
-
-            # merging
-            for merged_layer, worker_layer in zip(merged_weights, worker.weight_array):
-                merged_layer += worker.alpha * worker_layer
+        # all layers of all workers are summed at once in a single float32 matrix-vector product
+        # into a buffer that is reused from round to round
+        merged_weights: FlatWeights = self._aggregator.weighted_sum(weights= [worker.weight_array for worker in completed_workers.values()],
+                                                                    alphas= [alphas[w_id] for w_id in completed_workers.keys()])
 
 
         # save weight file.
         # increment here to begin upload the model
         save_location = os.path.join(local_storage_path.GLOBAL_MODEL_ROOT_FOLDER, self.get_new_global_model_filename())
 
-        with open(save_location, "wb") as f:
-            pickle.dump(merged_weights, f)
+        self.save_global_model(save_location, merged_weights)
         LOGGER.info('=' * 20)
         LOGGER.info(save_location)
         LOGGER.info('=' * 20)
-        
+        return True
 
 
-    def _get_valid_completed_workers(self, workers: Dict[str, Worker], cloud_storage: ServerStorageBoto3,
-                                     local_model_root_folder: str) -> Dict[str, Worker]:
+    def _get_valid_completed_workers(self, workers: Dict[str, PendingUpdate], cloud_storage: ServerStorageBoto3,
+                                     local_model_root_folder: str) -> Dict[str, PendingUpdate]:
         valid_completed_workers = {}
+        if not workers:
+            return valid_completed_workers
+
+        # check, download and load the weight file of every worker concurrently
+        # so that one slow or missing upload does not stall the others
+        max_workers = min(self._server.config.strategy.download_workers or 1, len(workers))
+        timeout = self._server.config.strategy.download_timeout
+
+        # set once the round gives up on the downloads still running, they stop at their next chunk
+        cancel_event = Event()
+        executor = thread_pool_ref(max_workers= max_workers, thread_name_prefix= "server_download_thread")
+        futures = {executor.submit(self._download_worker_weights, worker, cloud_storage, local_model_root_folder, timeout, cancel_event): w_id
+                   for w_id, worker in workers.items()}
+
+        # every worker has its own timeout once its download starts,
+        # queued downloads start when a thread of the pool is free
+        round_timeout = timeout * math.ceil(len(workers) / max_workers) if timeout else None
+        done, not_done = concurrent.futures.wait(futures, timeout= round_timeout)
+        cancel_event.set()
+        executor.shutdown(wait= False, cancel_futures= True)
+
+        for future in not_done:
+            LOGGER.info(f"worker {futures[future]}: download does not finish in {timeout} seconds. Remove {futures[future]} from aggregating process")
+
+        for future in done:
+            w_id = futures[future]
+            try:
+                weight_array = future.result()
+            except Exception as e:
+                LOGGER.info(f"worker {w_id}: fail to load the weight file ({e}). Remove {w_id} from aggregating process")
+                continue
+
+            if weight_array is not None:
+                valid_completed_workers[w_id] = workers[w_id].with_weights(weight_array)
 
-        for w_id, worker in workers.items():
-            remote_path = worker.get_remote_weight_file_path()
-            LOGGER.info("*" * 20)
-            LOGGER.info(f"{worker.worker_id} qod: {worker.qod}, loss: {worker.loss}, datasize : {worker.data_size}, weight file: {remote_path}")
-            file_exists = cloud_storage.is_file_exists(file_path= remote_path)
-            
-            if file_exists:
-                LOGGER.info(f"{remote_path} exists in the cloud. Begin to download shortly")
-                local_path = worker.get_local_weight_file_path(local_model_root_folder= local_model_root_folder)
-                download_success = self._attempt_to_download(cloud_storage= cloud_storage, 
-                                                             remote_file_path= remote_path, local_file_path= local_path)
-                
-                if download_success:
-                    worker.weight_array =  self._get_model_weights(local_path)
-                    valid_completed_workers[w_id] = worker
+        return valid_completed_workers
 
-            else:
-                LOGGER.info(f"worker {w_id}: weight file {remote_path} does not exist in the cloud. Remove {w_id} from aggregating process")
 
-            LOGGER.info("*" * 20)
+    def _download_worker_weights(self, worker: PendingUpdate, cloud_storage: ServerStorageBoto3,
+                                 local_model_root_folder: str, timeout: float = None, cancel_event: Event = None):
+        remote_path = worker.get_remote_weight_file_path()
+        LOGGER.info(f"{worker.worker_id} qod: {worker.qod}, loss: {worker.loss}, datasize : {worker.data_size}, weight file: {remote_path}")
 
-        return valid_completed_workers
+        if not cloud_storage.is_file_exists(file_path= remote_path):
+            LOGGER.info(f"worker {worker.worker_id}: weight file {remote_path} does not exist in the cloud. Remove {worker.worker_id} from aggregating process")
+            return None
+
+        LOGGER.info(f"{remote_path} exists in the cloud. Begin to download shortly")
+        local_path = worker.get_local_weight_file_path(local_model_root_folder= local_model_root_folder)
+        if not self._attempt_to_download(cloud_storage= cloud_storage, remote_file_path= remote_path,
+                                         local_file_path= local_path, timeout= timeout, cancel_event= cancel_event):
+            return None
+        if cancel_event is not None and cancel_event.is_set():
+            # finished after the round moved on, its result would be discarded anyway
+            return None
+
+        return self._get_model_weights(local_path)
 
 
 
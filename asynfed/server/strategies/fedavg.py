@@ -1,29 +1,22 @@
-from time import sleep
 from typing import Dict, List
 import os.path
 
-import numpy as np
-import pickle
-from typing import Dict
 
 from asynfed.server.objects import Worker
 from asynfed.server.storage_connectors.boto3 import ServerStorageBoto3
 from asynfed.common.config import LocalStoragePath
+from asynfed.common.weights import FlatWeights, WeightAggregator
 
 from .strategy import Strategy
 import copy
 import sys
 
-from threading import Lock
-lock = Lock()
 
 
 import logging
 LOGGER = logging.getLogger(__name__)
 
 
-from threading import Lock
-from time import sleep
 import logging
 import os
 import sys
@@ -51,6 +44,7 @@ class FedAvgStrategy(Strategy):
 
         self.use_loss = use_loss
         self.beta = beta or 0.5
+        self._aggregator = WeightAggregator(executor= self._shard_executor)
         
         LOGGER.info("=" * 50)
 
@@ -67,7 +61,6 @@ class FedAvgStrategy(Strategy):
 
     # def start_server(self):
     def handle_aggregating_process(self):
-        sleep(90)
         if not self._server.config.strategy.update_period or self._server.config.strategy.update_period == 0:
             # constantly check for new udpate
             self._server.config.strategy.update_period = 20
@@ -78,45 +71,44 @@ class FedAvgStrategy(Strategy):
                 # close the program
                 sys.exit(0)
 
+            # wake up as soon as m local updates are in and every connected worker is done
+            # (or the stop condition is met), the update period only bounds the wait
+            ready = self._server.worker_manager.wait_for_update(self._is_ready_to_aggregate,
+                                                                timeout= self._server.config.strategy.update_period)
+            if self._server.stop_condition_is_met or not ready:
+                continue
+
             num_completed_workers = len(self._server.worker_manager.get_completed_workers())
-            ready =  num_completed_workers >= self.m
-            print(num_completed_workers, ready)
-            if ready:
-                self._server.worker_manager.update_worker_connections()
-                print(f"This is the number of connected worker: {len(self._server.worker_manager.list_connected_workers())}")
-                connected_workers_complete = self._server.worker_manager.check_connected_workers_complete_status()
-
-                print(f"Status of connected workers: {connected_workers_complete}")
-
-
-                if connected_workers_complete or self.first_aggregating_time:
-                    LOGGER.info(f"This is the number of worker expected to join this round {self.current_version}: {num_completed_workers}")
-                    self.first_aggregating_time = False
-                    try:
-                        completed_workers: Dict [str, Worker] = self._server.worker_manager.get_completed_workers()
-                        LOGGER.info(f'Update condition is met. Start update global model with {len(completed_workers)} local updates')
-                        self._update(completed_workers)
-                        # wait until m worker connected to the network to begin new training epoch
-                        while True:
-                            self._server.worker_manager.update_worker_connections()
-                            if self._server.worker_manager.get_num_connected_workers() >= self.m:
-                                print("About to publish new global model")
-                                self._server.publish_new_global_model()
-                                print("After publishing new global model")
-                                self._server.worker_manager.reset_all_workers_training_state()
-                                print("After reset state of worker")
-                                break
-                            sleep(self._server.config.strategy.update_period)
-
-                    except Exception as e:
-                        raise e
-                else:
-                    sleep(self._server.config.strategy.update_period)
-
-            
-            sleep(self._server.config.strategy.update_period)
-
-                
+            LOGGER.info(f"This is the number of worker expected to join this round {self.current_version}: {num_completed_workers}")
+            self.first_aggregating_time = False
+            try:
+                completed_workers: Dict [str, Worker] = self._server.worker_manager.get_completed_workers()
+                LOGGER.info(f'Update condition is met. Start update global model with {len(completed_workers)} local updates')
+                self._update(completed_workers)
+                # wait until m worker connected to the network to begin new training epoch
+                while not self._server.worker_manager.wait_for_update(self._has_enough_connected_workers,
+                                                                      timeout= self._server.config.strategy.update_period):
+                    pass
+                self._server.publish_new_global_model()
+                self._server.worker_manager.reset_all_workers_training_state()
+                LOGGER.info("Published the new global model, reset the training state of the workers")
+
+            except Exception as e:
+                raise e
+
+    def _is_ready_to_aggregate(self) -> bool:
+        if self._server.stop_condition_is_met:
+            return True
+        worker_manager = self._server.worker_manager
+        if len(worker_manager.get_completed_workers()) < self.m:
+            return False
+        worker_manager.update_worker_connections()
+        return self.first_aggregating_time or worker_manager.check_connected_workers_complete_status()
+
+    def _has_enough_connected_workers(self) -> bool:
+        self._server.worker_manager.update_worker_connections()
+        return self._server.worker_manager.get_num_connected_workers() >= self.m
+
     def _update(self, completed_workers: Dict [str, Worker]):
         LOGGER.info("Aggregating process...")
         
@@ -142,7 +134,8 @@ class FedAvgStrategy(Strategy):
         # still mark as is completed 
         # so that it does not block the server to aggregate
         # when aggregating, the other constrain is the weight array is not None
-        self._server.worker_manager.add_local_update(client_id, client_model_update)
+        # the aggregating thread is only notified once the weights are downloaded
+        self._server.worker_manager.add_local_update(client_id, client_model_update, notify= False)
 
         worker: Worker = self._server.worker_manager.get_worker_by_id(client_id)
         remote_path = worker.get_remote_weight_file_path()
@@ -155,6 +148,8 @@ class FedAvgStrategy(Strategy):
             if download_success:
                 worker.weight_array =  self._get_model_weights(local_path)
 
+        self._server.worker_manager.notify_update()
+
         # write to influx db
         # self._influxdb.write_training_process_data(timestamp, client_id, client_model_update)
 
@@ -175,39 +170,31 @@ class FedAvgStrategy(Strategy):
         return alpha
 
     def aggregate(self, completed_workers: Dict [str, Worker], local_storage_path: LocalStoragePath):
-        # dealing with a list of NumPy arrays of different shapes (each representing the weights of a different layer of a neural network). 
-        # This kind of heterogeneous structure is not conducive to the vectorized operations that make NumPy efficient
-        # loop through each layer in the list
-        # more efficient than converting the entire list into a single 'object'-dtype NumPy array
         # aggregating to get the new global weights
         self.global_model_update_data_size = sum([worker.data_size for w_id, worker in completed_workers.items()])
         self.total_loss = sum([worker.loss for w_id, worker in completed_workers.items()])
 
-        merged_weights = None
-
+        weights = []
+        alphas = []
         for w_id, worker in completed_workers.items():
             worker.alpha = self._compute_alpha(worker)
             LOGGER.info(f"{w_id}, alpha: {worker.alpha}, data_size: {worker.data_size}, loss: {worker.loss}")
 
             if worker.weight_array is not None:
                 LOGGER.info(f"{w_id}: {worker.data_size}, {worker.get_remote_weight_file_path()}, global version used: {worker.global_version_used}")
-                # initialized zero array if merged weight is None
-                if merged_weights is None:
-                    # choose dtype = float 32 to reduce the size of the weight file
-                    merged_weights = [np.zeros(layer.shape, dtype=np.float32) for layer in worker.weight_array]
+                weights.append(worker.weight_array)
+                alphas.append(worker.alpha)
 
-                # self.com
-                # merging
-                for merged_layer, worker_layer in zip(merged_weights, worker.weight_array):
-                    merged_layer += worker.alpha * worker_layer
+        # all layers of all workers are summed at once in a single float32 matrix-vector product
+        # into a buffer that is reused from round to round
+        merged_weights: FlatWeights = self._aggregator.weighted_sum(weights= weights, alphas= alphas)
 
 
         # save weight file.
         # increment here to begin upload the model
         save_location = os.path.join(local_storage_path.GLOBAL_MODEL_ROOT_FOLDER, self.get_new_global_model_filename())
 
-        with open(save_location, "wb") as f:
-            pickle.dump(merged_weights, f)
+        self.save_global_model(save_location, merged_weights)
         LOGGER.info('=' * 20)
         LOGGER.info(save_location)
         LOGGER.info('=' * 20)
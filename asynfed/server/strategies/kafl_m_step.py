@@ -1,34 +1,24 @@
-from time import sleep
 from typing import Dict, List
 import os
 
-import numpy as np
-import pickle
 
-
-from asynfed.server.objects import Worker
+from asynfed.server.objects import Worker, PendingUpdate, ModelQueue
 from asynfed.server.storage_connectors.boto3 import ServerStorageBoto3
 from asynfed.common.config import LocalStoragePath
+from asynfed.common.weights import FlatWeights, WeightAccumulator
 
 from .strategy import Strategy
 
 import sys
 
-from threading import Lock
-lock = Lock()
-
 
 import logging
 LOGGER = logging.getLogger(__name__)
 
 
-from threading import Lock
-from time import sleep
-import copy
 import logging
 import os
 import sys
-import collections
 
 # Third party imports
 from asynfed.common.messages.client import ClientModelUpdate
@@ -49,10 +39,16 @@ class KAFLMStepStrategy(Strategy):
                          model_name= model_name, file_extension= file_extension)
         self.m = m
         self.agg_hyperparam = agg_hyperparam
+        # float32 running sum reused from round to round
+        self._accumulator = WeightAccumulator(executor= self._shard_executor)
         # create a queue to store all the model get from client, 
         # regardless of whether within each update 
         # these model come from the same worker
-        self.model_queue = collections.deque()
+        # the queue only references the downloaded files (memory-mapped) and is bounded:
+        # when it is full, the stalest update is evicted
+        strategy_config = self._server.config.strategy
+        self.model_queue = ModelQueue(max_size= strategy_config.queue_max_size,
+                                      max_staleness= strategy_config.queue_max_staleness)
 
 
     def handle_aggregating_process(self):
@@ -66,34 +62,50 @@ class KAFLMStepStrategy(Strategy):
                 # close the program
                 sys.exit(0)
 
-            total_local_models = len(self.model_queue)
-            if total_local_models < self.m:
-                sleep(self._server.config.strategy.update_period)
-
-            else:
-                try:
-                    LOGGER.info("*" * 20)
-                    LOGGER.info(f'In the attempt to aggregate new global version {self.current_version}, the number of models in the queue is {total_local_models}')
-                    LOGGER.info(f'Update condition is met. Start update global model with {self.m} local updates')
-                    LOGGER.info("*" * 20)
-                    self._update()
+            # wake up as soon as m local models are queued (or the stop condition is met),
+            # the update period only bounds the wait
+            self._server.worker_manager.wait_for_update(self._is_ready_to_aggregate,
+                                                        timeout= self._server.config.strategy.update_period)
+            total_local_models = self._count_local_models()
+
+            if self._server.stop_condition_is_met or total_local_models < self.m:
+                continue
+
+            try:
+                LOGGER.info("*" * 20)
+                LOGGER.info(f'In the attempt to aggregate new global version {self.current_version}, the number of models in the queue is {total_local_models}')
+                LOGGER.info(f'Update condition is met. Start update global model with {self.m} local updates')
+                LOGGER.info("*" * 20)
+                if self._update():
                     self._server.publish_new_global_model()
 
-                except Exception as e:
-                    raise e
-                
+            except Exception as e:
+                raise e
+
+    def _count_local_models(self) -> int:
+        # the updates that became too stale while waiting in the queue are evicted before counting
+        self.model_queue.evict_stale(self.current_version)
+        return len(self.model_queue)
 
-    def _get_m_local_model(self):
-        worker_models = []
-        for _ in range(self.m):
-            worker_models.append(self.model_queue.popleft())
-        return worker_models
+    def _is_ready_to_aggregate(self) -> bool:
+        return self._server.stop_condition_is_met or self._count_local_models() >= self.m
 
-    def _update(self):
+    def _get_m_local_model(self) -> List[PendingUpdate]:
+        # the updates that became too stale while waiting in the queue are evicted first
+        return self.model_queue.popleft_many(self.m, current_version= self.current_version)
+
+    def _update(self) -> bool:
+        """
+        return whether a new global model was written
+        """
         LOGGER.info("Aggregating process...")
-        worker_models: list = self._get_m_local_model()
+        worker_models: List[PendingUpdate] = self._get_m_local_model()
+        if len(worker_models) < self.m:
+            LOGGER.info(f"Only {len(worker_models)} updates left in the queue after evicting the stale ones, wait for {self.m}")
+            self.model_queue.putback(worker_models)
+            return False
 
-        self.aggregate(worker_models, self._server.cloud_storage, self._server.local_storage_path)
+        return self.aggregate(worker_models, self._server.cloud_storage, self._server.local_storage_path)
 
 
 
@@ -105,7 +117,8 @@ class KAFLMStepStrategy(Strategy):
         client_model_update: ClientModelUpdate = ClientModelUpdate(**message['content'])
 
         # update the state in the worker manager to clean storage
-        self._server.worker_manager.add_local_update(client_id, client_model_update)
+        # the update only counts once it is in the model queue, notify after enqueuing it
+        self._server.worker_manager.add_local_update(client_id, client_model_update, notify= False)
 
 
         worker: Worker = self._server.worker_manager.get_worker_by_id(client_id)
@@ -117,14 +130,16 @@ class KAFLMStepStrategy(Strategy):
             download_success = self._attempt_to_download(cloud_storage= self._server.cloud_storage, 
                                                             remote_file_path= remote_path, local_file_path= local_path)
             if download_success:
-                worker.weight_array =  self._get_model_weights(local_path)
                 model_filename = worker.get_remote_weight_file_path().split(os.path.sep)[-1]
                 worker.update_local_version_used = self.extract_model_version(model_filename)
 
-                # enqueue a copy of worker to model queue
-                clone_worker = copy.deepcopy(worker)
-
-                self.model_queue.append(clone_worker)
+                # enqueue an immutable snapshot of the update to model queue
+                # the weights are only referenced by the snapshot, not copied nor kept on the worker
+                weights = self._get_model_weights(local_path)
+                if weights is not None:
+                    self.model_queue.append(worker.snapshot(weight_array= weights),
+                                            current_version= self.current_version)
+                    self._server.worker_manager.notify_update()
 
         # write to influx db
         # self._influxdb.write_training_process_data(timestamp, client_id, client_model_update)
@@ -134,8 +149,11 @@ class KAFLMStepStrategy(Strategy):
         return all_clients
     
 
-    def aggregate(self, workers: List [Worker], cloud_storage: ServerStorageBoto3,
-                  local_storage_path: LocalStoragePath):
+    def aggregate(self, workers: List [PendingUpdate], cloud_storage: ServerStorageBoto3,
+                  local_storage_path: LocalStoragePath) -> bool:
+        """
+        return whether a new global model was written
+        """
 
         # print(self.current_version)
         if self.current_version == 1:
@@ -147,7 +165,10 @@ class KAFLMStepStrategy(Strategy):
                 LOGGER.info("*" * 10)
                 LOGGER.info(f"global model does not exist in the remote storage, shortly begin to download: {remote_path}")
                 LOGGER.info("*" * 10)
-                cloud_storage.download(remote_file_path= remote_path, local_file_path= local_path)
+                # through the sharded storage when models are stored as layer shards
+                if not self._download(cloud_storage= cloud_storage, remote_file_path= remote_path, local_file_path= local_path):
+                    LOGGER.warning(f"Fail to download the global model {remote_path}, skip this round")
+                    return False
 
         # dealing with a list of NumPy arrays of different shapes (each representing the weights of a different layer of a neural network). 
         # This kind of heterogeneous structure is not conducive to the vectorized operations that make NumPy efficient
@@ -172,25 +193,33 @@ class KAFLMStepStrategy(Strategy):
         #     pickle.dump(aggregate_global_weight, f)
 
         self.global_model_update_data_size = sum([worker.data_size for worker in workers])
-        w_g = np.array(self._get_model_weights(local_path), dtype=object)
-        w_new = np.array([np.zeros(layer.shape) for layer in w_g], dtype=object)
+        # the initial model (and global models of older runs) may still be pickled
+        w_g = self._get_model_weights(local_path, allow_pickle= True)
+        if w_g is None:
+            LOGGER.warning(f"Unable to load the global model {local_path}, skip this round")
+            return False
+        w_g = self.select_federated_layers(w_g)
 
         LOGGER.info(f"Update global version: {self.current_version}")
         for worker in workers:
             LOGGER.info(f"{worker.worker_id}: global version used: {worker.global_version_used}, datasize: {worker.data_size}, weight file: {worker.get_remote_weight_file_path()}")
-            worker_array = np.array(worker.weight_array, dtype=object)
-            worker_weighted = worker.data_size / self.global_model_update_data_size
-            w_new += (worker_array * worker_weighted)
 
-        ## Calculate w_g(t+1)
-        w_g_new = w_g * (1-self.agg_hyperparam) + w_new * self.agg_hyperparam
+        ## Calculate w_g(t+1) = w_g * (1 - h) + sum(w_i * data_size_i / total_data_size) * h
+        # accumulated in place in float32, one model at a time:
+        # the previous global model (whatever its dtype) is cast while being scaled into the running sum,
+        # then each worker model is scaled and added through the same reused scratch buffer
+        self._accumulator.reset()
+        self._accumulator.add(w_g, 1 - self.agg_hyperparam)
+        for worker in workers:
+            self._accumulator.add(worker.weight_array, self.agg_hyperparam * worker.data_size / self.global_model_update_data_size)
+        w_g_new: FlatWeights = self._accumulator.weights
 
         save_location = os.path.join(local_storage_path.GLOBAL_MODEL_ROOT_FOLDER, self.get_new_global_model_filename())
 
-        with open(save_location, "wb") as f:
-            pickle.dump(w_g_new, f)
+        self.save_global_model(save_location, w_g_new)
 
         LOGGER.info('=' * 20)
         LOGGER.info(save_location)
         LOGGER.info('=' * 20)
+        return True
         
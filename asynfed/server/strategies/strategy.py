@@ -3,11 +3,13 @@ import uuid
 from typing import List
 import re
 from abc import ABC, abstractmethod
-from time import sleep
-import pickle
+from threading import Event
+from time import sleep, time
 from typing import Dict
-from asynfed.server.objects import Worker
+from asynfed.server.objects import Worker, GlobalModelCache
 from asynfed.server.storage_connectors.boto3 import ServerStorageBoto3
+from asynfed.common.weights import ShardExecutor, FlatWeights, load_model, get_base_version, save_weights, is_encoded_model
+from asynfed.common.weights import resolve_layer_mask, select_layers, merge_layers
 
 import math
 import sys
@@ -49,6 +51,17 @@ class Strategy(ABC):
         self.avg_loss = 0.0
         self.avg_qod = 0.0
 
+        # thread pool shared by the aggregating buffers of the strategy
+        self._shard_executor = ShardExecutor(num_threads= self._server.config.strategy.aggregation_workers)
+        if self._shard_executor.num_threads > 1:
+            LOGGER.info(f"Aggregation is split across {self._shard_executor.num_threads} threads")
+
+        # recent global models, the base of the updates sent relative to a global version
+        self._global_model_cache = GlobalModelCache(local_folder= self._server.local_storage_path.GLOBAL_MODEL_ROOT_FOLDER,
+                                                    file_extension= self.file_extension,
+                                                    download= self._download_global_model,
+                                                    capacity= self._server.config.strategy.global_cache_size)
+
         # now the lr scheduler is just support consine schedule
         if total_update_times:
             LOGGER.info(f"Synchronous learning rate is turn on. Total update time to create a cosine lr scheduler for {total_update_times} update times")
@@ -93,8 +106,8 @@ class Strategy(ABC):
         return lr_scheduler
     
     
-    def get_learning_rate(self) -> float:
-        current_version = self.current_version or 0
+    def get_learning_rate(self, version: int = None) -> float:
+        current_version = version or self.current_version or 0
         if self.lr_scheduler is not None:
             lr = self.lr_scheduler.get_learning_rate(current_version - 1)
         else: 
@@ -124,13 +137,20 @@ class Strategy(ABC):
         # If no match was found, return None
         return None
 
-    def _attempt_to_download(self, cloud_storage: ServerStorageBoto3, remote_file_path: str, local_file_path: str) -> bool:
+    def _attempt_to_download(self, cloud_storage: ServerStorageBoto3, remote_file_path: str, local_file_path: str,
+                             timeout: float = None, cancel_event: Event = None) -> bool:
+        """
+        timeout (in second) bounds all the attempts together, a transfer still running is interrupted when it is over.
+        cancel_event: stop the download as soon as it is set
+        """
         LOGGER.info("Downloading new client model............")
         attemp = 3
+        deadline = time() + timeout if timeout else None
+        cancel_event = cancel_event or Event()
 
         for i in range(attemp):
-            if cloud_storage.download(remote_file_path= remote_file_path, 
-                                            local_file_path= local_file_path, try_time= attemp):
+            if self._download(cloud_storage, remote_file_path= remote_file_path, local_file_path= local_file_path,
+                              deadline= deadline, cancel_event= cancel_event):
                 return True
             
             LOGGER.info(f"{i + 1} attempt: download model failed, retry in 5 seconds.")
@@ -138,12 +158,75 @@ class Strategy(ABC):
             i += 1
             if i == attemp:
                 LOGGER.info(f"Already try 3 time. Pass this client model: {remote_file_path}")
-            sleep(5)
+            if deadline is not None and time() + 5 >= deadline:
+                LOGGER.info(f"Download timeout ({timeout} seconds) is reached. Pass this client model: {remote_file_path}")
+                break
+            if cancel_event.wait(5):
+                LOGGER.info(f"Download is cancelled. Pass this client model: {remote_file_path}")
+                break
 
         return False
     
 
-    def _get_model_weights(self, file_path):
+    def get_layer_mask(self, num_layers: int) -> list:
+        """
+        indices of the federated layers of a model of num_layers layers, None when the whole model is federated
+        """
+        return resolve_layer_mask(self._server.config.model_config.federated_layers, num_layers)
+
+    def select_federated_layers(self, layers: list) -> list:
+        # local updates only hold the federated layers, global models hold all of them
+        if not self._server.config.model_config.federated_layers:
+            return layers
+        return select_layers(layers, self.get_layer_mask(num_layers= len(layers)))
+
+    def save_global_model(self, save_location: str, weights):
+        """
+        write the aggregated weights as the new global model,
+        the layers that are not federated are carried over from the current global model
+        """
+        if not self._server.config.model_config.federated_layers:
+            save_weights(save_location, weights)
+            return
+
+        current_global_model = self.get_global_model(self.current_version)
+        if current_global_model is None:
+            current_global_model = load_model(self._server.config.model_config.initial_model_path, allow_pickle= True)
+        if isinstance(weights, FlatWeights) or is_encoded_model(weights):
+            weights = weights.to_layers()
+        layer_mask = self.get_layer_mask(num_layers= len(current_global_model))
+        save_weights(save_location, merge_layers(current_global_model, layer_mask, weights))
+
+    def get_global_model(self, version: int) -> list:
+        """
+        layers of a recent global version, None if it is not available anymore
+        """
+        return self._global_model_cache.get(version)
+
+    def _download_global_model(self, file_name: str, local_file_path: str) -> bool:
+        # the cloud storage is set up after the strategy
+        remote_file_path = f"{self._server._cloud_storage_path.GLOBAL_MODEL_ROOT_FOLDER}/{file_name}"
+        return self._download(self._server.cloud_storage, remote_file_path= remote_file_path, local_file_path= local_file_path)
+
+    def _download(self, cloud_storage: ServerStorageBoto3, remote_file_path: str, local_file_path: str,
+                  deadline: float = None, cancel_event: Event = None) -> bool:
+        """
+        deadline (a time() value) and cancel_event interrupt the transfer itself, not only the retries
+        """
+        # models may be stored as layer shards and a manifest
+        if self._server.sharded_storage is not None:
+            return self._server.sharded_storage.download_model(remote_file_path= remote_file_path, local_file_path= local_file_path,
+                                                               deadline= deadline, cancel_event= cancel_event)
+        return cloud_storage.download(remote_file_path= remote_file_path, local_file_path= local_file_path, try_time= 3,
+                                      deadline= deadline, cancel_event= cancel_event)
+
+    def _get_model_weights(self, file_path, allow_pickle: bool = False):
+        """
+        memory map a weight file, return None if it is not a valid weight file.
+        encoded (e.g. quantized) updates are returned as they are, the aggregating buffers decode them on the fly.
+        updates sent relative to a global version (e.g. sparse) are bound to that version, None if it is not available anymore
+        allow_pickle: also accept pickled weights, only for models produced by the server (initial model, global models)
+        """
         while not os.path.isfile(file_path):
             LOGGER.info("*" * 20)
             LOGGER.info("Sleep 5 second when the the download process is not completed, then retry")
@@ -151,8 +234,25 @@ class Strategy(ABC):
             LOGGER.info("*" * 20)
             sleep(5)
 
-        with open(file_path, "rb") as f:
-            weights = pickle.load(f)
-            
+        try:
+            weights = load_model(file_path, allow_pickle= allow_pickle)
+        except ValueError as e:
+            LOGGER.warning(f"Unable to load {file_path}: {e}")
+            return None
+
+        base_version = get_base_version(weights)
+        if base_version is not None:
+            base_layers = self.get_global_model(base_version)
+            if base_layers is not None:
+                base_layers = self.select_federated_layers(base_layers)
+            if base_layers is None:
+                LOGGER.warning(f"Global model {base_version} that {file_path} is based on is not available. Pass this client model")
+                return None
+            try:
+                weights.bind(base_layers)
+            except ValueError as e:
+                LOGGER.warning(f"Unable to load {file_path}: {e}")
+                return None
+
         return weights
     
\ No newline at end of file
@@ -1,5 +1,5 @@
 import logging
-from typing import Dict, List
+from typing import Callable, Dict, List
 
 from asynfed.server.objects import Worker
 from asynfed.common.messages.client import ClientModelUpdate
@@ -8,7 +8,7 @@ import asynfed.common.utils.time_ultils as time_utils
 LOGGER = logging.getLogger(__name__)
 
 
-from threading import Lock
+from threading import Condition, Lock
 
 class WorkerManager:
     def __init__(self) -> None:
@@ -17,19 +17,49 @@ class WorkerManager:
         self.worker_pool: Dict[str, Worker] = {}
         self.history_state: Dict[int, Dict[str, Worker]] = {}
         # self.lock = lock  # Initialize a lock
+        # signaled whenever the state of a worker changes (new update, join, ping)
+        # so that the aggregating thread wakes up as soon as its trigger condition is met
+        self._update_condition = Condition()
 
     def add_worker(self, worker: Worker) -> None:
         self.worker_pool[worker.worker_id] = worker
+        self.notify_update()
 
     def get_all_worker(self) -> Dict [str, Worker]:
         return self.worker_pool
 
-    def add_local_update(self, client_id: str, client_model_update: ClientModelUpdate):
+    def add_local_update(self, client_id: str, client_model_update: ClientModelUpdate, notify: bool = True):
+        """
+        notify: wake up the aggregating thread right away.
+            strategies that still have work to do on the update (download, enqueue) pass False
+            and call notify_update themselves once the update is usable
+        """
         worker: Worker = self.worker_pool[client_id]
         worker.is_completed = True
         worker.remote_file_path = client_model_update.storage_path
         worker.global_version_used = client_model_update.global_version_used
         worker.loss = client_model_update.loss
+        if client_model_update.encoding != worker.update_encoding:
+            LOGGER.info(f"{client_id} now uploads its updates as {client_model_update.encoding}")
+            worker.update_encoding = client_model_update.encoding
+        if notify:
+            self.notify_update()
+
+    def notify_update(self):
+        """
+        wake up the threads blocked in wait_for_update so that they re-check their condition.
+        must not be called while holding a lock the waiting predicate takes
+        """
+        with self._update_condition:
+            self._update_condition.notify_all()
+
+    def wait_for_update(self, predicate: Callable[[], bool], timeout: float = None) -> bool:
+        """
+        block until predicate() is true, re-checking it each time notify_update is called.
+        return the last value of predicate, False when the timeout (in second) expires first
+        """
+        with self._update_condition:
+            return self._update_condition.wait_for(predicate, timeout= timeout)
 
     def get_completed_workers(self) -> Dict:
         return {worker_id: self.worker_pool[worker_id] for worker_id in list(self.worker_pool.keys()) if self.worker_pool[worker_id].is_completed == True}
@@ -75,6 +105,7 @@ class WorkerManager:
 
     def update_worker_last_ping(self, worker_id):
         self.worker_pool[worker_id].last_ping = time_utils.time_now()
+        self.notify_update()
 
     def to_dict(self) -> Dict[str, Dict]:
         """